@@ -0,0 +1,541 @@
+import re
+import json
+import time
+import random
+import hashlib
+import itertools
+import threading
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Optional
+
+import openai
+from openai.types import Batch, FileObject
+from openai.types.chat import ChatCompletion
+
+# A responder returns the chat completion of a request body, given its custom_id
+Responder = Callable[[dict, str], dict]
+
+# =============================
+# Responders
+# =============================
+
+
+def _words_of_request(body: dict) -> list[str]:
+    user_messages = [m for m in body["messages"] if m["role"] == "user"]
+    words = user_messages[-1]["content"].split() if user_messages else []
+    return words or ["synthetic"]
+
+
+def instance_from_schema(
+    schema: dict, rng: random.Random, words: list[str], defs: dict | None = None
+):
+    """
+    Random instance of a JSON schema, with strings made of spans of the prompt (and the
+    prefix their description asks for, if any).
+    """
+
+    defs = schema.get("$defs", {}) if defs is None else defs
+    if "$ref" in schema:
+        return instance_from_schema(defs[schema["$ref"].split("/")[-1]], rng, words, defs)
+    if "anyOf" in schema:
+        options = [o for o in schema["anyOf"] if o.get("type") != "null"]
+        return instance_from_schema(rng.choice(options), rng, words, defs)
+    if "const" in schema:
+        return schema["const"]
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+
+    type_ = schema.get("type")
+    if isinstance(type_, list):
+        type_ = next((t for t in type_ if t != "null"), "null")
+    if type_ == "object":
+        return {
+            key: instance_from_schema(value, rng, words, defs)
+            for key, value in schema.get("properties", {}).items()
+        }
+    if type_ == "array":
+        return [
+            instance_from_schema(schema.get("items", {}), rng, words, defs)
+            for _ in range(rng.randint(max(schema.get("minItems", 1), 1), 3))
+        ]
+    if type_ == "string":
+        start = rng.randrange(len(words))
+        text = " ".join(words[start : start + rng.randint(3, 12)])
+        # Fields described as 'beginning with "Estimate "' (e.g. EstimationPrompt.prompt)
+        prefix = re.search(r'beginning with "([^"]*)"', schema.get("description", ""))
+        return prefix.group(1) + text if prefix else text
+    if type_ == "integer":
+        return rng.randint(1, 1_000_000)
+    if type_ == "number":
+        return round(rng.uniform(1.0, 1_000_000.0), 2)
+    if type_ == "boolean":
+        return True  # Flags like SingleValue.single_value must be true
+    return None
+
+
+def _logprob_entry(token: str, logprob: float) -> dict:
+    return {"token": token, "logprob": logprob, "bytes": list(token.encode("utf-8"))}
+
+
+def completion_of_content(
+    body: dict, custom_id: str, content: str, logprobs: Optional[dict] = None
+) -> dict:
+    """Chat completion for a request with the given answer."""
+
+    prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+    completion_tokens = max(len(content) // 4, 1)
+    return {
+        "id": f"chatcmpl-{custom_id}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body["model"],
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "logprobs": logprobs,
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _answer_logprobs(content: str) -> dict:
+    # The answer for sure, as the only token
+    top = [(content, -1e-9)] + [
+        (other, -21.0 - i)
+        for i, other in enumerate(o for o in ["YES", "NO", "NA"] if o != content)
+    ]
+    return {
+        "content": [
+            _logprob_entry(*top[0]) | {"top_logprobs": [_logprob_entry(*t) for t in top]}
+        ]
+    }
+
+
+def synthetic_completion(
+    body: dict, custom_id: str, yes_probability: float = 0.8
+) -> dict:
+    """
+    Chat completion for a batch request: an instance of the requested JSON schema for
+    structured outputs, or a YES/NO answer with top logprobs for classification requests.
+    Deterministic in the custom_id.
+    """
+
+    rng = random.Random(custom_id)
+    logprobs = None
+    if body.get("logprobs"):
+        if rng.random() < yes_probability:
+            top = [("YES", -1e-9), ("NO", -21.0), ("NA", -22.0)]
+        else:
+            top = [("NO", -0.01), ("YES", -5.0), ("NA", -22.0)]
+        content = top[0][0]
+        logprobs = {
+            "content": [
+                _logprob_entry(*top[0])
+                | {"top_logprobs": [_logprob_entry(*t) for t in top]}
+            ]
+        }
+    elif body.get("response_format", {}).get("type") == "json_schema":
+        schema = body["response_format"]["json_schema"]["schema"]
+        content = json.dumps(instance_from_schema(schema, rng, _words_of_request(body)))
+    else:
+        content = " ".join(_words_of_request(body)[:20])
+    return completion_of_content(body, custom_id, content, logprobs)
+
+
+class SyntheticResponder:
+    """Random answers of the requested shape (see synthetic_completion)."""
+
+    def __init__(self, yes_probability: float = 0.8):
+        self.yes_probability = yes_probability
+
+    def __call__(self, body: dict, custom_id: str) -> dict:
+        return synthetic_completion(body, custom_id, self.yes_probability)
+
+
+class CannedResponder:
+    """
+    Fixed answers by the last user message of the request. Requests without one are
+    answered by fallback (by default, synthetically).
+    """
+
+    def __init__(self, answers: dict[str, str], fallback: Optional[Responder] = None):
+        self.answers = answers
+        self.fallback = fallback or SyntheticResponder()
+
+    def __call__(self, body: dict, custom_id: str) -> dict:
+        user_messages = [m for m in body["messages"] if m["role"] == "user"]
+        content = self.answers.get(user_messages[-1]["content"] if user_messages else "")
+        if content is None:
+            return self.fallback(body, custom_id)
+        logprobs = _answer_logprobs(content) if body.get("logprobs") else None
+        return completion_of_content(body, custom_id, content, logprobs)
+
+
+class RuleResponder:
+    """
+    Answers with the content of the first rule whose pattern is found in the prompt
+    (all its messages), or with the fallback responder if none matches.
+    """
+
+    def __init__(
+        self, rules: list[tuple[str, str]], fallback: Optional[Responder] = None
+    ):
+        self.rules = [(re.compile(pattern), content) for pattern, content in rules]
+        self.fallback = fallback or SyntheticResponder()
+
+    def __call__(self, body: dict, custom_id: str) -> dict:
+        prompt = "\n".join(m["content"] for m in body["messages"])
+        for pattern, content in self.rules:
+            if pattern.search(prompt):
+                logprobs = _answer_logprobs(content) if body.get("logprobs") else None
+                return completion_of_content(body, custom_id, content, logprobs)
+        return self.fallback(body, custom_id)
+
+
+class LocalModelResponder:
+    """
+    Answers with a model served locally behind an OpenAI-compatible chat completions
+    endpoint (e.g. vLLM or llama.cpp), optionally in place of the requested model.
+    """
+
+    def __init__(self, base_url: str, model: Optional[str] = None, api_key: str = "local"):
+        self.client = openai.Client(base_url=base_url, api_key=api_key)
+        self.model = model
+
+    def __call__(self, body: dict, custom_id: str) -> dict:
+        if self.model is not None:
+            body = body | {"model": self.model}
+        return self.client.chat.completions.create(**body).model_dump(mode="json")
+
+
+# =============================
+# Emulator
+# =============================
+
+
+class BatchAPIEmulator:
+    """
+    In-process stand-in of the files, batches and chat completions endpoints of the OpenAI
+    API. Requests are answered by responder (synthetic answers by default). A batch waits
+    queue_delay seconds in "validating", then completes its requests at one every
+    processing_time_per_request seconds, and a real-time request takes
+    processing_time_per_request seconds. Each request of a batch fails with probability
+    failure_rate, and each batch expires with probability expire_rate (its requests then
+    fail with "batch_expired"), deterministically in seed.
+    OpenAIBatchHandler(backend=emulator) sends its requests to it without any HTTP.
+    """
+
+    def __init__(
+        self,
+        responder: Optional[Responder] = None,
+        queue_delay: float = 1.0,
+        processing_time_per_request: float = 1e-4,
+        failure_rate: float = 0.0,
+        expire_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        self.responder = responder or SyntheticResponder()
+        self.queue_delay = queue_delay
+        self.processing_time_per_request = processing_time_per_request
+        self.failure_rate = failure_rate
+        self.expire_rate = expire_rate
+        self.seed = seed
+
+        self.files: dict[str, bytes] = {}
+        self.batches: dict[str, dict] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def client(self) -> "EmulatedClient":
+        return EmulatedClient(self)
+
+    def async_client(self) -> "AsyncEmulatedClient":
+        return AsyncEmulatedClient(self)
+
+    def create_file(self, content: bytes, purpose: str) -> dict:
+        with self._lock:
+            file_id = f"file-{next(self._ids)}"
+            self.files[file_id] = content
+        return {
+            "id": file_id,
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": f"{file_id}.jsonl",
+            "purpose": purpose,
+            "status": "processed",
+        }
+
+    def create_completion(self, body: dict) -> dict:
+        # Real-time request, deterministic in its body
+        time.sleep(self.processing_time_per_request)
+        custom_id = hashlib.sha256(json.dumps(body, sort_keys=True).encode()).hexdigest()
+        return self.responder(body, custom_id[:16])
+
+    def _draw(self, *keys) -> float:
+        # Uniform in [0, 1), deterministic in the seed and keys
+        return random.Random("::".join(str(key) for key in (self.seed,) + keys)).random()
+
+    def create_batch(self, params: dict) -> dict:
+        requests = [
+            json.loads(line)
+            for line in self.files[params["input_file_id"]].decode().split("\n")
+            if line.strip()
+        ]
+        now = time.time()
+        processing_time = self.processing_time_per_request * len(requests)
+        with self._lock:
+            batch_id = f"batch-{next(self._ids)}"
+            self.batches[batch_id] = {
+                "params": params,
+                "requests": requests,
+                "created_at": now,
+                "in_progress_at": now + self.queue_delay,
+                "completed_at": now + self.queue_delay + processing_time,
+                "expires": self._draw(batch_id) < self.expire_rate,
+                "output_file_id": None,
+                "error_file_id": None,
+                "num_failed": 0,
+                "finished": False,
+            }
+        return self.retrieve_batch(batch_id)
+
+    def _output_line(self, batch_id: str, batch: dict, request: dict) -> tuple[bool, str]:
+        custom_id = request["custom_id"]
+        if batch["expires"]:
+            error = {"code": "batch_expired", "message": "The batch expired"}
+        elif self._draw(batch_id, custom_id) < self.failure_rate:
+            error = {"code": "server_error", "message": "Injected failure"}
+        else:
+            response = {
+                "status_code": 200,
+                "request_id": custom_id,
+                "body": self.responder(request["body"], custom_id),
+            }
+            line = {"id": f"batch_req_{custom_id}", "custom_id": custom_id}
+            return True, json.dumps(line | {"response": response, "error": None})
+        line = {"id": f"batch_req_{custom_id}", "custom_id": custom_id}
+        return False, json.dumps(line | {"response": None, "error": error})
+
+    def _write_output_files(self, batch_id: str, batch: dict):
+        outputs, errors = [], []
+        for request in batch["requests"]:
+            succeeded, line = self._output_line(batch_id, batch, request)
+            (outputs if succeeded else errors).append(line)
+        with self._lock:
+            if batch["finished"]:
+                return
+            for key, lines in [("output_file_id", outputs), ("error_file_id", errors)]:
+                if lines:
+                    batch[key] = f"file-{next(self._ids)}"
+                    self.files[batch[key]] = ("\n".join(lines) + "\n").encode()
+            batch["num_failed"] = len(errors)
+            batch["finished"] = True
+
+    def list_batches(self, limit: int = 20, after: str | None = None) -> dict:
+        # From the newest, as OpenAI does
+        with self._lock:
+            batch_ids = list(reversed(self.batches))
+        if after is not None:
+            batch_ids = batch_ids[batch_ids.index(after) + 1 :]
+        data = [self.retrieve_batch(batch_id) for batch_id in batch_ids[:limit]]
+        return {
+            "object": "list",
+            "data": data,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None,
+            "has_more": len(batch_ids) > limit,
+        }
+
+    def retrieve_batch(self, batch_id: str) -> dict | None:
+        batch = self.batches.get(batch_id)
+        if batch is None:
+            return None
+
+        now = time.time()
+        total = len(batch["requests"])
+        failed = 0
+        if now < batch["in_progress_at"]:
+            status, completed = "validating", 0
+        elif now < batch["completed_at"]:
+            status = "in_progress"
+            completed = int(
+                total
+                * (now - batch["in_progress_at"])
+                / (batch["completed_at"] - batch["in_progress_at"])
+            )
+        else:
+            status = "expired" if batch["expires"] else "completed"
+            if not batch["finished"]:
+                self._write_output_files(batch_id, batch)
+            failed = batch["num_failed"]
+            completed = total - failed
+
+        return {
+            "id": batch_id,
+            "object": "batch",
+            "endpoint": batch["params"]["endpoint"],
+            "input_file_id": batch["params"]["input_file_id"],
+            "completion_window": batch["params"]["completion_window"],
+            "status": status,
+            "output_file_id": batch["output_file_id"],
+            "error_file_id": batch["error_file_id"],
+            "created_at": int(batch["created_at"]),
+            "in_progress_at": (
+                int(batch["in_progress_at"]) if status != "validating" else None
+            ),
+            "completed_at": (
+                int(batch["completed_at"]) if status == "completed" else None
+            ),
+            "expired_at": int(batch["completed_at"]) if status == "expired" else None,
+            "request_counts": {"total": total, "completed": completed, "failed": failed},
+        }
+
+
+# =============================
+# Clients
+# =============================
+
+# Stand-ins of the parts of openai.Client and openai.AsyncClient used by the handlers of
+# utils.openai, backed by an emulator
+
+
+def _file_content(emulator: BatchAPIEmulator, file_id: str) -> bytes:
+    content = emulator.files.get(file_id)
+    if content is None:
+        raise KeyError(f"Unknown file {file_id}")
+    return content
+
+
+def _batch(emulator: BatchAPIEmulator, batch_id: str) -> Batch:
+    batch = emulator.retrieve_batch(batch_id)
+    if batch is None:
+        raise KeyError(f"Unknown batch {batch_id}")
+    return Batch.model_validate(batch)
+
+
+class _FileContent:
+    def __init__(self, content: bytes):
+        self.content = content
+
+    def iter_bytes(self, chunk_size: int = 1 << 20):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start : start + chunk_size]
+
+
+class _AsyncFileContent(_FileContent):
+    async def iter_bytes(self, chunk_size: int = 1 << 20):
+        for chunk in super().iter_bytes(chunk_size):
+            yield chunk
+
+
+class _BatchPage:
+    def __init__(self, emulator: BatchAPIEmulator, limit: int, after: Optional[str]):
+        self._emulator = emulator
+        self._limit = limit
+        page = emulator.list_batches(limit, after)
+        self.data = [Batch.model_validate(batch) for batch in page["data"]]
+        self._has_more = page["has_more"]
+
+    def has_next_page(self) -> bool:
+        return self._has_more and bool(self.data)
+
+    def _next_page(self) -> "_BatchPage":
+        return type(self)(self._emulator, self._limit, self.data[-1].id)
+
+    def __iter__(self):
+        page = self
+        while True:
+            yield from page.data
+            if not page.has_next_page():
+                return
+            page = page._next_page()
+
+
+class _AsyncBatchPage(_BatchPage):
+    async def get_next_page(self) -> "_AsyncBatchPage":
+        return self._next_page()
+
+
+class _Namespace:
+    def __init__(self, **attributes):
+        self.__dict__.update(attributes)
+
+
+class EmulatedClient:
+    def __init__(self, emulator: BatchAPIEmulator):
+        self.emulator = emulator
+
+        @contextmanager
+        def streaming_content(file_id: str):
+            yield _FileContent(_file_content(emulator, file_id))
+
+        self.files = _Namespace(
+            create=lambda file, purpose: FileObject.model_validate(
+                emulator.create_file(file.read(), purpose)
+            ),
+            content=lambda file_id: _file_content(emulator, file_id),
+            with_streaming_response=_Namespace(content=streaming_content),
+        )
+        self.batches = _Namespace(
+            create=lambda **params: Batch.model_validate(emulator.create_batch(params)),
+            retrieve=lambda batch_id: _batch(emulator, batch_id),
+            list=lambda limit=20, after=None: _BatchPage(emulator, limit, after),
+        )
+        self.chat = _Namespace(
+            completions=_Namespace(
+                create=lambda **body: ChatCompletion.model_validate(
+                    emulator.create_completion(body)
+                )
+            )
+        )
+
+    def close(self):
+        pass
+
+
+class AsyncEmulatedClient:
+    def __init__(self, emulator: BatchAPIEmulator):
+        self.emulator = emulator
+
+        async def create_file(file, purpose: str) -> FileObject:
+            return FileObject.model_validate(emulator.create_file(file.read(), purpose))
+
+        async def content(file_id: str) -> bytes:
+            return _file_content(emulator, file_id)
+
+        @asynccontextmanager
+        async def streaming_content(file_id: str):
+            yield _AsyncFileContent(_file_content(emulator, file_id))
+
+        async def create_batch(**params) -> Batch:
+            return Batch.model_validate(emulator.create_batch(params))
+
+        async def retrieve_batch(batch_id: str) -> Batch:
+            return _batch(emulator, batch_id)
+
+        async def list_batches(limit: int = 20, after: Optional[str] = None):
+            return _AsyncBatchPage(emulator, limit, after)
+
+        async def create_completion(**body) -> ChatCompletion:
+            return ChatCompletion.model_validate(emulator.create_completion(body))
+
+        self.files = _Namespace(
+            create=create_file,
+            content=content,
+            with_streaming_response=_Namespace(content=streaming_content),
+        )
+        self.batches = _Namespace(
+            create=create_batch, retrieve=retrieve_batch, list=list_batches
+        )
+        self.chat = _Namespace(completions=_Namespace(create=create_completion))
+
+    async def close(self):
+        pass
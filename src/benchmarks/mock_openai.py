@@ -0,0 +1,138 @@
+import re
+import json
+import time
+import threading
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.batch_emulator import BatchAPIEmulator, Responder, SyntheticResponder
+
+
+def _parse_multipart(body: bytes, content_type: str) -> dict[str, bytes]:
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    fields = {}
+    for part in body.split(b"--" + boundary):
+        if b"\r\n\r\n" not in part:
+            continue
+        headers, content = part.split(b"\r\n\r\n", 1)
+        name = re.search(rb'name="([^"]+)"', headers)
+        if name:
+            fields[name.group(1).decode()] = content.removesuffix(b"\r\n")
+    return fields
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload: dict | bytes):
+        time.sleep(self.server.mock.latency)
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header(
+            "Content-Type",
+            "application/octet-stream" if isinstance(payload, bytes) else "application/json",
+        )
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self):
+        self._send(404, {"error": {"message": f"Unknown path {self.path}"}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        mock = self.server.mock
+        if self.path == "/v1/files":
+            fields = _parse_multipart(body, self.headers["Content-Type"])
+            self._send(200, mock.create_file(fields["file"], fields["purpose"].decode()))
+        elif self.path == "/v1/batches":
+            self._send(200, mock.create_batch(json.loads(body)))
+        elif self.path == "/v1/chat/completions":
+            self._send(200, mock.create_completion(json.loads(body)))
+        else:
+            self._not_found()
+
+    def do_GET(self):
+        mock = self.server.mock
+        url = urlparse(self.path)
+        if url.path == "/v1/batches":
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            self._send(
+                200, mock.list_batches(int(query.get("limit", 20)), query.get("after"))
+            )
+        elif match := re.fullmatch(r"/v1/batches/([^/?]+)", self.path):
+            batch = mock.retrieve_batch(match.group(1))
+            if batch is None:
+                return self._not_found()
+            self._send(200, batch)
+        elif match := re.fullmatch(r"/v1/files/([^/?]+)/content", self.path):
+            content = mock.files.get(match.group(1))
+            if content is None:
+                return self._not_found()
+            self._send(200, content)
+        else:
+            self._not_found()
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    mock: "MockOpenAIServer"
+
+
+class MockOpenAIServer(BatchAPIEmulator):
+    """
+    BatchAPIEmulator served over HTTP, for clients that are not given the emulator (e.g.
+    whole runs of the pipeline in another process), with each HTTP response taking latency
+    seconds. Point the client to it with OPENAI_BASE_URL=server.url.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        queue_delay: float = 1.0,
+        processing_time_per_request: float = 1e-4,
+        yes_probability: float = 0.8,
+        responder: Optional[Responder] = None,
+        failure_rate: float = 0.0,
+        expire_rate: float = 0.0,
+        seed: int = 0,
+    ):
+        super().__init__(
+            responder=responder or SyntheticResponder(yes_probability),
+            queue_delay=queue_delay,
+            processing_time_per_request=processing_time_per_request,
+            failure_rate=failure_rate,
+            expire_rate=expire_rate,
+            seed=seed,
+        )
+        self.latency = latency
+
+        self._server = _Server((host, port), _Handler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
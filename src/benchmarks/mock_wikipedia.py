@@ -0,0 +1,157 @@
+import json
+import time
+import random
+import string
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+VITAL_TOPICS = [
+    "Geography",
+    "Everyday life",
+    "Society and social sciences",
+    "Biology and health sciences",
+    "Physical sciences",
+    "Technology",
+    "Mathematics",
+    "History",  # Filtered out by add_vital_topics
+]
+NOUNS = ["population", "length", "area", "height", "weight", "number of visitors", "depth"]
+UNITS = ["km", "m", "kg", "people", "tonnes", "litres", "years"]
+FILLER = "It is known for its history and is often described in the literature."
+
+
+def synthetic_page(topic: str, paragraphs: int) -> str:
+    rng = random.Random(topic)
+    html = []
+    for i in range(paragraphs):
+        if i % 3 == 2:
+            text = FILLER
+        else:
+            noun, unit = rng.choice(NOUNS), rng.choice(UNITS)
+            value = rng.randint(2, 10_000_000)
+            text = f"The {noun} of {topic} is approximately {value:,} {unit}. {FILLER}"
+        html.append(f"<p>{text}</p>")
+    return '<div class="mw-parser-output">' + "".join(html) + "</div>"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: "_Server"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        mock = self.server.mock
+        query = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+        time.sleep(mock.latency)
+
+        if query.get("action") == "parse":
+            payload = mock.parse(query["page"])
+        elif query.get("action") == "query":
+            titles = query.get("titles", "").split("|")
+            if query.get("prop") == "revisions":
+                payload = mock.vital_articles(titles[0])
+            else:
+                payload = mock.pages(titles, with_categories=query.get("prop") == "categories")
+        else:
+            payload = {"error": {"code": "badvalue", "info": "Unknown action"}}
+
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    mock: "MockWikipediaServer"
+
+
+class MockWikipediaServer:
+    """
+    Local stand-in of the endpoints of the Wikipedia API used by the pipeline: the vital
+    article lists (action=query&prop=revisions), title normalization and categories
+    (action=query) and page contents (action=parse), for num_topics synthetic topics.
+    Point the pipeline to it with WIKIPEDIA_API_URL=server.url.
+    """
+
+    def __init__(
+        self,
+        num_topics: int,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        paragraphs_per_page: int = 12,
+    ):
+        self.topics = [f"Synthetic topic {i:06}" for i in range(num_topics)]
+        self.topic_set = set(self.topics)
+        self.latency = latency
+        self.paragraphs_per_page = paragraphs_per_page
+
+        self._server = _Server((host, port), _Handler)
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/w/api.php"
+
+    def start(self) -> "MockWikipediaServer":
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def vital_articles(self, title: str) -> dict:
+        letter = title.split("/")[-1].removesuffix(".json")
+        letter_index = string.ascii_uppercase.index(letter)
+        articles = {
+            topic: {"topic": VITAL_TOPICS[i % len(VITAL_TOPICS)]}
+            for i, topic in enumerate(self.topics)
+            if i % len(string.ascii_uppercase) == letter_index
+        }
+        return {
+            "query": {
+                "pages": [
+                    {
+                        "ns": 4,
+                        "title": title,
+                        "revisions": [{"content": json.dumps(articles)}],
+                    }
+                ]
+            }
+        }
+
+    def pages(self, titles: list[str], with_categories: bool) -> dict:
+        pages = []
+        for title in titles:
+            page = {"ns": 0, "title": title}
+            if title not in self.topic_set:
+                page["missing"] = True
+            elif with_categories:
+                page["categories"] = [{"ns": 14, "title": "Category:Synthetic topics"}]
+            pages.append(page)
+        return {"query": {"pages": pages}}
+
+    def parse(self, page: str) -> dict:
+        if page not in self.topic_set:
+            return {"error": {"code": "missingtitle", "info": "The page doesn't exist."}}
+        return {
+            "parse": {
+                "title": page,
+                "text": {"*": synthetic_page(page, self.paragraphs_per_page)},
+            }
+        }
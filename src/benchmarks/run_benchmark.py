@@ -0,0 +1,167 @@
+"""
+Runs the pipeline of main.py end to end against local stand-ins of the OpenAI batch API
+and of the Wikipedia API, over synthetic sets of topics, and reports the time and memory
+of every stage. Nothing is sent to OpenAI or Wikipedia, but the tokenizers of the pipeline
+(tiktoken's o200k_base and Hugging Face's gpt2) are downloaded the first time, and read from
+their caches (TIKTOKEN_CACHE_DIR and HF_HOME) afterwards.
+
+    python src/benchmarks/run_benchmark.py --sizes 1000 10000 100000
+
+Each size runs in its own process and working directory, so that the peak RSS and the
+stage caches of one size do not affect the others.
+"""
+
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.mock_openai import MockOpenAIServer
+from benchmarks.mock_wikipedia import MockWikipediaServer
+
+
+def cache_tokenizers():
+    """Loads the tokenizers once, so that the runs do not fail halfway without network."""
+
+    import tiktoken
+    from tokenizers import Tokenizer
+
+    try:
+        tiktoken.get_encoding("o200k_base")
+        tiktoken.encoding_for_model("gpt-4o-mini")
+        Tokenizer.from_pretrained("gpt2")
+    except Exception as e:
+        sys.exit(
+            f"Could not load the tokenizers ({e!r}). Run the benchmark once with network"
+            " access, or point TIKTOKEN_CACHE_DIR and HF_HOME to caches that have them."
+        )
+
+
+def run_size(args, num_topics: int, report_file: str):
+    workdir = args.workdir or tempfile.mkdtemp(prefix=f"guesstimate-benchmark-{num_topics}-")
+    os.makedirs(workdir, exist_ok=True)
+    print(f"Running the pipeline on {num_topics} topics in {workdir}")
+
+    with MockWikipediaServer(
+        num_topics, latency=args.http_latency
+    ) as wikipedia_server, MockOpenAIServer(
+        latency=args.http_latency,
+        queue_delay=args.queue_delay,
+        processing_time_per_request=args.processing_time,
+        failure_rate=args.failure_rate,
+        expire_rate=args.expire_rate,
+    ) as openai_server:
+        os.environ["WIKIPEDIA_API_URL"] = wikipedia_server.url
+        os.environ["OPENAI_BASE_URL"] = openai_server.url
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        os.environ["OPENAI_BATCH_POLL_INTERVAL"] = str(args.poll_interval)
+        # The mock has no rate limits, so real-time requests are only bounded by it
+        os.environ["OPENAI_REALTIME_RPM"] = str(10**9)
+        os.environ["OPENAI_REALTIME_TPM"] = str(10**12)
+        os.chdir(workdir)
+
+        # Imported only now, since the API URLs are read when the modules are imported
+        import pipeline
+        from main import build_pipeline
+
+        start = time.perf_counter()
+        pipeline.run_pipeline(
+            build_pipeline(
+                execution_mode=args.execution_mode, download_wikipedia_pages=True
+            ),
+            max_workers=args.max_workers,
+        )
+        wall_time = time.perf_counter() - start
+
+    with open(os.path.join("data/pipeline", "run_report.json"), "r", encoding="utf-8") as f:
+        run_report = json.load(f)
+    run_report |= {"num_topics": num_topics, "wall_time": wall_time, "workdir": workdir}
+    with open(report_file, "w", encoding="utf-8") as f:
+        json.dump(run_report, f, ensure_ascii=False, indent=4)
+
+
+def print_report(run_report: dict):
+    print()
+    print(
+        f"{run_report['num_topics']} topics: {run_report['wall_time']:.1f}s"
+        f" (critical path: {run_report['critical_path_wall_time']:.1f}s)"
+    )
+    print(
+        f"{'stage':<34}{'wall (s)':>10}{'cpu (s)':>10}{'peak rss (MB)':>15}{'rss +/- (MB)':>14}"
+        f"{'records':>10}{'records/s':>12}{'queue (s)':>11}{'batch (s)':>11}"
+    )
+    for name, stage in run_report["stages"].items():
+        telemetry = stage.get("telemetry", {})
+        batches = stage.get("batches", [])
+        queue_time = sum(b["queue_time"] or 0 for b in batches)
+        processing_time = sum(b["processing_time"] or 0 for b in batches)
+        print(
+            f"{name:<34}"
+            f"{telemetry.get('wall_time', 0.0):>10.2f}"
+            f"{telemetry.get('cpu_time', 0.0):>10.2f}"
+            f"{telemetry.get('peak_rss_mb') or 0.0:>15.1f}"
+            f"{telemetry.get('rss_delta_mb') or 0.0:>14.1f}"
+            f"{telemetry.get('records', 0):>10}"
+            f"{telemetry.get('records_per_second') or 0.0:>12.1f}"
+            + (f"{queue_time:>11}{processing_time:>11}" if batches else "")
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--output-dir", default="data/benchmarks")
+    parser.add_argument(
+        "--workdir", default=None, help="Working directory (by default, a temporary one)"
+    )
+    parser.add_argument("--max-workers", type=int, default=4)
+    parser.add_argument(
+        "--execution-mode",
+        choices=["batch", "realtime", "auto"],
+        default="batch",
+        help="Execution mode of the LLM stages (see main.py)",
+    )
+    parser.add_argument(
+        "--http-latency", type=float, default=0.0, help="Seconds per HTTP request"
+    )
+    parser.add_argument(
+        "--queue-delay", type=float, default=1.0, help="Seconds before a batch starts"
+    )
+    parser.add_argument(
+        "--processing-time", type=float, default=1e-4, help="Seconds per batch request"
+    )
+    parser.add_argument(
+        "--failure-rate", type=float, default=0.0, help="Share of batch requests that fail"
+    )
+    parser.add_argument(
+        "--expire-rate", type=float, default=0.0, help="Share of batches that expire"
+    )
+    parser.add_argument("--poll-interval", type=float, default=0.5)
+    parser.add_argument("--run-size", type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--report-file", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_size is not None:
+        run_size(args, args.run_size, args.report_file)
+        sys.exit(0)
+
+    cache_tokenizers()
+    os.makedirs(args.output_dir, exist_ok=True)
+    for num_topics in args.sizes:
+        report_file = os.path.abspath(
+            os.path.join(args.output_dir, f"benchmark_{num_topics}.json")
+        )
+        subprocess.run(
+            [sys.executable, __file__, "--run-size", str(num_topics)]
+            + ["--report-file", report_file]
+            + sys.argv[1:],
+            check=True,
+        )
+        with open(report_file, "r", encoding="utf-8") as f:
+            print_report(json.load(f))
@@ -1,9 +1,29 @@
+import os
+import glob
 import json
+import argparse
 
+from utils.columns import read_columns
+from utils.input_output import sibling_file
 
-def load_json(file_path):
-    with open(file_path, "r", encoding="utf-8") as file:
-        return json.load(file)
+
+def load_questions(file_path, key):
+    # Only the needed fields, from the columnar copy of the file if there is one
+    return list(read_columns(file_path, [key, "rewritten-description"]).rows())
+
+
+def last_unfiltered_file(stage_name, cache_dir="data/pipeline"):
+    """Rejected records of the last run of a stage (see pipeline.general.dag)."""
+
+    last_run_files = glob.glob(
+        os.path.join(glob.escape(cache_dir), f"{glob.escape(stage_name)}.*.last_run.json")
+    )
+    if not last_run_files:
+        raise FileNotFoundError(f"No run of {stage_name} found in {cache_dir}")
+    # The most recent of its runs with any parameters
+    with open(max(last_run_files, key=os.path.getmtime), "r", encoding="utf-8") as f:
+        last_run = json.load(f)
+    return sibling_file(last_run["output_file"], "unfiltered")
 
 
 def binary_search_interactive(data, key, questions_per_round=5):
@@ -54,10 +74,23 @@ def binary_search_interactive(data, key, questions_per_round=5):
 
 
 def main():
-    file_path = r"data\pipeline\17_stage_6_filter_clarity.unfiltered.json"
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--file", default=None, help="File with the questions (by default, see --stage)"
+    )
+    parser.add_argument(
+        "--stage",
+        default="clear_questions_gpt4o",
+        help="Stage whose last run's rejected questions are used",
+    )
+    parser.add_argument("--cache-dir", default="data/pipeline")
+    args = parser.parse_args()
+
+    file_path = args.file or last_unfiltered_file(args.stage, args.cache_dir)
+    print(f"Questions from {file_path}")
     key = input("Enter the key containing the float values: ").strip()
 
-    data = load_json(file_path)
+    data = load_questions(file_path, key)
     binary_search_interactive(data, key)
 
 
@@ -1,100 +1,238 @@
+import argparse
 from functools import partial
 from dotenv import load_dotenv
-import numpy as np
 
 import pipeline
 
-if __name__ == "__main__":
-    load_dotenv()
 
-    pipeline_stages = [
-        pipeline.add_vital_topics,
-        # partial(
-        #     pipeline.add_topics_by_pageviews,
-        #     redirects_file="data/input/wikipedia_dumps/enwiki-20240901-redirect.sql",
-        #     pageviews_files=["data/input/wikipedia_dumps/pageviews-20240206-user"],
-        #     min_view_threshold=10_000,
+def build_pipeline(
+    execution_mode: str = "batch", download_wikipedia_pages: bool = False
+) -> list[pipeline.Stage]:
+    # Binds execution_mode to the LLM stages only when it is not the default, so that the
+    # stages keep the cache keys of batch runs
+    def llm(stage, **kwargs):
+        if execution_mode != "batch":
+            kwargs["execution_mode"] = execution_mode
+        return partial(stage, **kwargs) if kwargs else stage
+
+    return [
+        pipeline.Stage("vital_topics", pipeline.add_vital_topics),
+        # pipeline.Stage(
+        #     "pageview_topics",
+        #     partial(
+        #         pipeline.add_topics_by_pageviews,
+        #         redirects_file="data/input/wikipedia_dumps/enwiki-20240901-redirect.sql",
+        #         pageviews_files=["data/input/wikipedia_dumps/pageviews-20240206-user"],
+        #         min_view_threshold=10_000,
+        #     ),
+        #     inputs=["vital_topics"],
         # ),
-        pipeline.filter_topic_by_category,
-        pipeline.filter_topic_by_clarity,
-        partial(
-            pipeline.filter_topic_by_clarity,
-            model="gpt-4o-2024-11-20",
-            logprob_threshold=-1e-5,
-        ),
-        partial(
-            pipeline.add_manual_topics,
-            manual_topics_file="data/input/topics_manual.json",
-        ),
-        pipeline.normalize_topics,
-        pipeline.download_wikipedia_pages,
-        pipeline.mine_quantities,
-        pipeline.find_excerpts,
-        pipeline.deduplicate,
-        pipeline.add_uuid,
-        pipeline.rewrite_description,
-        partial(
-            pipeline.parallelize,
-            stages=[
-                partial(
-                    pipeline.filter_clear,
-                    task=pipeline.ClarityType.NoTechnicalTerms,
-                    logprob_threshold=-np.inf,
-                ),
-                partial(
-                    pipeline.filter_clear,
-                    task=pipeline.ClarityType.MakesSenseWithoutContext,
-                    logprob_threshold=-np.inf,
-                ),
-                partial(
-                    pipeline.filter_clear,
-                    task=pipeline.ClarityType.MakesSense,
-                    logprob_threshold=-np.inf,
-                ),
-                partial(
-                    pipeline.filter_clear,
-                    task=pipeline.ClarityType.OverallClear,
-                    logprob_threshold=-np.inf,
-                ),
-                partial(
-                    pipeline.filter_clear,
-                    task=pipeline.ClarityType.TryToAnswer,
-                    logprob_threshold=-np.inf,
-                ),
-            ],
-        ),
-        partial(
-            pipeline.generic_filter,
-            filters=[
-                (lambda x: x["logprob-clarity-NoTechnicalTerms"] > -9.0),
-                (lambda x: x["logprob-clarity-MakesSense"] > -5.0),
-                (lambda x: x.get("logprob-clarity-TryToAnswer", -999.0) > -12.0),
-                (lambda x: x["logprob-clarity-OverallClear"] > -0.001),
-                (lambda x: x.get("logprob-clarity-TryToAnswer", 0.0) < -1e-10),
-            ],
-        ),
-        partial(
-            pipeline.filter_clear,
-            task=pipeline.ClarityType.OverallClearDetailed,
-            logprob_threshold=-1e-7,  # An 'acceptable' less agressive threshold could be -0.25; but while most of the questions between the two are clear, it seems the interesting ones have lower logprobs
-            model="gpt-4o-2024-11-20",
-        ),
-        partial(
-            pipeline.filter_correct,
-            logprob_threshold=-0.1,
-        ),
-        pipeline.remove_quantities_with_small_ints,
-        pipeline.remove_date_and_unit_from_descriptions,
-        partial(
-            pipeline.add_scale_metadata,
-            model="gpt-4o-2024-11-20",  # May not be necessary...
-        ),
-        partial(
-            pipeline.finalize,
-            use_handwritten_filter=True,
+        pipeline.Stage(
+            "topics_by_category",
+            llm(pipeline.filter_topic_by_category),
+            inputs=["vital_topics"],
+        ),
+        pipeline.Stage(
+            "topics_by_clarity",
+            llm(pipeline.filter_topic_by_clarity),
+            inputs=["topics_by_category"],
+        ),
+        pipeline.Stage(
+            "topics_by_clarity_gpt4o",
+            llm(
+                pipeline.filter_topic_by_clarity,
+                model="gpt-4o-2024-11-20",
+                logprob_threshold=-1e-5,
+            ),
+            inputs=["topics_by_clarity"],
+        ),
+        pipeline.Stage(
+            "all_topics",
+            partial(
+                pipeline.add_manual_topics,
+                manual_topics_file="data/input/topics_manual.json",
+            ),
+            inputs=["topics_by_clarity_gpt4o"],
+            incremental=False,
+        ),
+        pipeline.Stage(
+            "normalized_topics",
+            pipeline.normalize_topics,
+            inputs=["all_topics"],
+            incremental=False,
+        ),
+        pipeline.Stage(
+            "wikipedia_pages",
+            (
+                partial(pipeline.download_wikipedia_pages, download=True)
+                if download_wikipedia_pages
+                else pipeline.download_wikipedia_pages
+            ),
+            inputs=["normalized_topics"],
+        ),
+        pipeline.Stage(
+            "quantities",
+            llm(pipeline.mine_quantities),
+            inputs=["wikipedia_pages"],
+        ),
+        pipeline.Stage(
+            "quantities_with_excerpts",
+            pipeline.find_excerpts,
+            inputs=["quantities"],
+        ),
+        pipeline.Stage(
+            "deduplicated_quantities",
+            pipeline.deduplicate,
+            inputs=["quantities_with_excerpts"],
+            incremental=False,
+        ),
+        pipeline.Stage(
+            "questions",
+            pipeline.add_uuid,
+            inputs=["deduplicated_quantities"],
+        ),
+        pipeline.Stage(
+            "rewritten_questions",
+            llm(pipeline.rewrite_description),
+            inputs=["questions"],
+        ),
+        pipeline.Stage(
+            "clarity_scores",
+            partial(
+                pipeline.parallelize,
+                stages=[
+                    llm(
+                        pipeline.filter_clear,
+                        task=pipeline.ClarityType.NoTechnicalTerms,
+                        logprob_threshold=float("-inf"),
+                    ),
+                    llm(
+                        pipeline.filter_clear,
+                        task=pipeline.ClarityType.MakesSenseWithoutContext,
+                        logprob_threshold=float("-inf"),
+                    ),
+                    llm(
+                        pipeline.filter_clear,
+                        task=pipeline.ClarityType.MakesSense,
+                        logprob_threshold=float("-inf"),
+                    ),
+                    llm(
+                        pipeline.filter_clear,
+                        task=pipeline.ClarityType.OverallClear,
+                        logprob_threshold=float("-inf"),
+                    ),
+                    llm(
+                        pipeline.filter_clear,
+                        task=pipeline.ClarityType.TryToAnswer,
+                        logprob_threshold=float("-inf"),
+                    ),
+                ],
+            ),
+            inputs=["rewritten_questions"],
+            columns=True,
+        ),
+        pipeline.Stage(
+            "clear_questions",
+            partial(
+                pipeline.generic_filter,
+                filters=[
+                    pipeline.ColumnFilter("logprob-clarity-NoTechnicalTerms", -9.0),
+                    pipeline.ColumnFilter("logprob-clarity-MakesSense", -5.0),
+                    pipeline.ColumnFilter(
+                        "logprob-clarity-TryToAnswer", -12.0, default=-999.0
+                    ),
+                    pipeline.ColumnFilter("logprob-clarity-OverallClear", -0.001),
+                    pipeline.ColumnFilter(
+                        "logprob-clarity-TryToAnswer", -1e-10, below=True, default=0.0
+                    ),
+                ],
+            ),
+            inputs=["clarity_scores"],
+        ),
+        pipeline.Stage(
+            "clear_questions_gpt4o",
+            llm(
+                pipeline.filter_clear,
+                task=pipeline.ClarityType.OverallClearDetailed,
+                logprob_threshold=-1e-7,  # An 'acceptable' less agressive threshold could be -0.25; but while most of the questions between the two are clear, it seems the interesting ones have lower logprobs
+                model="gpt-4o-2024-11-20",
+            ),
+            inputs=["clear_questions"],
+            # Its rejected questions are read by find_threshold.py
+            columns=True,
+        ),
+        pipeline.Stage(
+            "correct_questions",
+            llm(
+                pipeline.filter_correct,
+                logprob_threshold=-0.1,
+            ),
+            inputs=["clear_questions_gpt4o"],
+        ),
+        # The two local clean-ups are independent, so they run side by side and are joined
+        pipeline.Stage(
+            "questions_without_small_ints",
+            pipeline.remove_quantities_with_small_ints,
+            inputs=["correct_questions"],
+        ),
+        pipeline.Stage(
+            "questions_without_date_and_unit",
+            pipeline.remove_date_and_unit_from_descriptions,
+            inputs=["correct_questions"],
+        ),
+        pipeline.Stage(
+            "cleaned_questions",
+            pipeline.merge_by_uuid,
+            inputs=["questions_without_small_ints", "questions_without_date_and_unit"],
+        ),
+        pipeline.Stage(
+            "questions_with_scale",
+            llm(
+                pipeline.add_scale_metadata,
+                model="gpt-4o-2024-11-20",  # May not be necessary...
+            ),
+            inputs=["cleaned_questions"],
+            columns=True,
+        ),
+        pipeline.Stage(
+            "final_questions",
+            partial(
+                pipeline.finalize,
+                use_handwritten_filter=True,
+            ),
+            inputs=["questions_with_scale"],
+            extension=".json",
         ),
     ]
 
-    last_output_file = None
-    for i, stage in enumerate(pipeline_stages):
-        last_output_file = stage(input_file=last_output_file, pipeline_step=i)
+
+if __name__ == "__main__":
+    load_dotenv()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only process the topics/questions that are new or changed since the last run",
+    )
+    parser.add_argument(
+        "--execution-mode",
+        choices=["batch", "realtime", "auto"],
+        default="batch",
+        help="How the LLM stages send their requests: through the batch API, in real time"
+        " (at twice the price), or in real time only for small inputs",
+    )
+    parser.add_argument(
+        "--download-wikipedia-pages",
+        action="store_true",
+        help="Download the pages of the topics that are not in data/wikipedia_dumps/ yet",
+    )
+    args = parser.parse_args()
+
+    pipeline.run_pipeline(
+        build_pipeline(
+            execution_mode=args.execution_mode,
+            download_wikipedia_pages=args.download_wikipedia_pages,
+        ),
+        incremental=args.incremental,
+    )
@@ -1,34 +1,44 @@
-from pipeline.stage_0_add_vital_topics import add_vital_topics
-from pipeline.stage_0_add_manual_topics import add_manual_topics
-from pipeline.stage_0_add_topics_by_pageviews import add_topics_by_pageviews
-
-from pipeline.stage_1_normalize_topics import normalize_topics
-
-from pipeline.stage_2_filter_topics_by_llm_by_category import filter_topic_by_category
-from pipeline.stage_2_filter_topics_by_llm_by_clarity import filter_topic_by_clarity
-
-from pipeline.stage_3_download_wikipedia_pages import download_wikipedia_pages
-
-from pipeline.stage_4_mine_quantities import mine_quantities
-
-from pipeline.stage_5_find_excerpts import find_excerpts
-
-from pipeline.general.add_uuid import add_uuid
-from pipeline.general.parallelize import parallelize
-
-from pipeline.stage_6_rewrite_description import rewrite_description
-from pipeline.stage_6_filter_clarity import filter_clear, ClarityType
-from pipeline.stage_6_filter_correct import filter_correct
-
-from general.generic_filter import generic_filter
-from general.deduplicate import deduplicate
-
-from pipeline.stage_7_remove_date_and_unit_from_descriptions import (
-    remove_date_and_unit_from_descriptions,
-)
-from pipeline.stage_7_remove_quantities_with_small_ints import (
-    remove_quantities_with_small_ints,
-)
-from pipeline.stage_7_add_scale_metadata import add_scale_metadata
-
-from pipeline.stage_8_finalize import finalize
+# Stages are imported lazily: a stage module (and openai, tokenizers, bs4...) is only
+# imported when the stage runs, so that cached reruns start fast and work offline
+from pipeline.general.lazy import LazyStage
+from pipeline.general.dag import Stage, run_pipeline
+from pipeline.clarity_type import ClarityType
+from pipeline.general.column_filter import ColumnFilter
+
+_STAGE_MODULES = {
+    "add_vital_topics": "pipeline.stage_0_add_vital_topics",
+    "add_manual_topics": "pipeline.stage_0_add_manual_topics",
+    "add_topics_by_pageviews": "pipeline.stage_0_add_topics_by_pageviews",
+    "normalize_topics": "pipeline.stage_1_normalize_topics",
+    "filter_topic_by_category": "pipeline.stage_2_filter_topics_by_llm_by_category",
+    "filter_topic_by_clarity": "pipeline.stage_2_filter_topics_by_llm_by_clarity",
+    "download_wikipedia_pages": "pipeline.stage_3_download_wikipedia_pages",
+    "mine_quantities": "pipeline.stage_4_mine_quantities",
+    "find_excerpts": "pipeline.stage_5_find_excerpts",
+    "add_uuid": "pipeline.general.add_uuid",
+    "parallelize": "pipeline.general.parallelize",
+    "rewrite_description": "pipeline.stage_6_rewrite_description",
+    "filter_clear": "pipeline.stage_6_filter_clarity",
+    "filter_correct": "pipeline.stage_6_filter_correct",
+    "generic_filter": "pipeline.general.generic_filter",
+    "deduplicate": "pipeline.general.deduplicate",
+    "merge_by_uuid": "pipeline.general.merge",
+    "remove_date_and_unit_from_descriptions": "pipeline.stage_7_remove_date_and_unit_from_descriptions",
+    "remove_quantities_with_small_ints": "pipeline.stage_7_remove_quantities_with_small_ints",
+    "add_scale_metadata": "pipeline.stage_7_add_scale_metadata",
+    "finalize": "pipeline.stage_8_finalize",
+}
+
+_lazy_stages = {}
+
+
+def __getattr__(name):
+    if name not in _STAGE_MODULES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    if name not in _lazy_stages:
+        _lazy_stages[name] = LazyStage(_STAGE_MODULES[name], name)
+    return _lazy_stages[name]
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_STAGE_MODULES))
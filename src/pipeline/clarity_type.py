@@ -0,0 +1,13 @@
+from enum import Enum
+
+
+# Kept apart from stage_6_filter_clarity so that main.py can refer to the tasks without
+# importing the stage and its dependencies
+class ClarityType(str, Enum):
+    NoTechnicalTerms = "NoTechnicalTerms"
+    MakesSenseWithoutContext = "MakesSenseWithoutContext"
+    LaypersonCanGuess = "LaypersonCanGuess"
+    MakesSense = "MakesSense"
+    OverallClear = "OverallClear"
+    TryToAnswer = "TryToAnswer"
+    OverallClearDetailed = "OverallClearDetailed"
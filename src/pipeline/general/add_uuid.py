@@ -15,7 +15,7 @@ from openai.types.chat import ChatCompletionMessage
 from openai.lib._parsing import type_to_response_format_param, maybe_parse_content
 from utils.openai import OpenAIBatchHandler
 from utils.json import complete_truncated_json
-from utils.input_output import output_and_log_files
+from utils.input_output import output_and_log_files, read_records, write_records
 import json
 
 
@@ -34,15 +34,11 @@ def add_uuid(
         print(f"Output file {output_file} already exists.")
         return output_file
 
-    # Load input questions and prompts
-    with open(input_file, "r", encoding="utf-8") as f:
-        questions = json.load(f)
+    def questions_with_uuids():
+        for question in read_records(input_file):
+            question["uuid"] = uuid.uuid4().hex
+            yield question
 
-    for question in questions:
-        question["uuid"] = uuid.uuid4().hex
-
-    # Write the modified questions with found excerpts
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(questions, f, ensure_ascii=False, indent=1)
+    write_records(output_file, questions_with_uuids())
 
     return output_file
@@ -0,0 +1,46 @@
+from dataclasses import dataclass
+
+GeneralizedKey = str | list[str] | list[tuple[str, float]]
+KeyWithThreshold = tuple[GeneralizedKey, float]
+
+
+@dataclass(frozen=True)
+class ColumnFilter:
+    """
+    Keeps the records whose linear combination of some keys is above a threshold (or
+    below it, if below), evaluated over whole columns at once (see generic_filter).
+    - keys: a key, a list of keys (summed up) or a list of tuples of keys and weights
+    - default: value of the keys that are missing or None. If None, such records are
+      rejected
+    """
+
+    keys: GeneralizedKey
+    threshold: float
+    below: bool = False
+    default: float | None = None
+
+    def weighted_keys(self) -> list[tuple[str, float]]:
+        if isinstance(self.keys, str):
+            return [(self.keys, 1.0)]
+        return [key if isinstance(key, tuple) else (key, 1.0) for key in self.keys]
+
+    def evaluate(self, columns):
+        """Mask of the records of columns (a utils.columns.Columns) that are kept."""
+
+        # Imported here so that building the pipeline does not import numpy
+        import numpy as np
+
+        combination = np.zeros(columns.num_rows)
+        for key, weight in self.weighted_keys():
+            if columns.kinds[key] == "json":
+                raise ValueError(
+                    f"{self!r}: the values of {key!r} are not all numbers, booleans or None"
+                )
+            values = np.asarray(columns.values[key], dtype=np.float64)
+            if self.default is not None:
+                values = np.where(np.isnan(values), self.default, values)
+            combination += weight * values
+        # NaN (a missing value without default) compares as False, so it is rejected
+        if self.below:
+            return combination < self.threshold
+        return combination > self.threshold
@@ -0,0 +1,256 @@
+import os
+import json
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils.cache import stage_cache_key
+from utils.input_output import atomic_open, sibling_file
+from utils.telemetry import (
+    StageMonitor,
+    add_telemetry_to_metadata,
+    critical_path,
+    process_cpu_time,
+    read_metadata,
+    stage_telemetry,
+)
+from pipeline.general.incremental import run_incrementally
+
+
+@dataclass
+class Stage:
+    """
+    A node of the pipeline DAG.
+    - name: unique name other stages use to refer to this stage's output
+    - function: the stage itself, called as function(input_file=..., output_file=..., pipeline_step=...)
+    - inputs: names of the stages whose outputs this stage consumes. With a single input,
+      input_file is a path; with several, it is the list of paths in the same order.
+    - extension: format of the output, .jsonl (streamed line by line between stages) or
+      .json (a single array, e.g. for files consumed outside of the pipeline)
+    - incremental: whether each output record only depends on the input records with the
+      same uuid/topic, so that incremental runs can process only new or changed records
+    - columns: whether to also write a columnar copy of the output and of its .unfiltered
+      records if any (see utils.columns), for the filters and tools that only read a few
+      fields of every record
+    """
+
+    name: str
+    function: Callable
+    inputs: list[str] = field(default_factory=list)
+    extension: str = ".jsonl"
+    incremental: bool = True
+    columns: bool = False
+
+
+def _write_columns(output_file: str):
+    # Imported here so that numpy is only loaded when a stage asks for columns
+    from utils.columns import has_columns, write_columns
+
+    for path in [output_file, sibling_file(output_file, "unfiltered")]:
+        if os.path.exists(path) and not has_columns(path):
+            write_columns(path)
+
+
+def _check_dag(stages: list[Stage]):
+    names = [stage.name for stage in stages]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Duplicate stage names: {sorted(duplicates)}")
+
+    for stage in stages:
+        for input_name in stage.inputs:
+            if input_name not in names:
+                raise ValueError(
+                    f"Stage {stage.name} depends on unknown stage {input_name}"
+                )
+
+    # Kahn's algorithm, only to detect cycles before anything runs
+    remaining = {stage.name: set(stage.inputs) for stage in stages}
+    while remaining:
+        ready = [name for name, inputs in remaining.items() if not inputs]
+        if not ready:
+            raise ValueError(f"Cycle between stages: {sorted(remaining)}")
+        for name in ready:
+            del remaining[name]
+        for inputs in remaining.values():
+            inputs.difference_update(ready)
+
+
+def _run_stage(
+    stage: Stage,
+    pipeline_step: int,
+    input_files: list[str],
+    cache_dir: str,
+    incremental: bool,
+) -> tuple[str, dict]:
+    cache_key = stage_cache_key(stage.function, input_files)
+    output_file = os.path.join(
+        cache_dir, f"{stage.name}.{cache_key[:16]}{stage.extension}"
+    )
+    if os.path.exists(output_file):
+        print(f"[{stage.name}] Cached: {output_file}")
+        if stage.columns:
+            _write_columns(output_file)
+        # Keep the telemetry of the run that produced it, but it costs nothing this time
+        return output_file, {"output_file": output_file, "cached": True} | read_metadata(
+            output_file
+        )
+
+    # Points to the last run of this stage with the same parameters, for incremental runs
+    parameters_key = stage_cache_key(stage.function, [])
+    last_run_file = os.path.join(
+        cache_dir, f"{stage.name}.{parameters_key[:16]}.last_run.json"
+    )
+    last_run = None
+    if os.path.exists(last_run_file):
+        with open(last_run_file, "r", encoding="utf-8") as f:
+            last_run = json.load(f)
+
+    if len(input_files) == 0:
+        input_file = None
+    elif len(input_files) == 1:
+        input_file = input_files[0]
+    else:
+        input_file = input_files
+
+    print(f"[{stage.name}] Starting")
+    with StageMonitor() as monitor:
+        if (
+            incremental
+            and stage.incremental
+            and len(input_files) == 1
+            and last_run is not None
+            and all(os.path.exists(path) for path in last_run.values())
+        ):
+            output_file = run_incrementally(
+                stage.function,
+                input_file=input_file,
+                output_file=output_file,
+                pipeline_step=pipeline_step,
+                previous_input_file=last_run["input_file"],
+                previous_output_file=last_run["output_file"],
+            )
+        else:
+            output_file = stage.function(
+                input_file=input_file, output_file=output_file, pipeline_step=pipeline_step
+            )
+        if output_file is not None and stage.columns:
+            _write_columns(output_file)
+    print(f"[{stage.name}] Done in {monitor.wall_time:.1f}s")
+
+    if output_file is None:
+        raise RuntimeError(f"Stage {stage.name} did not return its output file")
+
+    metadata = add_telemetry_to_metadata(
+        output_file, stage_telemetry(input_files, output_file, monitor)
+    )
+
+    if len(input_files) == 1:
+        with atomic_open(last_run_file, "w", encoding="utf-8") as f:
+            json.dump({"input_file": input_file, "output_file": output_file}, f)
+
+    return output_file, {"output_file": output_file, "cached": False} | metadata
+
+
+def _write_run_report(
+    report_file: str,
+    stage_inputs: dict[str, list[str]],
+    stage_reports: dict[str, dict],
+    wall_time: float,
+    cpu_time: float,
+):
+    executed_reports = {
+        name: report for name, report in stage_reports.items() if not report["cached"]
+    }
+    wall_times = {
+        name: report.get("telemetry", {}).get("wall_time", 0.0)
+        for name, report in executed_reports.items()
+    }
+    path, path_time = critical_path(
+        {name: stage_inputs[name] for name in stage_reports}, wall_times
+    )
+    run_report = {
+        "stages": stage_reports,
+        # Stages run concurrently, so the run takes less than the sum of their times
+        "total_wall_time": wall_time,
+        "total_cpu_time": cpu_time,
+        "sum_of_stage_wall_times": sum(wall_times.values()),
+        "sum_of_stage_cpu_times": sum(
+            report.get("telemetry", {}).get("cpu_time", 0.0)
+            for report in executed_reports.values()
+        ),
+        "total_cost": sum(
+            report.get("input_cost", 0.0) + report.get("output_cost", 0.0)
+            for report in executed_reports.values()
+        ),
+        "critical_path": path,
+        "critical_path_wall_time": path_time,
+    }
+    with atomic_open(report_file, "w", encoding="utf-8") as f:
+        json.dump(run_report, f, ensure_ascii=False, indent=4)
+
+
+def run_pipeline(
+    stages: list[Stage],
+    max_workers: int = 4,
+    cache_dir: str = "data/pipeline",
+    incremental: bool = False,
+) -> dict[str, str]:
+    """
+    Runs the stages as soon as all their inputs are available, with up to max_workers
+    stages running at the same time. The pipeline step of each stage (used for the
+    default log file names) is its position in the list.
+    Outputs are stored in cache_dir under a key of the stage, its parameters and the
+    contents of its inputs, so a stage only reruns when one of those changes.
+    If incremental, stages whose inputs changed since their last run with the same
+    parameters only process the new or changed records (see Stage.incremental).
+    The telemetry of every stage is added to its .metadata.json file and aggregated in
+    cache_dir/run_report.json, which is rewritten as stages finish.
+    Returns the output file of every stage, by name.
+    """
+
+    _check_dag(stages)
+    pipeline_steps = {stage.name: i for i, stage in enumerate(stages)}
+    stage_inputs = {stage.name: stage.inputs for stage in stages}
+    report_file = os.path.join(cache_dir, "run_report.json")
+    start = time.perf_counter()
+    start_cpu = process_cpu_time()
+
+    output_files = {}
+    # In order of completion, which is a valid order of the DAG
+    stage_reports = {}
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stage in [s for s in pending if all(i in output_files for i in s.inputs)]:
+                pending.remove(stage)
+                future = executor.submit(
+                    _run_stage,
+                    stage,
+                    pipeline_steps[stage.name],
+                    [output_files[input_name] for input_name in stage.inputs],
+                    cache_dir,
+                    incremental,
+                )
+                running[future] = stage
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    output_files[stage.name], stage_reports[stage.name] = future.result()
+                except Exception:
+                    for other_future in running:
+                        other_future.cancel()
+                    raise
+                _write_run_report(
+                    report_file,
+                    stage_inputs,
+                    stage_reports,
+                    time.perf_counter() - start,
+                    process_cpu_time() - start_cpu,
+                )
+
+    return output_files
@@ -14,7 +14,13 @@ from openai.types.chat import ChatCompletionMessage
 from openai.lib._parsing import type_to_response_format_param, maybe_parse_content
 from utils.openai import OpenAIBatchHandler
 from utils.json import complete_truncated_json
-from utils.input_output import output_and_log_files
+from utils.input_output import (
+    output_and_log_files,
+    atomic_open,
+    read_records,
+    write_records_last,
+    sibling_file,
+)
 import json
 
 
@@ -33,47 +39,44 @@ def deduplicate(
         print(f"Output file {output_file} already exists.")
         return output_file
 
-    # Load input questions and prompts
-    with open(input_file, "r", encoding="utf-8") as f:
-        questions = json.load(f)
-
     seen_hashes = set()
-    filtered_questions = []
+    entries_before = 0
 
-    for question in questions:
-        hashes = set(
-            [question["description"]]
-            + (
-                [question["rewritten-description"]["prompt"]]
-                if "rewritten-description" in question
-                else []
+    def deduplicated_questions():
+        nonlocal entries_before
+        for question in read_records(input_file):
+            entries_before += 1
+            hashes = set(
+                [question["description"]]
+                + (
+                    [question["rewritten-description"]["prompt"]]
+                    if "rewritten-description" in question
+                    else []
+                )
             )
-        )
-
-        if any(h in seen_hashes for h in hashes):
-            continue
 
-        seen_hashes.update(hashes)
-        filtered_questions.append(question)
+            if any(h in seen_hashes for h in hashes):
+                continue
 
-    print("Number of original entries:", len(questions))
-    print("Number of filtered entries:", len(filtered_questions))
+            seen_hashes.update(hashes)
+            yield question
 
-    # Write the modified questions with found excerpts
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(filtered_questions, f, ensure_ascii=False, indent=1)
+    # Write the deduplicated questions as they are found, but after the metadata
+    with write_records_last(output_file, deduplicated_questions()) as entries_after:
+        print("Number of original entries:", entries_before)
+        print("Number of filtered entries:", entries_after)
 
-    with open(
-        output_file.replace(".json", ".metadata.json"), "w", encoding="utf-8"
-    ) as f:
-        json.dump(
-            {
-                "entries_before": len(questions),
-                "entries_after": len(filtered_questions),
-            },
-            f,
-            ensure_ascii=False,
-            indent=4,
-        )
+        with atomic_open(
+            sibling_file(output_file, "metadata", ".json"), "w", encoding="utf-8"
+        ) as f:
+            json.dump(
+                {
+                    "entries_before": entries_before,
+                    "entries_after": entries_after,
+                },
+                f,
+                ensure_ascii=False,
+                indent=4,
+            )
 
     return output_file
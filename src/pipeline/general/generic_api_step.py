@@ -1,8 +1,9 @@
 import sys
 import os
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
 import numpy as np
 from typing import Any
+from functools import partial
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
@@ -14,8 +15,15 @@ from dotenv import load_dotenv
 
 from openai.types.chat import ChatCompletionMessage
 from openai.lib._parsing import type_to_response_format_param, maybe_parse_content
-from utils.openai import OpenAIBatchHandler
+from utils.llm_backend import LLMBackend, backend_for_execution_mode
+from utils.response_cache import default_response_cache
 from utils.json import complete_truncated_json
+from utils.input_output import (
+    atomic_open,
+    read_records,
+    write_records,
+    sibling_file,
+)
 import json
 
 # TODO: Include prompt examples
@@ -32,16 +40,20 @@ class Usage:
     output_tokens: int
     input_cost: float
     output_cost: float
-
-    def from_openai_outputs(outputs: dict) -> str:
-        input_tokens = sum(
-            [output["usage"]["prompt_tokens"] for output in outputs if output]
-        )
+    # Queue and processing times of the OpenAI batches
+    batches: list[dict] = field(default_factory=list)
+
+    def from_openai_outputs(outputs: dict, price_multiplier: float = 1.0) -> str:
+        # Responses from the response cache were paid for in an earlier run
+        paid_outputs = [
+            output for output in outputs if output and not output.get("cached")
+        ]
+        input_tokens = sum([output["usage"]["prompt_tokens"] for output in paid_outputs])
         output_tokens = sum(
-            [output["usage"]["completion_tokens"] for output in outputs if output]
+            [output["usage"]["completion_tokens"] for output in paid_outputs]
         )
 
-        model = outputs[0]["model"]
+        model = next((output["model"] for output in outputs if output), "")
         if "gpt-4o-mini" in model:
             input_cost = 0.075 * 1e-6
             output_cost = 0.300 * 1e-6
@@ -54,8 +66,8 @@ class Usage:
         usage = Usage(
             input_tokens,
             output_tokens,
-            input_tokens * input_cost,
-            output_tokens * output_cost,
+            input_tokens * input_cost * price_multiplier,
+            output_tokens * output_cost * price_multiplier,
         )
         return usage
 
@@ -68,6 +80,8 @@ def fetch_api_response_and_process_with_structured_outputs(
     log_path: str,
     completion_kwargs: Optional[dict] = None,
     response_key: Optional[str] = None,
+    execution_mode: str = "batch",
+    backend: Optional[LLMBackend] = None,
 ) -> tuple[list[dict], Usage]:
     # Form the request
     common_prompt_part = [
@@ -101,49 +115,62 @@ def fetch_api_response_and_process_with_structured_outputs(
             }
         )
 
-    # Fetch the API response
-    batch_handler = OpenAIBatchHandler(
-        api_key=os.getenv("OPENAI_API_KEY"), log_dir=log_path
-    )
-    outputs = batch_handler.upload_batches(
-        requests=requests,
-        endpoint="/v1/chat/completions",
-        batch_call_id="filter_correct",
-        max_tokens_per_batch=35_000_000,
-        max_requests_per_batch=20_000,
-    )
-    usage = Usage.from_openai_outputs(outputs)
+    # Fetch the API response, processing each batch as soon as it is downloaded
+    backend = backend or backend_for_execution_mode(execution_mode)
+    with backend.handler(
+        len(requests), log_dir=log_path, response_cache=default_response_cache()
+    ) as batch_handler:
+        outputs = batch_handler.upload_batches(
+            requests=requests,
+            endpoint="/v1/chat/completions",
+            batch_call_id="filter_correct",
+            max_tokens_per_batch=5_000_000,
+            max_requests_per_batch=20_000,
+            process_output=partial(
+                process_structured_output,
+                response_type=response_type,
+                response_key=response_key,
+            ),
+        )
+    usage = Usage.from_openai_outputs(outputs, batch_handler.price_multiplier)
+    usage.batches = list(batch_handler.batch_timings.values())
     assert len(outputs) == len(user_prompts)
 
-    # Process the response
-    true_outputs = [
-        output["choices"][0]["message"] if output else None for output in outputs
+    return_dicts = [
+        (
+            output["parsed"]
+            if output
+            else ({response_key: None} if response_key else {})
+        )
+        for output in outputs
     ]
-    return_dicts = []
-    for true_output in true_outputs:
-        if not true_output:
-            return_dicts.append({response_key: None} if response_key else {})
-            continue
-        try:
-            fixed_content = json.dumps(
-                complete_truncated_json(true_output["content"]), indent=4
-            )
-            true_output["content"] = fixed_content
-            parsed = maybe_parse_content(
-                response_format=response_type,
-                message=ChatCompletionMessage(**true_output),
-            ).model_dump()
-
-            return_dicts.append({response_key: parsed} if response_key else parsed)
-
-        except Exception as e:
-            print("Error:", e)
-            print("Output:", true_output)
-            return_dicts.append({response_key: None} if response_key else {})
-
     return return_dicts, usage
 
 
+def process_structured_output(
+    output: dict,
+    response_type: type[BaseModel],
+    response_key: Optional[str] = None,
+) -> dict:
+    true_output = output["choices"][0]["message"]
+    try:
+        fixed_content = json.dumps(
+            complete_truncated_json(true_output["content"]), indent=4
+        )
+        true_output["content"] = fixed_content
+        parsed = maybe_parse_content(
+            response_format=response_type,
+            message=ChatCompletionMessage(**true_output),
+        ).model_dump(mode="json")
+
+        return {response_key: parsed} if response_key else parsed
+
+    except Exception as e:
+        print("Error:", e)
+        print("Output:", true_output)
+        return {response_key: None} if response_key else {}
+
+
 def fetch_api_response_and_process_with_logprobs(
     system_prompt: str,
     user_prompts: list[str],
@@ -153,6 +180,8 @@ def fetch_api_response_and_process_with_logprobs(
     logprob_negative_tokens: str | list[str] | None,
     log_path: str,
     completion_kwargs: Optional[dict] = None,
+    execution_mode: str = "batch",
+    backend: Optional[LLMBackend] = None,
 ) -> tuple[list[dict], Usage]:
     if isinstance(logprob_positive_tokens, str):
         logprob_positive_tokens = [logprob_positive_tokens]
@@ -167,6 +196,7 @@ def fetch_api_response_and_process_with_logprobs(
         {"role": "system", "content": system_prompt},
     ]
     model = completion_kwargs.pop("model", "gpt-4o-mini")
+    backend = backend or backend_for_execution_mode(execution_mode)
     requests = []
     for user_prompt in user_prompts:
         requests.append(
@@ -191,75 +221,96 @@ def fetch_api_response_and_process_with_logprobs(
                 "n": 1,
                 "max_completion_tokens": 1,
                 "logprobs": True,
-                "top_logprobs": 20,
+                "top_logprobs": min(20, backend.max_top_logprobs),
             }
         )
 
-    # Fetch the API response
-    batch_handler = OpenAIBatchHandler(
-        api_key=os.getenv("OPENAI_API_KEY"), log_dir=log_path
-    )
-    outputs = batch_handler.upload_batches(
-        requests=requests,
-        endpoint="/v1/chat/completions",
-        batch_call_id="filter_correct",
-        max_tokens_per_batch=35_000_000,
-    )
-    usage = Usage.from_openai_outputs(outputs)
+    # Fetch the API response, processing each batch as soon as it is downloaded
+    with backend.handler(
+        len(requests), log_dir=log_path, response_cache=default_response_cache()
+    ) as batch_handler:
+        outputs = batch_handler.upload_batches(
+            requests=requests,
+            endpoint="/v1/chat/completions",
+            batch_call_id="filter_correct",
+            max_tokens_per_batch=5_000_000,
+            process_output=partial(
+                process_logprobs_output,
+                logprob_key=logprob_key,
+                logprob_positive_tokens=logprob_positive_tokens,
+                logprob_negative_tokens=logprob_negative_tokens,
+            ),
+        )
+    usage = Usage.from_openai_outputs(outputs, batch_handler.price_multiplier)
+    usage.batches = list(batch_handler.batch_timings.values())
     assert len(outputs) == len(user_prompts)
 
-    # Process the response
-    seqs_logprobs = [
-        output["choices"][0]["logprobs"] if output else None for output in outputs
+    return_dicts = [
+        output["parsed"] if output else {logprob_key: None} for output in outputs
     ]
-    return_dicts = []
-    for seq_logprobs in seqs_logprobs:
-        if not seq_logprobs:
-            return_dicts.append({logprob_key: None})
-            continue
-        try:
-            logprob_objects = seq_logprobs["content"][0]["top_logprobs"]
-            prob_positive = 0.0
-            prob_negative = 0.0
-            prob_positive_is_present = False
-            for logprob_object in logprob_objects:
-                if logprob_object["token"] in logprob_positive_tokens:
-                    prob_positive_is_present = True
-                    prob_positive += np.exp(logprob_object["logprob"])
-                elif logprob_object["token"] in logprob_negative_tokens:
-                    prob_negative += np.exp(logprob_object["logprob"])
-
-            if len(logprob_negative_tokens) > 0:
-                probs = np.array([prob_positive, prob_negative])
-                if np.sum(probs) == 0:
-                    probs = (
-                        np.array([1.0, 0.0])
-                        if prob_positive_is_present
-                        else np.array([0.0, 1.0])
-                    )
-                probs /= np.sum(probs)
-                prob_positive = probs[0]
-
-            if len(logprob_positive_tokens) == 0:
-                prob_positive = 1.0 - prob_negative
-
-            logprob_correct = np.log(prob_positive).item()
-
-            return_dicts.append({logprob_key: logprob_correct})
-
-        except Exception as e:
-            print("Error:", e)
-            print("Output:", seq_logprobs)
-            return_dicts.append({logprob_key: None})
-
     return return_dicts, usage
 
 
+def process_logprobs_output(
+    output: dict,
+    logprob_key: str,
+    logprob_positive_tokens: list[str],
+    logprob_negative_tokens: list[str],
+) -> dict:
+    seq_logprobs = output["choices"][0]["logprobs"]
+    if not seq_logprobs:
+        return {logprob_key: None}
+    try:
+        logprob_objects = seq_logprobs["content"][0]["top_logprobs"]
+        prob_positive = 0.0
+        prob_negative = 0.0
+        prob_positive_is_present = False
+        for logprob_object in logprob_objects:
+            if logprob_object["token"] in logprob_positive_tokens:
+                prob_positive_is_present = True
+                prob_positive += np.exp(logprob_object["logprob"])
+            elif logprob_object["token"] in logprob_negative_tokens:
+                prob_negative += np.exp(logprob_object["logprob"])
+
+        if len(logprob_negative_tokens) > 0:
+            probs = np.array([prob_positive, prob_negative])
+            if np.sum(probs) == 0:
+                probs = (
+                    np.array([1.0, 0.0])
+                    if prob_positive_is_present
+                    else np.array([0.0, 1.0])
+                )
+            probs /= np.sum(probs)
+            prob_positive = probs[0]
+
+        if len(logprob_positive_tokens) == 0:
+            prob_positive = 1.0 - prob_negative
+
+        logprob_correct = np.log(prob_positive).item()
+
+        return {logprob_key: logprob_correct}
+
+    except Exception as e:
+        print("Error:", e)
+        print("Output:", seq_logprobs)
+        return {logprob_key: None}
+
+
 # =============================
 # Main Functions
 # =============================
 
 
+def uses_batch_api(stage: callable) -> callable:
+    """
+    Marks a stage whose requests go through the OpenAI batch API, so that parallelize can
+    send the requests of such stages together.
+    """
+
+    stage.uses_batch_api = True
+    return stage
+
+
 def generic_api_processing_step(
     input_path: str,
     output_path: str,
@@ -270,10 +321,18 @@ def generic_api_processing_step(
     fetch_api_response_and_process: callable,
     filter_questions: callable,
     sort_by_key: str | None = None,
+    execution_mode: str = "batch",
+    backend: LLMBackend | None = None,
 ):
+    """
+    execution_mode is "batch" (OpenAI batch API, the default), "realtime" (concurrent
+    requests, at twice the price) or "auto" (real time for small inputs, see
+    utils.llm_backend). backend, if given, answers the requests instead, e.g. a
+    LocalServerBackend to run on a local model.
+    """
+
     # Load input questions and prompts
-    with open(input_path, "r", encoding="utf-8") as f:
-        questions = json.load(f)
+    questions = list(read_records(input_path))
 
     # Form the prompts
     user_prompts = [format_question_into_prompt(question) for question in questions]
@@ -281,6 +340,8 @@ def generic_api_processing_step(
         system_prompt=instruction,
         user_prompts=user_prompts,
         log_path=log_path,
+        execution_mode=execution_mode,
+        backend=backend,
         inprompt_examples=[
             (format_question_into_prompt(example["input"]), example["output"])
             for example in examples
@@ -306,17 +367,10 @@ def generic_api_processing_step(
     print("Total output tokens:", usage.output_tokens)
     print(f"Cost: ${usage.input_cost+usage.output_cost:.4f}")
 
-    # Write the modified questions with found excerpts
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(filtered_questions, f, ensure_ascii=False, indent=1)
-
-    with open(
-        output_path.replace(".json", ".unfiltered.json"), "w", encoding="utf-8"
-    ) as f:
-        json.dump(new_questions, f, ensure_ascii=False, indent=1)
+    write_records(sibling_file(output_path, "unfiltered"), new_questions)
 
-    with open(
-        output_path.replace(".json", ".metadata.json"), "w", encoding="utf-8"
+    with atomic_open(
+        sibling_file(output_path, "metadata", ".json"), "w", encoding="utf-8"
     ) as f:
         json.dump(
             asdict(usage)
@@ -328,3 +382,6 @@ def generic_api_processing_step(
             ensure_ascii=False,
             indent=4,
         )
+
+    # Write the modified questions with found excerpts
+    write_records(output_path, filtered_questions)
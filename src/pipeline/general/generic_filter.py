@@ -14,13 +14,30 @@ from openai.types.chat import ChatCompletionMessage
 from openai.lib._parsing import type_to_response_format_param, maybe_parse_content
 from utils.openai import OpenAIBatchHandler
 from utils.json import complete_truncated_json
-from utils.input_output import output_and_log_files
+from utils.input_output import (
+    output_and_log_files,
+    atomic_open,
+    read_records,
+    write_records_last,
+    sibling_file,
+)
+from utils.columns import read_columns
+from pipeline.general.column_filter import ColumnFilter, KeyWithThreshold
 import json
+import itertools
+from contextlib import ExitStack
+
+
+def _as_column_filter(filter_):
+    # (keys, threshold) tuples are shorthands for ColumnFilter(keys, threshold)
+    if isinstance(filter_, tuple):
+        return ColumnFilter(*filter_)
+    return filter_
 
 
 def generic_filter(
     input_file: str,
-    filters: list[Callable[[dict], bool]],
+    filters: list[ColumnFilter | KeyWithThreshold | Callable[[dict], bool]],
     output_file: str | None = None,
     log_file: str | None = None,
     pipeline_step: int = 0,
@@ -31,6 +48,11 @@ def generic_filter(
     - a tuple of a key and a threshold
     - a tuple of a list of keys and a threshold (the keys are summed up)
     - a tuple of a list of tuples of keys and weights and a threshold (the keys are linearly combined)
+    - a ColumnFilter, for the above with a missing-value default or an upper threshold
+    - a function of the question, for anything else (evaluated question by question)
+    Column filters are applied before functions. The number of questions each filter
+    rejects is stored in the metadata under its position and description, where a
+    question only counts as rejected by the first filter that rejects it.
     """
 
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
@@ -38,34 +60,105 @@ def generic_filter(
         print(f"Output file {output_file} already exists.")
         return output_file
 
-    # Load input questions and prompts
-    with open(input_file, "r", encoding="utf-8") as f:
-        questions = json.load(f)
-
-    filtered_questions = [
-        question
-        for question in questions
-        if all(filter_(question) for filter_ in filters)
+    # Each filter is referred to by its position and description, so that identical
+    # filters keep separate counts
+    filters = [_as_column_filter(filter_) for filter_ in filters]
+    names = [
+        f"{i}: {filter_!r}"
+        if isinstance(filter_, ColumnFilter)
+        else f"{i}: function {getattr(filter_, '__qualname__', repr(filter_))}"
+        for i, filter_ in enumerate(filters)
+    ]
+    column_filters = [
+        (name, f) for name, f in zip(names, filters) if isinstance(f, ColumnFilter)
+    ]
+    function_filters = [
+        (name, f) for name, f in zip(names, filters) if not isinstance(f, ColumnFilter)
     ]
 
-    print("Number of original entries:", len(questions))
-    print("Number of filtered entries:", len(filtered_questions))
-
-    # Write the modified questions with found excerpts
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(filtered_questions, f, ensure_ascii=False, indent=1)
-
-    with open(
-        output_file.replace(".json", ".metadata.json"), "w", encoding="utf-8"
-    ) as f:
-        json.dump(
-            {
-                "entries_before": len(questions),
-                "entries_after": len(filtered_questions),
-            },
-            f,
-            ensure_ascii=False,
-            indent=4,
+    # Only the keys used by the filters are loaded (from the columnar copy if any), and
+    # each filter is evaluated on all the questions at once
+    rejected = {}
+    keep = itertools.repeat(True)
+    if column_filters:
+        columns = read_columns(
+            input_file,
+            list(
+                dict.fromkeys(
+                    key
+                    for _, filter_ in column_filters
+                    for key, _ in filter_.weighted_keys()
+                )
+            ),
         )
+        keep = np.ones(columns.num_rows, dtype=bool)
+        for name, filter_ in column_filters:
+            mask = filter_.evaluate(columns)
+            # Only the questions no previous filter rejected
+            rejected[name] = int(np.sum(keep & ~mask))
+            keep &= mask
+
+    # Functions are evaluated question by question, on the questions the column filters kept
+    rejected_by_function = [0] * len(function_filters)
+    entries_before = 0
+
+    # The output is only committed once the metadata is written (see write_records_last)
+    with ExitStack() as output:
+        if (
+            not function_filters
+            and input_file.endswith(".jsonl")
+            and output_file.endswith(".jsonl")
+        ):
+            # The kept lines can be copied without parsing them
+            entries_after = 0
+            output_f = output.enter_context(
+                atomic_open(output_file, "w", encoding="utf-8")
+            )
+            with open(input_file, "r", encoding="utf-8") as input_f:
+                for line, is_kept in zip((l for l in input_f if l.strip()), keep):
+                    entries_before += 1
+                    if is_kept:
+                        output_f.write(line if line.endswith("\n") else line + "\n")
+                        entries_after += 1
+        else:
+
+            def filtered_questions():
+                nonlocal entries_before
+                for question, is_kept in zip(read_records(input_file), keep):
+                    entries_before += 1
+                    if not is_kept:
+                        continue
+                    for i, (_, filter_) in enumerate(function_filters):
+                        if not filter_(question):
+                            rejected_by_function[i] += 1
+                            break
+                    else:
+                        yield question
+
+            entries_after = output.enter_context(
+                write_records_last(output_file, filtered_questions())
+            )
+
+        for (name, _), count in zip(function_filters, rejected_by_function):
+            rejected[name] = count
+
+        print("Number of original entries:", entries_before)
+        print("Number of filtered entries:", entries_after)
+        for filter_, count in rejected.items():
+            print(f"Rejected by {filter_}: {count}")
+
+        with atomic_open(
+            sibling_file(output_file, "metadata", ".json"), "w", encoding="utf-8"
+        ) as f:
+            json.dump(
+                {
+                    "entries_before": entries_before,
+                    "entries_after": entries_after,
+                    "rejected_by_filter": rejected,
+                },
+                f,
+                ensure_ascii=False,
+                indent=4,
+            )
 
     return output_file
@@ -0,0 +1,147 @@
+import os
+import glob
+import json
+import hashlib
+from typing import Callable
+from collections import defaultdict
+
+from utils.input_output import atomic_open, read_records, write_records, sibling_file
+
+
+def _key_field(input_file: str) -> str:
+    for record in read_records(input_file):
+        return "uuid" if isinstance(record, dict) and "uuid" in record else "topic"
+    return "topic"
+
+
+def record_key(record, key_field: str) -> str:
+    """Upstream key of a record: its uuid once questions have one, its topic before."""
+
+    if key_field == "uuid":
+        return record["uuid"]
+    if isinstance(record, dict):
+        return record["topic"] if "topic" in record else record["_"]
+    return record
+
+
+def _hash_records_by_key(path: str, key_field: str) -> dict[str, str]:
+    hashers = defaultdict(hashlib.sha256)
+    for record in read_records(path):
+        hashers[record_key(record, key_field)].update(
+            json.dumps(record, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        )
+    return {key: hasher.hexdigest() for key, hasher in hashers.items()}
+
+
+def _merge(
+    previous_file: str,
+    delta_file: str | None,
+    output_file: str,
+    key_field: str,
+    stale_keys: set[str],
+) -> int:
+    def merged_records():
+        for record in read_records(previous_file):
+            if record_key(record, key_field) not in stale_keys:
+                yield record
+        if delta_file is not None:
+            yield from read_records(delta_file)
+
+    return write_records(output_file, merged_records())
+
+
+def _remove_with_side_files(path: str):
+    root, _ = os.path.splitext(path)
+    for file in {path} | set(glob.glob(glob.escape(root) + ".*")):
+        if os.path.isfile(file):
+            os.remove(file)
+
+
+def run_incrementally(
+    function: Callable,
+    input_file: str,
+    output_file: str,
+    pipeline_step: int,
+    previous_input_file: str,
+    previous_output_file: str,
+) -> str:
+    """
+    Runs a record-wise stage only on the input records whose key (uuid or topic) is new or
+    whose contents changed since the previous run, and merges the results into the output
+    of the previous run. Records whose key disappeared from the input are dropped. The
+    metadata of the output (usage, costs, counts) is that of the run on the delta.
+    """
+
+    key_field = _key_field(input_file)
+    previous_hashes = _hash_records_by_key(previous_input_file, key_field)
+    current_hashes = _hash_records_by_key(input_file, key_field)
+
+    changed_keys = {
+        key for key, hash_ in current_hashes.items() if previous_hashes.get(key) != hash_
+    }
+    removed_keys = previous_hashes.keys() - current_hashes.keys()
+    print(
+        f"Incremental run: {len(changed_keys)} new or changed, {len(removed_keys)} removed,"
+        f" {len(current_hashes) - len(changed_keys)} reused"
+    )
+
+    delta_input_file = None
+    delta_output_file = None
+    if changed_keys:
+        delta_input_file = sibling_file(output_file, "delta-input")
+        write_records(
+            delta_input_file,
+            (
+                record
+                for record in read_records(input_file)
+                if record_key(record, key_field) in changed_keys
+            ),
+        )
+        delta_output_file = function(
+            input_file=delta_input_file,
+            output_file=sibling_file(output_file, "delta"),
+            pipeline_step=pipeline_step,
+        )
+
+    stale_keys = changed_keys | removed_keys
+
+    # Keep the side files that hold records (e.g. .unfiltered) consistent with the output
+    previous_unfiltered_file = sibling_file(previous_output_file, "unfiltered")
+    if os.path.exists(previous_unfiltered_file) and (
+        delta_output_file is None
+        or os.path.exists(sibling_file(delta_output_file, "unfiltered"))
+    ):
+        _merge(
+            previous_unfiltered_file,
+            delta_output_file and sibling_file(delta_output_file, "unfiltered"),
+            sibling_file(output_file, "unfiltered"),
+            key_field,
+            stale_keys,
+        )
+
+    # The usage and costs of this run are those of the delta
+    delta_metadata_file = delta_output_file and sibling_file(
+        delta_output_file, "metadata", ".json"
+    )
+    metadata = {}
+    if delta_metadata_file is not None and os.path.exists(delta_metadata_file):
+        with open(delta_metadata_file, "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+    metadata["incremental"] = {
+        "changed": len(changed_keys),
+        "removed": len(removed_keys),
+        "reused": len(current_hashes) - len(changed_keys),
+    }
+    with atomic_open(
+        sibling_file(output_file, "metadata", ".json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=4)
+
+    # The main output is written last, so that it only exists once it is complete
+    _merge(previous_output_file, delta_output_file, output_file, key_field, stale_keys)
+
+    for delta_file in [delta_input_file, delta_output_file]:
+        if delta_file is not None:
+            _remove_with_side_files(delta_file)
+
+    return output_file
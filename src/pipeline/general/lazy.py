@@ -0,0 +1,40 @@
+import importlib
+import importlib.util
+
+from utils.cache import source_hash
+
+
+class LazyStage:
+    """
+    Stand-in for a stage function that only imports the module of the stage (and its
+    dependencies: openai, tokenizers...) when the stage is called, so that building the
+    pipeline and skipping cached stages stays fast and works offline.
+    """
+
+    def __init__(self, module: str, name: str):
+        self.module = module
+        self.name = name
+        self._function = None
+
+    def load(self):
+        if self._function is None:
+            self._function = getattr(importlib.import_module(self.module), self.name)
+        return self._function
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+    def __getattr__(self, attribute):
+        # Attributes of the function itself, e.g. uses_batch_api
+        if attribute.startswith("_"):
+            raise AttributeError(attribute)
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return f"LazyStage({self.module}.{self.name})"
+
+    def cache_fingerprint(self) -> str:
+        """Same fingerprint as the function itself (see utils.cache), without importing it."""
+
+        source_file = importlib.util.find_spec(self.module).origin
+        return f"{self.module}.{self.name}@{source_hash(source_file)}"
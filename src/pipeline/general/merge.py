@@ -0,0 +1,48 @@
+import os
+import json
+from collections import defaultdict
+
+from utils.input_output import output_and_log_files, read_records, write_records
+
+
+def merge_by_uuid(
+    input_file: list[str],
+    output_file: str | None = None,
+    log_file: str | None = None,
+    pipeline_step: int = 0,
+    keep_only_common: bool = True,
+) -> str:
+    """
+    Joins the outputs of several branches that started from the same questions.
+    Fields of later inputs override those of earlier ones. If keep_only_common, only
+    questions present in every input are kept (i.e. the branches act as filters),
+    otherwise questions present in any input are kept.
+    The order is the one of the first input.
+    """
+
+    output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
+    if os.path.exists(output_file):
+        print(f"Output file {output_file} already exists.")
+        return output_file
+
+    uuid_to_questions = defaultdict(dict)
+    uuid_to_count = defaultdict(int)
+    ordered_uuids = []
+    for file in input_file:
+        for question in read_records(file):
+            if question["uuid"] not in uuid_to_questions:
+                ordered_uuids.append(question["uuid"])
+            uuid_to_questions[question["uuid"]] |= question
+            uuid_to_count[question["uuid"]] += 1
+
+    merged_questions = [
+        uuid_to_questions[uuid]
+        for uuid in ordered_uuids
+        if not keep_only_common or uuid_to_count[uuid] == len(input_file)
+    ]
+
+    print("Number of merged entries:", len(merged_questions))
+
+    write_records(output_file, merged_questions)
+
+    return output_file
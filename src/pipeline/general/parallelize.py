@@ -14,9 +14,16 @@ from dotenv import load_dotenv
 
 from openai.types.chat import ChatCompletionMessage
 from openai.lib._parsing import type_to_response_format_param, maybe_parse_content
-from utils.openai import OpenAIBatchHandler
+from functools import partial
+from contextlib import nullcontext
+from utils.openai import OpenAIBatchHandler, SharedBatchSubmission
 from utils.json import complete_truncated_json
-from utils.input_output import output_and_log_files
+from utils.input_output import (
+    output_and_log_files,
+    read_records,
+    write_records,
+    sibling_file,
+)
 import json
 
 
@@ -24,6 +31,12 @@ GeneralizedKey = str | list[str] | list[tuple[str, float]]
 KeyWithThreshold = tuple[GeneralizedKey, float]
 
 
+def _uses_batch_api(stage: Callable) -> bool:
+    while isinstance(stage, partial):
+        stage = stage.func
+    return getattr(stage, "uses_batch_api", False)
+
+
 def parallelize(
     input_file: str,
     output_file: str | None = None,
@@ -36,19 +49,36 @@ def parallelize(
         print(f"Output file {output_file} already exists.")
         return output_file
 
-    with open(input_file, "r", encoding="utf-8") as f:
-        questions = json.load(f)
-        assert all("uuid" in question for question in questions)
+    assert all("uuid" in question for question in read_records(input_file))
+
+    # If all the branches go through the batch API, their requests are uploaded and
+    # polled together instead of each branch handling its own batches
+    shared_submission = (
+        SharedBatchSubmission(len(stages), log_dir=log_file, batch_call_id="parallelize")
+        if all(_uses_batch_api(stage) for stage in stages)
+        else None
+    )
+
+    def run_stage(i, stage, **kwargs):
+        with (
+            shared_submission.participant(i)
+            if shared_submission is not None
+            else nullcontext()
+        ):
+            return stage(**kwargs)
 
     async def run_things_in_parallel():
         tasks = []
         for i, stage in enumerate(stages):
-            output_file_, log_file_ = output_and_log_files(
+            _, log_file_ = output_and_log_files(
                 None, None, pipeline_step, prefix=f".{i:02}"
             )
+            output_file_ = sibling_file(output_file, f"{i:02}")
 
             tasks.append(
                 asyncio.to_thread(
+                    run_stage,
+                    i,
                     stage,
                     input_file=input_file,
                     output_file=output_file_,
@@ -61,12 +91,11 @@ def parallelize(
 
         uuid_to_questions = defaultdict(dict)
         for file in task_output_files:
-            with open(file, "r", encoding="utf-8") as f:
-                questions = json.load(f)
-                for question in questions:
-                    uuid_to_questions[question["uuid"]] |= question
+            for question in read_records(file):
+                uuid_to_questions[question["uuid"]] |= question
 
-        with open(output_file, "w", encoding="utf-8") as f:
-            json.dump(list(uuid_to_questions.values()), f, ensure_ascii=False, indent=1)
+        write_records(output_file, uuid_to_questions.values())
 
     asyncio.run(run_things_in_parallel())
+
+    return output_file
@@ -0,0 +1,66 @@
+import os
+import multiprocessing
+from typing import Callable, Iterable
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from tqdm import tqdm
+
+
+class _InProcessExecutor(Executor):
+    """Runs the submitted functions right away, for num_processes=1 (e.g. to debug)."""
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+def process_pool(num_processes: int | None = None) -> Executor:
+    """
+    Pool of worker processes for the CPU-bound parts of local stages, with one process per
+    core by default. Workers are spawned rather than forked, since stages run in threads.
+    The functions submitted to it must be defined at the top level of a module.
+    """
+
+    num_processes = num_processes or os.cpu_count() or 1
+    if num_processes == 1:
+        return _InProcessExecutor()
+    return ProcessPoolExecutor(
+        max_workers=num_processes, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def group_by_topic(records: Iterable[dict]) -> dict[str, list[tuple[int, dict]]]:
+    """Shards records by topic, keeping their position in the input."""
+
+    shards = {}
+    for i, record in enumerate(records):
+        shards.setdefault(record["topic"], []).append((i, record))
+    return shards
+
+
+def map_by_topic(
+    function: Callable[[str, list[dict]], list[dict]],
+    records: list[dict],
+    num_processes: int | None = None,
+) -> list[dict]:
+    """
+    Applies function(topic, records_of_topic) -> processed records to the records of each
+    topic in a pool of processes, and returns the processed records in the input order,
+    whatever the number of processes.
+    """
+
+    shards = group_by_topic(records)
+    topics = list(shards)
+    processed_records = [None] * len(records)
+    with process_pool(num_processes) as executor:
+        futures = [
+            executor.submit(function, topic, [record for _, record in shards[topic]])
+            for topic in topics
+        ]
+        for topic, future in tqdm(zip(topics, futures), total=len(topics)):
+            for (i, _), record in zip(shards[topic], future.result()):
+                processed_records[i] = record
+    return processed_records
@@ -4,7 +4,7 @@ import requests
 from collections import defaultdict
 import string
 
-from utils.input_output import output_and_log_files
+from utils.input_output import output_and_log_files, read_records, write_records
 
 
 def add_manual_topics(
@@ -20,15 +20,12 @@ def add_manual_topics(
         return output_file
 
     if input_file is not None and os.path.exists(input_file):
-        with open(input_file, "r") as f:
-            articles = json.load(f)
+        articles = list(read_records(input_file))
 
     if os.path.exists(manual_topics_file):
-        with open(manual_topics_file, "r") as f:
-            manual_topics = json.load(f)
+        manual_topics = list(read_records(manual_topics_file))
         articles.extend(manual_topics)
 
-    with open(output_file, "w") as f:
-        json.dump(articles, f, indent=4)
+    write_records(output_file, articles)
 
     return output_file
@@ -8,7 +8,7 @@ import os
 import json
 from collections import defaultdict
 
-from utils.input_output import output_and_log_files
+from utils.input_output import output_and_log_files, read_records, write_records
 
 
 def parse_redirects(file_path):
@@ -53,8 +53,7 @@ def add_topics_by_pageviews(
         return output_file
 
     if input_file is not None and os.path.exists(input_file):
-        with open(input_file, "r") as f:
-            articles = json.load(f)
+        articles = list(read_records(input_file))
 
     redirects_map = parse_redirects(redirects_file)
 
@@ -92,7 +91,6 @@ def add_topics_by_pageviews(
 
     articles.extend(list(pages_by_views.keys()))
 
-    with open(output_file, "w") as f:
-        json.dump(articles, f, indent=4)
+    write_records(output_file, articles)
 
     return output_file
@@ -4,7 +4,8 @@ import requests
 from collections import defaultdict
 import string
 
-from utils.input_output import output_and_log_files
+from utils.input_output import output_and_log_files, read_records, write_records
+from utils.wikipedia import WIKIPEDIA_API_URL
 
 DISALLOWED_VITAL_TOPICS = ["People", "History", "Arts", "Philosophy and religion"]
 ALLOWED_VITAL_TOPICS = [
@@ -28,7 +29,7 @@ def fetch_json_data(letter: str) -> dict:
     Returns:
     - dict: Parsed JSON data from the response, or None if fetching fails.
     """
-    url = f"https://en.wikipedia.org/w/api.php?action=query&format=json&prop=revisions&titles=Wikipedia:Vital_articles/data/{letter}.json&rvprop=content&formatversion=2"
+    url = f"{WIKIPEDIA_API_URL}?action=query&format=json&prop=revisions&titles=Wikipedia:Vital_articles/data/{letter}.json&rvprop=content&formatversion=2"
 
     response = requests.get(url)
     if response.status_code == 200:
@@ -95,8 +96,7 @@ def add_vital_topics(
         return output_file
 
     if input_file is not None and os.path.exists(input_file):
-        with open(input_file, "r") as f:
-            articles = json.load(f)
+        articles = list(read_records(input_file))
 
     articles = []
     for letter in string.ascii_uppercase:  # A-Z
@@ -104,7 +104,6 @@ def add_vital_topics(
         if json_data:
             articles.extend(process_into_article_list(json_data))
 
-    with open(output_file, "w") as f:
-        json.dump(articles, f, indent=4)
+    write_records(output_file, articles)
 
     return output_file
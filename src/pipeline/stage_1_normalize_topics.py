@@ -3,7 +3,7 @@ import os
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
-from utils.input_output import output_and_log_files
+from utils.input_output import output_and_log_files, read_records, write_records
 from utils.wikipedia import normalize_articles, are_disambiguation
 
 import os
@@ -23,11 +23,10 @@ def normalize_topics(
         return output_file
 
     # Read topics
-    with open(input_file, "r", encoding="utf-8") as f:
-        topics = json.load(f)
+    topics = list(read_records(input_file))
 
     # Remove duplicates
-    topics = list(set(t["_"] if isinstance(t, dict) else t for t in topics))
+    topics = list(dict.fromkeys(t["_"] if isinstance(t, dict) else t for t in topics))
 
     # Chunk topics into groups of 50
     chunked_topics = [topics[i : i + 10] for i in range(0, len(topics), 10)]
@@ -76,8 +75,9 @@ def normalize_topics(
         os._exit(0)
 
     # Remove duplicates again after normalization
-    normalized_topics = list(set(normalized_topics))
+    normalized_topics = list(dict.fromkeys(normalized_topics))
 
     # Save normalized topics to output file
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(normalized_topics, f, ensure_ascii=False, indent=4)
+    write_records(output_file, normalized_topics)
+
+    return output_file
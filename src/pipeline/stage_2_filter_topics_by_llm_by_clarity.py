@@ -11,13 +11,16 @@ from dotenv import load_dotenv
 
 from functools import partial
 from utils.input_output import output_and_log_files
+from utils.llm_backend import LLMBackend
 from pipeline.general.generic_api_step import (
     generic_api_processing_step,
     fetch_api_response_and_process_with_structured_outputs,
     fetch_api_response_and_process_with_logprobs,
+    uses_batch_api,
 )
 
 
+@uses_batch_api
 def filter_topic_by_clarity(
     input_file: str,
     output_file: str | None = None,
@@ -25,6 +28,8 @@ def filter_topic_by_clarity(
     pipeline_step: int = 0,
     model="gpt-4o-mini",
     logprob_threshold: float = -0.05,
+    execution_mode: str = "batch",
+    backend: LLMBackend | None = None,
 ) -> str:
 
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
@@ -36,6 +41,8 @@ def filter_topic_by_clarity(
         input_path=input_file,
         output_path=output_file,
         log_path=log_file,
+        execution_mode=execution_mode,
+        backend=backend,
         instruction="Answer only YES if everyone would know what this is, otherwise NO.",
         format_question_into_prompt=lambda x: x["_"],
         fetch_api_response_and_process=partial(
@@ -56,3 +63,5 @@ def filter_topic_by_clarity(
         examples=[],
         sort_by_key="logprob-topic-clarity",
     )
+
+    return output_file
@@ -10,7 +10,13 @@ from tqdm import tqdm
 from dotenv import load_dotenv
 
 from functools import partial
-from utils.input_output import output_and_log_files
+from utils.input_output import (
+    output_and_log_files,
+    atomic_open,
+    read_records,
+    write_records,
+)
+from pipeline.general.process_pool import process_pool
 from pipeline.general.generic_api_step import (
     generic_api_processing_step,
     fetch_api_response_and_process_with_structured_outputs,
@@ -33,23 +39,43 @@ from tokenizers import Tokenizer
 from pathlib import Path
 import concurrent.futures
 
-# Load GPT-3 tokenizer
-tokenizer = Tokenizer.from_pretrained("gpt2")
+_tokenizer = None
+
+
+def get_tokenizer():
+    # Load GPT-3 tokenizer, once per process and only when pages are actually parsed
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer.from_pretrained("gpt2")
+    return _tokenizer
 
 # =============================
 # Main Functions
 # =============================
 
 
-def query_and_process_wiki_articles(list_of_topic_and_path):
+def query_and_process_wiki_articles(list_of_topic_and_path, executor=None):
+    """
+    Downloads the articles one after the other. If an executor is given, the articles are
+    parsed in it (e.g. in a process pool) while the next ones download, and the futures
+    of the parsing are returned.
+    """
+
     print(len(list_of_topic_and_path))
+    futures = []
     for topic_and_path in list_of_topic_and_path:
         try:
             topic, wikidump_path = topic_and_path
             response = query(topic)
-            process_wiki_article(response, topic, wikidump_path)
+            if executor is None:
+                process_wiki_article(response, topic, wikidump_path)
+            else:
+                futures.append(
+                    executor.submit(process_wiki_article, response, topic, wikidump_path)
+                )
         except Exception as e:
             print("Error:", e)
+    return futures
 
 
 def process_wiki_article(wikipedia_response_json_text, topic, wikidump_path):
@@ -98,7 +124,7 @@ def process_wiki_article(wikipedia_response_json_text, topic, wikidump_path):
                 last_dots = True
 
         # Tokenize text and check length
-        encoded = tokenizer.encode(next_parsed_text)
+        encoded = get_tokenizer().encode(next_parsed_text)
         if len(encoded.ids) > 9000:
             break
 
@@ -108,7 +134,7 @@ def process_wiki_article(wikipedia_response_json_text, topic, wikidump_path):
     if not parsed_text or parsed_text == "[...]":
         return
 
-    with open(wikidump_path, "w", encoding="utf-8") as f:
+    with atomic_open(wikidump_path, "w", encoding="utf-8") as f:
         f.write(parsed_text)
 
 
@@ -118,7 +144,14 @@ def download_wikipedia_pages(
     log_file: str | None = None,
     pipeline_step: int = 0,
     dump_path: str = "data/wikipedia_dumps/",
+    num_processes: int | None = None,
+    download: bool = False,
 ):
+    """
+    Lists the topics whose page is in dump_path. If download, the missing pages are
+    downloaded from Wikipedia (see utils.wikipedia) and parsed into dump_path first.
+    """
+
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
     if os.path.exists(output_file):
         print(f"Output file {output_file} already exists.")
@@ -130,40 +163,47 @@ def download_wikipedia_pages(
     # Ensure the output directory exists
     os.makedirs(dir_wikidump, exist_ok=True)
 
-    with open(topics_file, "r", encoding="utf-8") as f:
-        topics = json.load(f)
+    topics = list(read_records(topics_file))
 
-    topics = list(set(t["_"] if isinstance(t, dict) else t for t in topics))
+    topics = list(dict.fromkeys(t["_"] if isinstance(t, dict) else t for t in topics))
 
     # Prepare topics for processing
     topics_with_paths = [
         (topic, os.path.join(dir_wikidump, f"{topic}.txt")) for topic in topics
     ]
 
-    # try:
-    #     # Run parallel processing with concurrent tasks
-    #     max_concurrent_tasks = 5
-    #     with concurrent.futures.ThreadPoolExecutor() as executor:
-    #         executor.map(
-    #             query_and_process_wiki_articles,
-    #             [
-    #                 topics_with_paths[i::max_concurrent_tasks]
-    #                 for i in range(max_concurrent_tasks)
-    #             ],
-    #         )
-    # except Exception as e:
-    #     print("Error:", e)
-    #     os._exit(0)
-
-    with open(output_file, "w") as f:
-        json.dump(
-            [
-                {"topic": topic, "topic_dump_path": path}
-                for topic, path in topics_with_paths
-                if os.path.exists(path)
-            ],
-            f,
-            indent=4,
-        )
+    # Only download the pages that are not in the dump yet
+    missing_topics_with_paths = [
+        (topic, path) for topic, path in topics_with_paths if not os.path.exists(path)
+    ]
+
+    if not download:
+        print(f"{len(missing_topics_with_paths)} topics have no page in {dir_wikidump}")
+    elif missing_topics_with_paths:
+        # Download with concurrent tasks, and parse the HTML in one process per core
+        max_concurrent_tasks = 5
+        with process_pool(num_processes) as process_executor:
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                parsing_futures = executor.map(
+                    partial(query_and_process_wiki_articles, executor=process_executor),
+                    [
+                        missing_topics_with_paths[i::max_concurrent_tasks]
+                        for i in range(max_concurrent_tasks)
+                    ],
+                )
+            for future in tqdm(sum(parsing_futures, [])):
+                try:
+                    future.result()
+                except Exception as e:
+                    print("Error:", e)
+
+    write_records(
+        output_file,
+        (
+            {"topic": topic, "topic_dump_path": path}
+            for topic, path in topics_with_paths
+            if os.path.exists(path)
+        ),
+    )
 
     return output_file
@@ -11,10 +11,12 @@ from dotenv import load_dotenv
 
 from functools import partial
 from utils.input_output import output_and_log_files
+from utils.llm_backend import LLMBackend
 from pipeline.general.generic_api_step import (
     generic_api_processing_step,
     fetch_api_response_and_process_with_structured_outputs,
     fetch_api_response_and_process_with_logprobs,
+    uses_batch_api,
 )
 
 SYSTEM_PROMPT = """You are an information processing man assisting in the creation of a trivia game about estimating numerical quantities of universally recognisable concepts.
@@ -103,12 +105,15 @@ class ListOfQuantities(BaseModel):
     quantities: list[Quantity]
 
 
+@uses_batch_api
 def mine_quantities(
     input_file: str,
     output_file: str | None = None,
     log_file: str | None = None,
     pipeline_step: int = 0,
     model="gpt-4o-mini",
+    execution_mode: str = "batch",
+    backend: LLMBackend | None = None,
 ) -> str:
 
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
@@ -120,6 +125,8 @@ def mine_quantities(
         input_path=input_file,
         output_path=output_file,
         log_path=log_file,
+        execution_mode=execution_mode,
+        backend=backend,
         instruction=SYSTEM_PROMPT,
         format_question_into_prompt=lambda x: open(
             x["topic_dump_path"], "r", encoding="utf-8"
@@ -141,3 +148,5 @@ def mine_quantities(
         ],
         examples=[],
     )
+
+    return output_file
@@ -1,10 +1,11 @@
 import os
 import json
 import tiktoken
+from functools import partial
 import unicodedata
-from tqdm import tqdm
 from pathlib import Path
-from utils.input_output import output_and_log_files
+from utils.input_output import output_and_log_files, read_records, write_records
+from pipeline.general.process_pool import map_by_topic
 from pipeline.general.generic_api_step import (
     generic_api_processing_step,
     fetch_api_response_and_process_with_structured_outputs,
@@ -12,6 +13,17 @@ from pipeline.general.generic_api_step import (
 )
 
 
+_tokenizer = None
+
+
+def get_tokenizer():
+    # Created once per worker process
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = tiktoken.encoding_for_model("gpt-4o-mini")
+    return _tokenizer
+
+
 def normalize_unicode(text):
     # Normalize to NFC (Canonical Composition) or NFD (Canonical Decomposition)
     normalized_text = unicodedata.normalize("NFC", text)
@@ -127,12 +139,18 @@ def find_excerpt_in_topic(topic, questions, tokenizer, wikidump_path):
     return questions
 
 
+def _find_excerpts_of_topic(topic, questions, dump_path):
+    wikidump_file = os.path.join(dump_path, f"{topic}.txt")
+    return find_excerpt_in_topic(topic, questions, get_tokenizer(), wikidump_file)
+
+
 def find_excerpts(
     input_file: str,
     output_file: str | None = None,
     log_file: str | None = None,
     pipeline_step: int = 0,
     dump_path: str = "data/wikipedia_dumps/",
+    num_processes: int | None = None,
 ):
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
     if os.path.exists(output_file):
@@ -140,27 +158,21 @@ def find_excerpts(
         return output_file
 
     # Read the input questions
-    with open(input_file, "r", encoding="utf-8") as f:
-        questions = json.load(f)
-
-    # Tokenizer initialization using tiktoken
-    tokenizer = tiktoken.encoding_for_model("gpt-4o-mini")
+    questions = list(read_records(input_file))
 
-    questions_by_topic = {}
     for question in questions:
-        if question["topic"] not in questions_by_topic:
-            questions_by_topic[question["topic"]] = []
         question["found_excerpt"] = None
-        questions_by_topic[question["topic"]].append(question)
 
-    for topic in tqdm(questions_by_topic):
-        wikidump_file = os.path.join(dump_path, f"{topic}.txt")
-        find_excerpt_in_topic(
-            topic, questions_by_topic[topic], tokenizer, wikidump_file
-        )
+    # Topics are independent, so they are spread over one process per core
+    questions = map_by_topic(
+        partial(_find_excerpts_of_topic, dump_path=dump_path),
+        questions,
+        num_processes=num_processes,
+    )
 
     print("Done")
 
     # Write the modified questions with found excerpts
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(questions, f, ensure_ascii=False, indent=4)
+    write_records(output_file, questions)
+
+    return output_file
@@ -12,21 +12,14 @@ from dotenv import load_dotenv
 
 from functools import partial
 from utils.input_output import output_and_log_files
+from utils.llm_backend import LLMBackend
 from pipeline.general.generic_api_step import (
     generic_api_processing_step,
     fetch_api_response_and_process_with_structured_outputs,
     fetch_api_response_and_process_with_logprobs,
+    uses_batch_api,
 )
-
-
-class ClarityType(str, Enum):
-    NoTechnicalTerms = "NoTechnicalTerms"
-    MakesSenseWithoutContext = "MakesSenseWithoutContext"
-    LaypersonCanGuess = "LaypersonCanGuess"
-    MakesSense = "MakesSense"
-    OverallClear = "OverallClear"
-    TryToAnswer = "TryToAnswer"
-    OverallClearDetailed = "OverallClearDetailed"
+from pipeline.clarity_type import ClarityType
 
 
 TASK_INSTRUCTIONS = {
@@ -63,6 +56,7 @@ def format_question(question: dict) -> str:
         )
 
 
+@uses_batch_api
 def filter_clear(
     input_file: str,
     output_file: str | None = None,
@@ -71,6 +65,8 @@ def filter_clear(
     model="gpt-4o-mini",
     logprob_threshold: float = -0.05,
     task: ClarityType = ClarityType.OverallClear,
+    execution_mode: str = "batch",
+    backend: LLMBackend | None = None,
 ) -> str:
 
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
@@ -93,6 +89,8 @@ def filter_clear(
         input_path=input_file,
         output_path=output_file,
         log_path=log_file,
+        execution_mode=execution_mode,
+        backend=backend,
         instruction=instruction,
         format_question_into_prompt=format_question,
         fetch_api_response_and_process=partial(
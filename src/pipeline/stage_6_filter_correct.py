@@ -12,10 +12,12 @@ from dotenv import load_dotenv
 
 from functools import partial
 from utils.input_output import output_and_log_files
+from utils.llm_backend import LLMBackend
 from pipeline.general.generic_api_step import (
     generic_api_processing_step,
     fetch_api_response_and_process_with_structured_outputs,
     fetch_api_response_and_process_with_logprobs,
+    uses_batch_api,
 )
 from pipeline.stage_4_mine_quantities import SingleValueModifier
 
@@ -74,6 +76,7 @@ def format_question(question: dict) -> str:
 {question['found_excerpt']}"""
 
 
+@uses_batch_api
 def filter_correct(
     input_file: str,
     output_file: str | None = None,
@@ -81,6 +84,8 @@ def filter_correct(
     pipeline_step: int = 0,
     model="gpt-4o-mini",
     logprob_threshold: float = -0.05,
+    execution_mode: str = "batch",
+    backend: LLMBackend | None = None,
 ) -> str:
 
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
@@ -94,6 +99,8 @@ def filter_correct(
         input_path=input_file,
         output_path=output_file,
         log_path=log_file,
+        execution_mode=execution_mode,
+        backend=backend,
         instruction="You will receive of description of a task about estimating a quantity, a value of the quantity and a text passage. You must reply only YES if the answer is erfectly correct according to the passage and NO otherwise.",
         format_question_into_prompt=format_question,
         fetch_api_response_and_process=partial(
@@ -11,6 +11,7 @@ from dotenv import load_dotenv
 
 from functools import partial
 from utils.input_output import output_and_log_files
+from utils.llm_backend import LLMBackend
 from pipeline.stage_4_mine_quantities import (
     SingleValue,
     IntervalValue,
@@ -21,6 +22,7 @@ from pipeline.general.generic_api_step import (
     generic_api_processing_step,
     fetch_api_response_and_process_with_structured_outputs,
     fetch_api_response_and_process_with_logprobs,
+    uses_batch_api,
 )
 
 SYSTEM_PROMPT = """You are helping design a game about estimating quantities. You will receive a topic, an excerpt and a preliminary description of a quanitity mentioned in the excerpt, as well as a preferred unit for the quantity.
@@ -238,6 +240,7 @@ def make_input_human_readable(question, include_units=False):
     )
 
 
+@uses_batch_api
 def rewrite_description(
     input_file: str,
     output_file: str | None = None,
@@ -245,6 +248,8 @@ def rewrite_description(
     pipeline_step: int = 0,
     model="gpt-4o-mini",
     include_units: bool = True,
+    execution_mode: str = "batch",
+    backend: LLMBackend | None = None,
 ) -> str:
 
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
@@ -256,6 +261,8 @@ def rewrite_description(
         input_path=input_file,
         output_path=output_file,
         log_path=log_file,
+        execution_mode=execution_mode,
+        backend=backend,
         instruction=SYSTEM_PROMPT,
         format_question_into_prompt=partial(
             make_input_human_readable, include_units=include_units
@@ -274,5 +281,7 @@ def rewrite_description(
         examples=EXAMPLES,
     )
 
+    return output_file
+
 
 # TODO: In the future, it would have been better to rewrite the description and answer all at once, since then the information in the original answer (e.g. the units) can also be used to shape the new description (and answer)
@@ -11,10 +11,12 @@ from dotenv import load_dotenv
 
 from functools import partial
 from utils.input_output import output_and_log_files
+from utils.llm_backend import LLMBackend
 from pipeline.general.generic_api_step import (
     generic_api_processing_step,
     fetch_api_response_and_process_with_structured_outputs,
     fetch_api_response_and_process_with_logprobs,
+    uses_batch_api,
 )
 from pipeline.stage_6_filter_clarity import format_question
 
@@ -105,12 +107,15 @@ EXAMPLES = [
 ]
 
 
+@uses_batch_api
 def add_scale_metadata(
     input_file: str,
     output_file: str | None = None,
     log_file: str | None = None,
     pipeline_step: int = 0,
     model="gpt-4o-mini",
+    execution_mode: str = "batch",
+    backend: LLMBackend | None = None,
 ) -> str:
 
     output_file, log_file = output_and_log_files(output_file, log_file, pipeline_step)
@@ -122,6 +127,8 @@ def add_scale_metadata(
         input_path=input_file,
         output_path=output_file,
         log_path=log_file,
+        execution_mode=execution_mode,
+        backend=backend,
         instruction=SYSTEM_PROMPT,
         format_question_into_prompt=format_question,
         fetch_api_response_and_process=partial(
@@ -9,7 +9,7 @@ from tqdm import tqdm
 from dotenv import load_dotenv
 
 from functools import partial
-from utils.input_output import output_and_log_files
+from utils.input_output import output_and_log_files, read_records, write_records
 
 
 def remove_date_and_unit_from_descriptions(
@@ -25,8 +25,7 @@ def remove_date_and_unit_from_descriptions(
         return output_file
 
     # Read the input questions
-    with open(input_file, "r", encoding="utf-8") as f:
-        questions = json.load(f)
+    questions = list(read_records(input_file))
 
     num_changed = 0
     for question in questions:
@@ -42,7 +41,6 @@ def remove_date_and_unit_from_descriptions(
     print(f"Number of questions with date and unit removed: {num_changed}")
 
     # Write the filtered questions to the output file
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(questions, f, ensure_ascii=False, indent=1)
+    write_records(output_file, questions)
 
     return output_file
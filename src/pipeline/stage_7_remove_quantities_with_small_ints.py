@@ -9,7 +9,13 @@ from tqdm import tqdm
 from dotenv import load_dotenv
 
 from functools import partial
-from utils.input_output import output_and_log_files
+from utils.input_output import (
+    output_and_log_files,
+    atomic_open,
+    read_records,
+    write_records,
+    sibling_file,
+)
 
 
 def remove_quantities_with_small_ints(
@@ -25,8 +31,7 @@ def remove_quantities_with_small_ints(
         return output_file
 
     # Read the input questions
-    with open(input_file, "r", encoding="utf-8") as f:
-        questions = json.load(f)
+    questions = list(read_records(input_file))
 
     filtered_questions = [
         question
@@ -41,13 +46,9 @@ def remove_quantities_with_small_ints(
     print("Number of original entries:", len(questions))
     print("Number of filtered entries:", len(filtered_questions))
 
-    # Write the filtered questions to the output file
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(filtered_questions, f, ensure_ascii=False, indent=1)
-
     # Write metadata
-    with open(
-        output_file.replace(".json", ".metadata.json"), "w", encoding="utf-8"
+    with atomic_open(
+        sibling_file(output_file, "metadata", ".json"), "w", encoding="utf-8"
     ) as f:
         json.dump(
             {
@@ -59,4 +60,7 @@ def remove_quantities_with_small_ints(
             indent=1,
         )
 
+    # Write the filtered questions to the output file
+    write_records(output_file, filtered_questions)
+
     return output_file
@@ -9,7 +9,13 @@ from tqdm import tqdm
 from dotenv import load_dotenv
 
 from functools import partial
-from utils.input_output import output_and_log_files
+from utils.input_output import (
+    output_and_log_files,
+    atomic_open,
+    write_records_last,
+    sibling_file,
+)
+from utils.columns import read_columns
 
 
 def finalize(
@@ -25,11 +31,13 @@ def finalize(
         print(f"Output file {output_file} already exists.")
         return output_file
 
-    # Read the input questions
-    with open(input_file, "r", encoding="utf-8") as f:
-        questions = json.load(f)
+    # Only the fields used below are loaded (from the columnar copy of the input if any)
+    questions = read_columns(
+        input_file,
+        ["uuid", "topic", "rewritten-description", "found_excerpt", "scale-interval"],
+    ).rows()
 
-    final_questions = [
+    final_questions = (
         {
             "uuid": question["uuid"],
             "topic": question["topic"],
@@ -55,22 +63,20 @@ def finalize(
             or question["scale-interval"]["lower_bound"] is not None
         )
         and question["rewritten-description"]["prompt"].startswith("Estimate ")
-    ]
+    )
 
-    # Write the final questions to the output file
-    with open(output_file, "w", encoding="utf-8") as f:
-        json.dump(final_questions, f, ensure_ascii=False, indent=1)
-
-    with open(
-        output_file.replace(".json", ".metadata.json"), "w", encoding="utf-8"
-    ) as f:
-        json.dump(
-            {
-                "number_of_questions": len(final_questions),
-            },
-            f,
-            ensure_ascii=False,
-            indent=1,
-        )
+    # Write the final questions to the output file, after the metadata
+    with write_records_last(output_file, final_questions) as number_of_questions:
+        with atomic_open(
+            sibling_file(output_file, "metadata", ".json"), "w", encoding="utf-8"
+        ) as f:
+            json.dump(
+                {
+                    "number_of_questions": number_of_questions,
+                },
+                f,
+                ensure_ascii=False,
+                indent=1,
+            )
 
     return output_file
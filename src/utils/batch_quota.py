@@ -0,0 +1,104 @@
+import os
+import re
+import json
+import heapq
+import itertools
+import threading
+from typing import Optional
+
+# Tokens that can be enqueued in the batch API for a model at once, unless set in
+# $OPENAI_ENQUEUED_TOKEN_LIMITS (a JSON object from model names to limits)
+DEFAULT_ENQUEUED_TOKEN_LIMIT = 35_000_000
+
+
+def _limits_from_env() -> dict[str, int]:
+    return json.loads(os.getenv("OPENAI_ENQUEUED_TOKEN_LIMITS", "{}"))
+
+
+def quota_model(model: str) -> str:
+    """Model whose quota a model counts against: snapshots (gpt-4o-2024-11-20) share it."""
+
+    return re.sub(r"-\d{4}-\d{2}-\d{2}$", "", model)
+
+
+class EnqueuedTokenLedger:
+    """
+    Process-wide ledger of the tokens of the batches in flight of each model, shared by
+    every stage, so that together they never enqueue more than the limit of the model.
+    A batch is admitted only if it fits and no batch of higher priority (or of the same
+    priority, waiting for longer) is waiting for the same model. A batch larger than the
+    limit is admitted once nothing else of its model is in flight.
+    Models are counted and limited under quota_model(model), so the snapshots of a model
+    share its quota.
+    """
+
+    def __init__(
+        self,
+        limits: Optional[dict[str, int]] = None,
+        default_limit: int = DEFAULT_ENQUEUED_TOKEN_LIMIT,
+    ):
+        self.limits = {
+            quota_model(model): limit
+            for model, limit in (_limits_from_env() if limits is None else limits).items()
+        }
+        self.default_limit = default_limit
+        self.enqueued: dict[str, int] = {}
+        # Waiting batches of each model, as (-priority, arrival, tokens)
+        self._waiting: dict[str, list[tuple[int, int, int]]] = {}
+        self._arrivals = itertools.count()
+        self._condition = threading.Condition()
+
+    def limit(self, model: str) -> int:
+        return self.limits.get(quota_model(model), self.default_limit)
+
+    def _fits(self, model: str, tokens: int) -> bool:
+        enqueued = self.enqueued.get(model, 0)
+        return enqueued == 0 or enqueued + tokens <= self.limit(model)
+
+    def _take(self, model: str, tokens: int):
+        self.enqueued[model] = self.enqueued.get(model, 0) + tokens
+
+    def try_acquire(self, model: str, tokens: int, priority: int = 0) -> bool:
+        """Reserves tokens for a batch of model if it can be admitted right away."""
+
+        model = quota_model(model)
+        with self._condition:
+            waiting = self._waiting.get(model)
+            if waiting and waiting[0][0] <= -priority:
+                return False
+            if not self._fits(model, tokens):
+                return False
+            self._take(model, tokens)
+            return True
+
+    def acquire(self, model: str, tokens: int, priority: int = 0):
+        """Waits for the turn of a batch of model and reserves its tokens."""
+
+        model = quota_model(model)
+        with self._condition:
+            entry = (-priority, next(self._arrivals), tokens)
+            waiting = self._waiting.setdefault(model, [])
+            heapq.heappush(waiting, entry)
+            self._condition.wait_for(
+                lambda: waiting[0] == entry and self._fits(model, tokens)
+            )
+            heapq.heappop(waiting)
+            self._take(model, tokens)
+            self._condition.notify_all()
+
+    def reserve(self, model: str, tokens: int):
+        """Counts the tokens of a batch of model that is already in flight."""
+
+        with self._condition:
+            self._take(quota_model(model), tokens)
+
+    def release(self, model: str, tokens: int):
+        """Frees the tokens of a batch of model that left the queue."""
+
+        model = quota_model(model)
+        with self._condition:
+            self.enqueued[model] = max(self.enqueued.get(model, 0) - tokens, 0)
+            self._condition.notify_all()
+
+
+enqueued_token_ledger = EnqueuedTokenLedger()
@@ -0,0 +1,127 @@
+import os
+import ast
+import inspect
+import hashlib
+from enum import Enum
+from functools import partial
+
+# Directory of the top-level packages of the repository (pipeline, utils...)
+SOURCE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _module_file(module: str) -> str | None:
+    path = os.path.join(SOURCE_ROOT, *module.split("."))
+    for candidate in [path + ".py", os.path.join(path, "__init__.py")]:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def _imported_files(path: str) -> set[str]:
+    """Source files of the repository that path imports (anywhere in the file)."""
+
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), filename=path)
+    modules = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            # The names imported from a package may be modules themselves
+            modules += [node.module] + [f"{node.module}.{a.name}" for a in node.names]
+    return {file for file in map(_module_file, modules) if file is not None}
+
+
+def source_hash(path: str) -> str:
+    """
+    Hash of a source file together with the files of the repository it imports, directly
+    or not, so that editing shared code (e.g. prompt building in generic_api_step or the
+    parsing in utils.openai) invalidates the stages that use it.
+    """
+
+    files = set()
+    pending = [os.path.abspath(path)]
+    while pending:
+        file = pending.pop()
+        if file in files:
+            continue
+        files.add(file)
+        if file.endswith(".py"):
+            pending += _imported_files(file)
+
+    hasher = hashlib.sha256()
+    for file in sorted(files):
+        name = os.path.relpath(file, SOURCE_ROOT) if file != os.path.abspath(path) else ""
+        hasher.update(f"{name}:{hash_file(file)}\n".encode("utf-8"))
+    return hasher.hexdigest()
+
+
+def fingerprint(obj) -> str:
+    """
+    Deterministic description of a stage function and its bound parameters:
+    - partials are described by their function and arguments
+    - named functions and classes by their qualified name and the hash of the source file
+      they are defined in and of the files it imports (see source_hash)
+    - lambdas by their source code
+    - strings that point to existing files by the hash of their contents
+    - objects that define cache_fingerprint() (e.g. lazily imported stages) by its result
+    """
+
+    if hasattr(type(obj), "cache_fingerprint"):
+        return obj.cache_fingerprint()
+    if isinstance(obj, partial):
+        args = ", ".join(fingerprint(arg) for arg in obj.args)
+        kwargs = ", ".join(
+            f"{key}={fingerprint(value)}" for key, value in sorted(obj.keywords.items())
+        )
+        return f"partial({fingerprint(obj.func)}, [{args}], {{{kwargs}}})"
+    if isinstance(obj, Enum):
+        return f"{type(obj).__qualname__}.{obj.name}"
+    if inspect.isfunction(obj) or inspect.isclass(obj):
+        if obj.__name__ == "<lambda>":
+            try:
+                return inspect.getsource(obj).strip()
+            except OSError:
+                code = obj.__code__
+                return repr((code.co_code.hex(), code.co_consts, code.co_names))
+        try:
+            source = source_hash(inspect.getsourcefile(obj))
+        except (OSError, TypeError, SyntaxError):
+            source = None
+        return f"{obj.__module__}.{obj.__qualname__}@{source}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ", ".join(fingerprint(item) for item in obj) + "]"
+    if isinstance(obj, dict):
+        return (
+            "{"
+            + ", ".join(
+                f"{fingerprint(key)}: {fingerprint(value)}"
+                for key, value in sorted(obj.items(), key=lambda x: repr(x[0]))
+            )
+            + "}"
+        )
+    if isinstance(obj, str) and os.path.isfile(obj):
+        return f"file({obj!r}, {hash_file(obj)})"
+    return repr(obj)
+
+
+def stage_cache_key(function, input_files: list[str]) -> str:
+    """
+    Key of a stage artifact: it changes whenever the stage, its parameters or the contents
+    of its inputs change.
+    """
+
+    hasher = hashlib.sha256()
+    hasher.update(fingerprint(function).encode("utf-8"))
+    for input_file in input_files:
+        hasher.update(b"\0")
+        hasher.update(hash_file(input_file).encode("utf-8"))
+    return hasher.hexdigest()
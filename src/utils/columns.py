@@ -0,0 +1,165 @@
+import os
+import json
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from utils.input_output import atomic_open, read_records, sibling_file
+
+# Columnar copy of a stage artifact (.npz next to it), for the tools that only need a few
+# fields of every record. Each top-level key of the records is a column:
+# - numeric columns (int, float, bool) are float arrays, with NaN for None/missing values
+# - other columns are the JSON of each value, concatenated, with the offsets of each value
+# and every column has a mask of the records in which the key is present.
+
+_NUMERIC_KINDS = {"int": int, "float": float, "bool": bool}
+
+
+@dataclass
+class Columns:
+    num_rows: int
+    # Numeric columns as float arrays (NaN if None or missing), other columns as lists
+    # of values (None if missing)
+    values: dict[str, np.ndarray | list] = field(default_factory=dict)
+    # Whether each record has the key
+    present: dict[str, np.ndarray] = field(default_factory=dict)
+    # Type of the values of each column: int, float, bool or json
+    kinds: dict[str, str] = field(default_factory=dict)
+
+    def rows(self):
+        """Records restricted to the loaded columns, without the missing keys."""
+
+        for i in range(self.num_rows):
+            row = {}
+            for key, values in self.values.items():
+                if not self.present[key][i]:
+                    continue
+                value = values[i]
+                if self.kinds[key] != "json":
+                    value = None if np.isnan(value) else _NUMERIC_KINDS[self.kinds[key]](value)
+                row[key] = value
+            yield row
+
+
+def columns_file(path: str) -> str:
+    return sibling_file(path, "columns", ".npz")
+
+
+def _kind(values: list) -> str:
+    non_null = [value for value in values if value is not None]
+    if non_null and all(isinstance(value, bool) for value in non_null):
+        return "bool"
+    if all(
+        isinstance(value, (int, float)) and not isinstance(value, bool)
+        for value in non_null
+    ):
+        return "int" if all(isinstance(value, int) for value in non_null) else "float"
+    return "json"
+
+
+def _build_columns(records, keys: list[str] | None = None) -> tuple[int, dict, dict]:
+    values = {}
+    present = {}
+    num_rows = 0
+    for i, record in enumerate(records):
+        if not isinstance(record, dict):
+            record = {"_": record}
+        for key in record if keys is None else keys:
+            if key not in record:
+                continue
+            if key not in values:
+                values[key] = [None] * i
+                present[key] = [False] * i
+            values[key].append(record[key])
+            present[key].append(True)
+        for key in values:
+            if len(values[key]) == i:
+                values[key].append(None)
+                present[key].append(False)
+        num_rows = i + 1
+    return num_rows, values, present
+
+
+def write_columns(path: str) -> str:
+    """Writes the columnar copy of the records of path and returns its file."""
+
+    num_rows, values, present = _build_columns(read_records(path))
+
+    arrays = {}
+    kinds = {}
+    for key, column in values.items():
+        kinds[key] = _kind(column)
+        arrays[f"{key}:present"] = np.array(present[key], dtype=bool)
+        if kinds[key] == "json":
+            encoded = [
+                json.dumps(value, ensure_ascii=False).encode("utf-8") for value in column
+            ]
+            arrays[f"{key}:offsets"] = np.cumsum([0] + [len(e) for e in encoded])
+            arrays[f"{key}:json"] = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        else:
+            arrays[f"{key}:values"] = np.array(
+                [np.nan if value is None else value for value in column],
+                dtype=np.float64,
+            )
+    arrays["schema"] = np.frombuffer(
+        json.dumps({"num_rows": num_rows, "kinds": kinds}).encode("utf-8"),
+        dtype=np.uint8,
+    )
+
+    output_file = columns_file(path)
+    with atomic_open(output_file, "wb", encoding=None) as f:
+        np.savez(f, **arrays)
+    return output_file
+
+
+def has_columns(path: str) -> bool:
+    file = columns_file(path)
+    return os.path.exists(file) and os.path.getmtime(file) >= os.path.getmtime(path)
+
+
+def read_columns(path: str, keys: list[str]) -> Columns:
+    """
+    Loads only the given columns of the records of path, from its columnar copy if it is
+    up to date, and otherwise by parsing the records.
+    """
+
+    if not has_columns(path):
+        num_rows, values, present = _build_columns(read_records(path), keys)
+        columns = Columns(num_rows)
+        for key in keys:
+            column = values.get(key, [None] * num_rows)
+            columns.present[key] = np.array(present.get(key, [False] * num_rows), dtype=bool)
+            columns.kinds[key] = _kind(column)
+            if columns.kinds[key] == "json":
+                columns.values[key] = column
+            else:
+                columns.values[key] = np.array(
+                    [np.nan if value is None else value for value in column],
+                    dtype=np.float64,
+                )
+        return columns
+
+    with np.load(columns_file(path)) as arrays:
+        schema = json.loads(arrays["schema"].tobytes())
+        columns = Columns(schema["num_rows"])
+        for key in keys:
+            kind = schema["kinds"].get(key)
+            if kind is None:
+                columns.present[key] = np.zeros(columns.num_rows, dtype=bool)
+                columns.values[key] = np.full(columns.num_rows, np.nan)
+                columns.kinds[key] = "float"
+                continue
+            columns.kinds[key] = kind
+            columns.present[key] = arrays[f"{key}:present"]
+            if kind == "json":
+                offsets = arrays[f"{key}:offsets"]
+                encoded = arrays[f"{key}:json"].tobytes()
+                columns.values[key] = [
+                    json.loads(encoded[start:end]) if is_present else None
+                    for start, end, is_present in zip(
+                        offsets[:-1], offsets[1:], columns.present[key]
+                    )
+                ]
+            else:
+                columns.values[key] = arrays[f"{key}:values"]
+    return columns
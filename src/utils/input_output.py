@@ -1,5 +1,14 @@
 import inspect
+import json
 import os
+import tempfile
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+# Read once, since setting the umask is the only way to read it. mkstemp creates files
+# only their owner can read, so atomic_open gives them the permissions of open() instead.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
 
 
 def output_and_log_files(
@@ -36,3 +45,93 @@ def output_and_log_files(
     os.makedirs(os.path.dirname(log_file), exist_ok=True)
 
     return output_file, log_file
+
+
+@contextmanager
+def atomic_open(path: str, mode: str = "w", encoding: str | None = "utf-8"):
+    """
+    Opens a temporary file next to path and moves it to path only once it has been
+    written completely, so that a crash never leaves a truncated file behind.
+    """
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with open(fd, mode, encoding=None if "b" in mode else encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_records(path: str) -> Iterator:
+    """
+    Yields the records of a stage artifact: one per line for .jsonl files (so that they
+    can be processed without loading the whole file), or the items of the array for
+    .json files.
+    """
+
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+def write_records(path: str, records: Iterable) -> int:
+    """
+    Writes the records as they are produced, as JSON lines for .jsonl files or as a
+    JSON array for .json files. Returns the number of records written.
+    """
+
+    with atomic_open(path, "w", encoding="utf-8") as f:
+        return _write_records(f, path, records)
+
+
+@contextmanager
+def write_records_last(path: str, records: Iterable) -> Iterator[int]:
+    """
+    Like write_records, but path is only replaced once the block ends, so that the side
+    files written in the block (e.g. the .metadata.json) exist before the main output
+    does. Yields the number of records written.
+    """
+
+    with atomic_open(path, "w", encoding="utf-8") as f:
+        yield _write_records(f, path, records)
+
+
+def _write_records(f, path: str, records: Iterable) -> int:
+    num_records = 0
+    if path.endswith(".jsonl"):
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False))
+            f.write("\n")
+            num_records += 1
+    else:
+        f.write("[")
+        for record in records:
+            f.write(",\n" if num_records > 0 else "\n")
+            f.write(json.dumps(record, ensure_ascii=False))
+            num_records += 1
+        f.write("\n]\n")
+    return num_records
+
+
+def sibling_file(path: str, suffix: str, extension: str | None = None) -> str:
+    """
+    Path of a file stored next to a stage artifact, e.g. the .metadata.json or the
+    .unfiltered.jsonl of data/pipeline/stage.jsonl.
+    """
+
+    root, original_extension = os.path.splitext(path)
+    return f"{root}.{suffix}{extension or original_extension}"
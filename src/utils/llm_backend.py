@@ -0,0 +1,161 @@
+from dataclasses import dataclass, field
+from typing import Any, Optional
+
+from utils.openai import AsyncOpenAIBatchHandler, OpenAIBatchHandler
+from utils.openai_realtime import OpenAIRealtimeHandler
+from utils.response_cache import ResponseCache
+
+# In "auto" mode, calls with at most this many requests run in real time
+REALTIME_MAX_REQUESTS = 1_000
+
+EXECUTION_MODES = ["batch", "realtime", "auto"]
+
+
+class LLMBackend:
+    """
+    Where the requests of a stage are answered. handler() opens a session whose
+    upload_batches submits the requests, polls them until they are answered and fetches
+    their outputs, with their usage (priced with price_multiplier) and logprobs as the
+    OpenAI chat completions endpoint returns them.
+    """
+
+    # Most top logprobs a request can ask for
+    max_top_logprobs = 20
+
+    def handler(
+        self,
+        num_requests: int,
+        log_dir: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+    ) -> OpenAIBatchHandler:
+        raise NotImplementedError
+
+    def cache_fingerprint(self) -> str:
+        # What the answers depend on, for the stage cache (see utils.cache)
+        return type(self).__name__
+
+
+@dataclass
+class OpenAIBatchBackend(LLMBackend):
+    """The OpenAI batch API, or a stand-in of it (see benchmarks.batch_emulator)."""
+
+    base_url: Optional[str] = None
+    emulator: Optional[Any] = None
+    max_concurrency: int = 16
+
+    def handler(self, num_requests, log_dir=None, response_cache=None):
+        return AsyncOpenAIBatchHandler(
+            log_dir=log_dir,
+            response_cache=response_cache,
+            base_url=self.base_url,
+            backend=self.emulator,
+            max_concurrency=self.max_concurrency,
+        )
+
+
+@dataclass
+class OpenAIRealtimeBackend(LLMBackend):
+    """Concurrent requests to the OpenAI chat completions endpoint, at twice the price."""
+
+    base_url: Optional[str] = None
+    emulator: Optional[Any] = None
+    requests_per_minute: Optional[int] = None
+    tokens_per_minute: Optional[int] = None
+    max_concurrency: int = 32
+
+    def handler(self, num_requests, log_dir=None, response_cache=None):
+        return OpenAIRealtimeHandler(
+            log_dir=log_dir,
+            response_cache=response_cache,
+            base_url=self.base_url,
+            backend=self.emulator,
+            requests_per_minute=self.requests_per_minute,
+            tokens_per_minute=self.tokens_per_minute,
+            max_concurrency=self.max_concurrency,
+        )
+
+
+@dataclass
+class AutoBackend(LLMBackend):
+    """realtime for calls with at most max_realtime_requests requests, batch otherwise."""
+
+    max_realtime_requests: int = REALTIME_MAX_REQUESTS
+    batch: LLMBackend = field(default_factory=OpenAIBatchBackend)
+    realtime: LLMBackend = field(default_factory=OpenAIRealtimeBackend)
+
+    def handler(self, num_requests, log_dir=None, response_cache=None):
+        backend = self.realtime if num_requests <= self.max_realtime_requests else self.batch
+        return backend.handler(num_requests, log_dir, response_cache)
+
+
+class LocalServerHandler(OpenAIRealtimeHandler):
+    """
+    OpenAIRealtimeHandler for a model served locally behind an OpenAI-compatible chat
+    completions endpoint (e.g. vLLM or llama.cpp): every request asks for model instead of
+    the requested one (so that their responses are cached apart from those of OpenAI),
+    with at most max_concurrency requests in flight, no rate limits and no cost.
+    """
+
+    price_multiplier = 0.0
+    rate_limited = False
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str,
+        api_key: str = "local",
+        log_dir: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+        max_concurrency: int = 16,
+    ):
+        super().__init__(
+            api_key=api_key,
+            log_dir=log_dir,
+            response_cache=response_cache,
+            base_url=base_url,
+            max_concurrency=max_concurrency,
+        )
+        self.model = model
+
+    def upload_batches(self, requests: list[dict], *args, **kwargs):
+        return super().upload_batches(
+            [request | {"model": self.model} for request in requests], *args, **kwargs
+        )
+
+
+@dataclass
+class LocalServerBackend(LLMBackend):
+    """A model served locally behind an OpenAI-compatible endpoint (see LocalServerHandler)."""
+
+    base_url: str
+    model: str
+    api_key: str = "local"
+    max_concurrency: int = 16
+    max_top_logprobs: int = 20
+
+    def handler(self, num_requests, log_dir=None, response_cache=None):
+        return LocalServerHandler(
+            base_url=self.base_url,
+            model=self.model,
+            api_key=self.api_key,
+            log_dir=log_dir,
+            response_cache=response_cache,
+            max_concurrency=self.max_concurrency,
+        )
+
+    def cache_fingerprint(self) -> str:
+        return f"LocalServerBackend({self.base_url!r}, {self.model!r})"
+
+
+def backend_for_execution_mode(execution_mode: str) -> LLMBackend:
+    """
+    The backend of an execution mode: the batch API ("batch"), real-time requests
+    ("realtime"), or real time only for at most REALTIME_MAX_REQUESTS requests ("auto").
+    """
+
+    assert execution_mode in EXECUTION_MODES, f"Unknown execution mode {execution_mode}"
+    if execution_mode == "batch":
+        return OpenAIBatchBackend()
+    if execution_mode == "realtime":
+        return OpenAIRealtimeBackend()
+    return AutoBackend()
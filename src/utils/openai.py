@@ -1,19 +1,50 @@
 import os
 from dataclasses import dataclass
-from typing import Optional
-import io
+from typing import Any, Callable, Iterable, Iterator, Optional
+from contextlib import contextmanager
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import shutil
+import tempfile
+import asyncio
 import openai
 import time
 import json
 import tiktoken
+import threading
 
 import hashlib
 
+from utils.input_output import atomic_open
+from utils.response_cache import ResponseCache, request_key
+from utils.batch_quota import EnqueuedTokenLedger, enqueued_token_ledger
+
 
 def consistent_hash(s: str) -> str:
     return hashlib.sha256(s.encode()).hexdigest()
 
 
+def requests_fingerprint(requests: list[dict]) -> str:
+    """
+    Cheap hash of chat completion requests that does not need to serialize them, used to
+    check whether a checkpointed batch still corresponds to the same requests.
+    """
+
+    hasher = hashlib.sha256()
+    for request in requests:
+        for message in request["messages"]:
+            hasher.update(message["role"].encode())
+            hasher.update(b"\0")
+            hasher.update(message["content"].encode())
+            hasher.update(b"\0")
+        hasher.update(
+            repr(sorted((k, v) for k, v in request.items() if k != "messages")).encode()
+        )
+        hasher.update(b"\n")
+    return hasher.hexdigest()
+
+
 @dataclass
 class BatchInfo:
     hash: str
@@ -23,27 +54,238 @@ class BatchInfo:
     num_tokens: Optional[int] = None
     file_id: Optional[str] = None
     batch_id: Optional[str] = None
+    first_request: Optional[int] = None
+    requests_hash: Optional[str] = None
 
     def to_dict(self):
         return self.__dict__
 
 
+@dataclass
+class PlannedBatch:
+    """Requests [first_request, end) of an upload_batches call, sent as batch index."""
+
+    index: int
+    first_request: int
+    end: int
+    num_tokens: int = 0
+    requests_hash: Optional[str] = None
+    # Metadata of the batch of a previous run with the same requests and processed results
+    checkpoint: Optional[BatchInfo] = None
+    # Metadata of the batch once it is submitted
+    batch_info: Optional[BatchInfo] = None
+
+
 FINISHED_BATCH_STATUSES = ["failed", "completed", "expired", "cancelled"]
 NONFINISHED_BATCH_STATUSES = ["validating", "in_progress", "finalizing", "cancelling"]
 
+# Number of requests whose messages are tokenized together when planning batches
+TOKEN_COUNT_WINDOW = 256
+# Size of the chunks in which batch outputs are written to disk
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+# Number of responses written to the response cache at once
+CACHE_WRITE_SIZE = 1000
+
+
+def output_error(output: dict) -> Optional[Any]:
+    """Error of a line of the output or error file of a batch, or None if it succeeded."""
+
+    if output.get("error"):
+        return output["error"]
+    response = output.get("response")
+    if response is None:
+        return {"message": "No response"}
+    if response.get("status_code", 200) != 200:
+        return response.get("body", {}).get("error") or {
+            "message": f"Status code {response['status_code']}"
+        }
+    return None
+
+
+def process_raw_output(
+    output_raw: dict,
+    process_output: Callable[[dict], Any] | list[Callable[[dict], Any]],
+) -> Optional[dict]:
+    """
+    Applies process_output (or its function for the request, if it is a list) to the body
+    of a successful output, and returns it with the model and usage of the response.
+    """
+
+    error = output_error(output_raw)
+    if error:
+        print("Error:", output_raw["custom_id"], error)
+        return None
+    body = output_raw["response"]["body"]
+    process = (
+        process_output[int(output_raw["custom_id"].split("::")[-1])]
+        if isinstance(process_output, list)
+        else process_output
+    )
+    return {
+        "custom_id": output_raw["custom_id"],
+        "model": body.get("model"),
+        "usage": body.get("usage"),
+        "parsed": process(body),
+    }
+
+
+def batch_timings(batch_object) -> dict:
+    """
+    Splits the time of a finished batch into the time it waited in OpenAI's queue
+    (created -> in_progress) and the time it took to be processed (in_progress -> done).
+    """
+
+    finished_at = (
+        batch_object.completed_at
+        or batch_object.failed_at
+        or batch_object.expired_at
+        or batch_object.cancelled_at
+    )
+    started_at = batch_object.in_progress_at
+    return {
+        "batch_id": batch_object.id,
+        "status": batch_object.status,
+        "requests": batch_object.request_counts.total,
+        "failed_requests": batch_object.request_counts.failed,
+        "queue_time": (
+            started_at - batch_object.created_at if started_at is not None else None
+        ),
+        "processing_time": (
+            finished_at - started_at
+            if started_at is not None and finished_at is not None
+            else None
+        ),
+    }
+
+
+class PollSchedule:
+    """
+    Interval between two polls of the batches in flight. It starts at min_interval, so that
+    small batches return in seconds. While the batches make progress it is set to about half
+    of their remaining time, estimated from the rate of their request_counts, and otherwise
+    it backs off, always within [min_interval, max_interval].
+    """
+
+    def __init__(
+        self,
+        min_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+        backoff: float = 1.5,
+    ):
+        if max_interval is None:
+            max_interval = float(os.getenv("OPENAI_BATCH_POLL_INTERVAL", 60))
+        if min_interval is None:
+            min_interval = float(os.getenv("OPENAI_BATCH_MIN_POLL_INTERVAL", 1))
+        self.min_interval = min(min_interval, max_interval)
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = None
+        # Last time the number of done requests of each batch changed, and that number
+        self._progress: dict[str, tuple[float, int]] = {}
+
+    def next_interval(
+        self, batch_objects: list, max_interval: Optional[float] = None
+    ) -> float:
+        max_interval = max_interval or self.max_interval
+        now = time.monotonic()
+        rate = 0.0
+        remaining = 0
+        started = False
+        for batch_object in batch_objects:
+            counts = batch_object.request_counts
+            if counts is None:
+                continue
+            done = counts.completed + counts.failed
+            remaining += counts.total - done
+            last_time, last_done = self._progress.get(batch_object.id, (None, None))
+            if last_done is None or done != last_done:
+                # The time before the first request is done is queue time, not progress
+                if last_done:
+                    rate += (done - last_done) / (now - last_time)
+                else:
+                    started = started or done > 0
+                self._progress[batch_object.id] = (now, done)
+
+        if self.interval is None or started:
+            self.interval = self.min_interval
+        elif rate > 0:
+            self.interval = remaining / rate / 2
+        else:
+            self.interval *= self.backoff
+        self.interval = min(max(self.interval, self.min_interval), max_interval)
+        return self.interval
+
 
 class OpenAIBatchHandler:
-    def __init__(self, api_key: Optional[str] = None, log_dir: Optional[str] = None):
+    """
+    Sends requests through the OpenAI batch API, at base_url if given (by default,
+    $OPENAI_BASE_URL or OpenAI), or to backend, an object whose client() and
+    async_client() stand in for the OpenAI clients (e.g. a
+    benchmarks.batch_emulator.BatchAPIEmulator, to run offline).
+    """
+
+    # Whether the requests can be sent together with those of other stages (see
+    # SharedBatchSubmission)
+    shares_batches = True
+    # Price of the requests relative to the batch API
+    price_multiplier = 1.0
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        log_dir: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+        ledger: Optional[EnqueuedTokenLedger] = None,
+        base_url: Optional[str] = None,
+        backend: Optional[Any] = None,
+    ):
         api_key = api_key or os.getenv("OPENAI_API_KEY")
-        self.client = openai.Client(api_key=api_key)
-        self.tokenizer = tiktoken.get_encoding("o200k_base")
+        if backend is not None:
+            self.client = backend.client()
+        else:
+            self.client = openai.Client(api_key=api_key, base_url=base_url)
+        # To create other handlers that send their requests to the same place
+        self._client_options = dict(base_url=base_url, backend=backend)
+        self.response_cache = response_cache
+        self.ledger = ledger or enqueued_token_ledger
+        # Key in the response cache of the requests being sent, by custom id
+        self._response_cache_keys: dict[str, str] = {}
+        self._tokenizer = None
         self.log_dir = log_dir
+        # Timings of the batches this handler waited for, by batch id
+        self.batch_timings: dict[str, dict] = {}
+        self._batch_created_at: dict[str, int] = {}
+        self._poll_schedule = PollSchedule()
+        # Number of tokens of each message content
+        self._token_counts: dict[str, int] = {}
+        # Where the outputs are downloaded without a log_dir
+        self._scratch_dir = None
+
+    @property
+    def tokenizer(self):
+        # Only needed for the batches that are not checkpointed
+        if self._tokenizer is None:
+            self._tokenizer = tiktoken.get_encoding("o200k_base")
+        return self._tokenizer
+
+    def close(self):
+        self.client.close()
+        if self._scratch_dir is not None:
+            shutil.rmtree(self._scratch_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def _get_file_path(self, batch_call_id: str, index: int, suffix: str):
         if self.log_dir is None:
             return None
         else:
-            extension = "jsonl" if suffix in ["input", "output"] else "json"
+            extension = (
+                "jsonl" if suffix in ["input", "output", "errors", "parsed"] else "json"
+            )
             os.makedirs(os.path.join(self.log_dir, batch_call_id), exist_ok=True)
             return os.path.join(
                 self.log_dir, batch_call_id, f"{index}-{suffix}.{extension}"
@@ -52,7 +294,7 @@ class OpenAIBatchHandler:
     def _write_metadata(self, metadata: BatchInfo, batch_call_id: str, index: int):
         if self.log_dir is None:
             return
-        with open(
+        with atomic_open(
             self._get_file_path(
                 batch_call_id=batch_call_id, index=index, suffix="metadata"
             ),
@@ -61,81 +303,295 @@ class OpenAIBatchHandler:
         ) as f:
             json.dump(metadata.to_dict(), f)
 
-    def wait_for_batches(self, batch_ids: str | list[str], timeout: Optional[int] = 60):
+    def _manifest_file(self, batch_call_id: str) -> str:
+        os.makedirs(os.path.join(self.log_dir, batch_call_id), exist_ok=True)
+        return os.path.join(self.log_dir, batch_call_id, "manifest.json")
+
+    def _read_manifest(self, batch_call_id: str) -> dict:
+        if self.log_dir is None or not os.path.exists(self._manifest_file(batch_call_id)):
+            return {}
+        with open(self._manifest_file(batch_call_id), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write_manifest(self, batch_call_id: str, **fields):
+        """
+        Updates the manifest of a call: the original indices of the requests it sends
+        ("requests"), and how they are split into batches and the IDs of the batches
+        submitted so far ("batches"), so that a restarted run can reattach to them.
+        """
+
+        if self.log_dir is None:
+            return
+        manifest = self._read_manifest(batch_call_id)
+        manifest.update(fields)
+        with atomic_open(self._manifest_file(batch_call_id), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    def wait_for_batches(
+        self,
+        batch_ids: str | list[str],
+        timeout: Optional[float] = None,
+        on_batch_finished: Optional[Callable[[Any], None]] = None,
+    ):
         if not isinstance(batch_ids, list):
             batch_ids = [batch_ids]
+        if not batch_ids:
+            return
         print("Waiting for batches", batch_ids)
-        batch_objects = [
-            self.client.batches.retrieve(batch_id) for batch_id in batch_ids
-        ]
-        while any(
-            batch_object.status not in FINISHED_BATCH_STATUSES
-            for batch_object in batch_objects
-        ):
+        remaining_ids = batch_ids
+        while remaining_ids:
+            finished_ids = {
+                batch_object.id
+                for batch_object in self.wait_for_any_batch(
+                    remaining_ids, timeout, on_batch_finished
+                )
+            }
+            remaining_ids = [
+                batch_id for batch_id in remaining_ids if batch_id not in finished_ids
+            ]
+
+    def wait_for_any_batch(
+        self,
+        batch_ids: list[str],
+        timeout: Optional[float] = None,
+        on_batch_finished: Optional[Callable[[Any], None]] = None,
+    ) -> list:
+        """
+        Polls the batches until at least one has finished, and returns the finished ones
+        (after calling on_batch_finished on each of them). The interval between polls adapts
+        to the progress of the batches, up to timeout seconds (see PollSchedule).
+        """
+
+        while True:
+            batch_objects = self._retrieve_many(batch_ids)
+            finished = [
+                batch_object
+                for batch_object in batch_objects
+                if batch_object.status in FINISHED_BATCH_STATUSES
+            ]
+            if finished:
+                for batch_object in finished:
+                    self.batch_timings[batch_object.id] = batch_timings(batch_object)
+                    if on_batch_finished is not None:
+                        on_batch_finished(batch_object)
+                return finished
+
+            interval = self._poll_schedule.next_interval(batch_objects, timeout)
             total = sum(
-                batch_object.request_counts.total for batch_object in batch_objects
+                batch_object.request_counts.total
+                for batch_object in batch_objects
+                if batch_object.request_counts is not None
             )
             completed = sum(
-                batch_object.request_counts.completed for batch_object in batch_objects
+                batch_object.request_counts.completed
+                for batch_object in batch_objects
+                if batch_object.request_counts is not None
             )
             failed = sum(
-                batch_object.request_counts.failed for batch_object in batch_objects
+                batch_object.request_counts.failed
+                for batch_object in batch_objects
+                if batch_object.request_counts is not None
             )
             print(
-                f"{completed}/{total}"
+                f"{completed}/{total} in {len(batch_objects)} batches in flight"
                 + ("" if failed == 0 else f"   [!] {failed} failed")
-                + (f"      {[batch_object.status for batch_object in batch_objects]}")
+                + f"   (next poll in {interval:.1f}s)"
             )
+            time.sleep(interval)
 
-            time.sleep(timeout)
-            batch_objects = [
-                self.client.batches.retrieve(batch_id) for batch_id in batch_ids
-            ]
+    def _list_window(self, batch_ids: list[str]) -> int:
+        # Batches are listed from the newest, so the listing can stop at the oldest one
+        # tracked (or go through every page if one of them was never seen)
+        return min(self._batch_created_at.get(batch_id, 0) for batch_id in batch_ids)
 
-    def download_batch(self, metadata: BatchInfo):
+    def _retrieve_many(self, batch_ids: list[str]) -> list:
+        """
+        Refreshes the batches with one paginated list call, rather than one retrieve call
+        per batch. The batches that are not listed are retrieved on their own.
+        """
+
+        found = {}
+        if len(batch_ids) > 1:
+            wanted = set(batch_ids)
+            oldest = self._list_window(batch_ids)
+            for batch_object in self.client.batches.list(limit=100):
+                if batch_object.id in wanted:
+                    found[batch_object.id] = batch_object
+                if len(found) == len(wanted) or batch_object.created_at < oldest:
+                    break
+        for batch_id in batch_ids:
+            if batch_id not in found:
+                found[batch_id] = self.client.batches.retrieve(batch_id)
+            self._batch_created_at[batch_id] = found[batch_id].created_at
+        return [found[batch_id] for batch_id in batch_ids]
+
+    def _output_file(self, metadata: BatchInfo, suffix: str = "output") -> str:
+        if self.log_dir is not None:
+            return self._get_file_path(metadata.batch_call_id, metadata.index, suffix)
+        if self._scratch_dir is None:
+            self._scratch_dir = tempfile.mkdtemp(prefix="openai-batches-")
+        return os.path.join(
+            self._scratch_dir,
+            f"{metadata.batch_call_id}-{metadata.index}-{suffix}.jsonl",
+        )
+
+    def _stream_file(self, file_id: Optional[str], path: str):
+        with atomic_open(path, "wb") as f:
+            if file_id is None:  # e.g. no request of the batch failed
+                return
+            with self.client.files.with_streaming_response.content(file_id) as response:
+                for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+    def _stream_output(self, metadata: BatchInfo):
+        # Batches that expired, were cancelled or failed have no output file, or only the
+        # outputs of some of their requests. The output file is written last, since its
+        # existence means that the batch was downloaded
         batch_object = self.client.batches.retrieve(metadata.batch_id)
-        content = self.client.files.content(batch_object.output_file_id)
+        self._stream_file(batch_object.error_file_id, self._output_file(metadata, "errors"))
+        self._stream_file(batch_object.output_file_id, self._output_file(metadata))
+
+    def _download_many(self, batch_infos: list[BatchInfo]):
+        """Downloads the output and error files of the batches not downloaded yet."""
+
+        for batch_info in batch_infos:
+            if not os.path.exists(self._output_file(batch_info)):
+                self._stream_output(batch_info)
+
+    def download_batch(self, metadata: BatchInfo) -> Iterator[dict]:
+        """
+        Yields the outputs of a batch one by one, from its output and error files, which
+        are downloaded first if needed (and, without a log_dir, removed once read).
+        """
+
+        self._download_many([metadata])
+        to_cache = []
+        try:
+            for suffix in ["output", "errors"]:
+                if not os.path.exists(self._output_file(metadata, suffix)):
+                    continue
+                with open(self._output_file(metadata, suffix), "r", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        output = json.loads(line)
+                        key = self._response_cache_keys.get(output["custom_id"])
+                        if key is not None and output_error(output) is None:
+                            to_cache.append((key, output["response"]["body"]))
+                            if len(to_cache) >= CACHE_WRITE_SIZE:
+                                self.response_cache.put_many(to_cache)
+                                to_cache = []
+                        yield output
+            if to_cache:
+                self.response_cache.put_many(to_cache)
+        finally:
+            if self.log_dir is None:
+                for suffix in ["output", "errors"]:
+                    if os.path.exists(self._output_file(metadata, suffix)):
+                        os.remove(self._output_file(metadata, suffix))
+
+    def _has_checkpoint(self, metadata: BatchInfo) -> bool:
+        return self.log_dir is not None and os.path.exists(
+            self._get_file_path(metadata.batch_call_id, metadata.index, "parsed")
+        )
+
+    def _load_checkpoint(self, metadata: BatchInfo) -> Optional[list[dict]]:
+        if not self._has_checkpoint(metadata):
+            return None
+        filename = self._get_file_path(metadata.batch_call_id, metadata.index, "parsed")
+        with open(filename, "r", encoding="utf-8") as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def _download_and_process_batch(
+        self,
+        metadata: BatchInfo,
+        process_output: Callable[[dict], Any] | list[Callable[[dict], Any]],
+    ) -> list[dict]:
+        """
+        Downloads the outputs of a batch and processes them, checkpointing the processed
+        results so that a later run does not need to download or process them again.
+        process_output can also be a list with the function of each request.
+        """
+
+        checkpoint = self._load_checkpoint(metadata)
+        if checkpoint is not None:
+            return checkpoint
+
+        processed_outputs = []
+        for output_raw in self.download_batch(metadata):
+            processed_output = process_raw_output(output_raw, process_output)
+            if processed_output is not None:
+                processed_outputs.append(processed_output)
+
         if self.log_dir is not None:
-            filename = self._get_file_path(
-                batch_call_id=metadata.batch_call_id,
-                index=metadata.index,
-                suffix="output",
-            )
-            if os.path.exists(filename):
-                decoded_content = open(
-                    filename,
-                    "r",
-                    encoding="utf-8",
-                ).read()
-            else:
-                decoded_content = content.response.content.decode("utf-8")
-                with open(
-                    filename,
-                    "w",
-                    encoding="utf-8",
-                ) as f:
-                    f.write(decoded_content)
-
-        return [json.loads(line) for line in decoded_content.split("\n") if line]
-
-    def _upload_and_return_batch_info(
+            with atomic_open(
+                self._get_file_path(metadata.batch_call_id, metadata.index, "parsed"),
+                "w",
+                encoding="utf-8",
+            ) as f:
+                for processed_output in processed_outputs:
+                    f.write(json.dumps(processed_output, ensure_ascii=False) + "\n")
+
+        return processed_outputs
+
+    def _load_completed_batch(
+        self, batch_call_id: str, index: int, first_request: int, requests: list[dict]
+    ) -> Optional[BatchInfo]:
+        """
+        Returns the metadata of a batch of a previous run whose processed results were
+        checkpointed, if it covers the same requests starting at first_request.
+        """
+
+        if self.log_dir is None:
+            return None
+        metadata_file = self._get_file_path(batch_call_id, index, "metadata")
+        if not os.path.exists(metadata_file):
+            return None
+        with open(metadata_file, "r", encoding="utf-8") as f:
+            metadata = BatchInfo(**json.load(f))
+        if (
+            metadata.first_request != first_request
+            or metadata.requests_hash is None
+            or first_request + metadata.num_requests > len(requests)
+            or not self._has_checkpoint(metadata)
+        ):
+            return None
+        if metadata.requests_hash != requests_fingerprint(
+            requests[first_request : first_request + metadata.num_requests]
+        ):
+            return None
+        return metadata
+
+    def _prepare_batch_upload(
         self,
         batch_call_id: str,
         index: int,
-        jsonl_string: str,
+        jsonl_lines: Iterable[str],
         endpoint: str,
         requests_in_batch: int,
         tokens_in_batch: int,
-    ):
+        first_request: Optional[int] = None,
+        requests_hash: Optional[str] = None,
+    ) -> tuple[BatchInfo, Optional[str]]:
+        """
+        Writes the input file of a batch and returns its metadata, together with the
+        file to upload, or None if the same batch was already uploaded. The lines are
+        written and hashed one by one, so that the batch is never whole in memory.
+        """
+
         if self.log_dir is not None:
-            filename = self._get_file_path(batch_call_id, index, "input")
-            with open(filename, "w", encoding="utf-8") as f:
-                f.write(jsonl_string)
-            file_handler = open(filename, "rb")
+            input_file = self._get_file_path(batch_call_id, index, "input")
         else:
-            file_handler = io.BytesIO(jsonl_string.encode("utf-8"))
+            fd, input_file = tempfile.mkstemp(prefix=f"{batch_call_id}-", suffix=".jsonl")
+            os.close(fd)
 
-        whole_content_hash = consistent_hash(jsonl_string)
+        hasher = hashlib.sha256()
+        with atomic_open(input_file, "wb") as f:
+            for i, line in enumerate(jsonl_lines):
+                data = (line if i == 0 else "\n" + line).encode("utf-8")
+                hasher.update(data)
+                f.write(data)
+        whole_content_hash = hasher.hexdigest()
 
         # Check if we've already uploaded this batch
         if self.log_dir is not None and os.path.exists(
@@ -149,64 +605,133 @@ class OpenAIBatchHandler:
                 print("Metadata exists")
                 metadata = json.load(f)
                 if metadata["hash"] == whole_content_hash:
-                    file_handler.close()
                     metadata = BatchInfo(**metadata)
-                    return metadata
+                    if metadata.requests_hash != requests_hash:
+                        metadata.first_request = first_request
+                        metadata.requests_hash = requests_hash
+                        self._write_metadata(metadata, batch_call_id, index)
+                    return metadata, None
+
+        # Outputs downloaded for a previous version of this batch are stale
+        if self.log_dir is not None:
+            for suffix in ["output", "errors", "parsed"]:
+                stale_file = self._get_file_path(batch_call_id, index, suffix)
+                if os.path.exists(stale_file):
+                    os.remove(stale_file)
 
-        file_object = self.client.files.create(file=file_handler, purpose="batch")
-        file_handler.close()
-        batch_object = self.client.batches.create(
-            input_file_id=file_object.id, endpoint=endpoint, completion_window="24h"
-        )
         batch_info = BatchInfo(
             hash=whole_content_hash,
             batch_call_id=batch_call_id,
             index=index,
             num_requests=requests_in_batch,
             num_tokens=tokens_in_batch,
-            file_id=file_object.id,
-            batch_id=batch_object.id,
+            first_request=first_request,
+            requests_hash=requests_hash,
+        )
+        return batch_info, input_file
+
+    @contextmanager
+    def _open_batch_input(self, input_file: str):
+        try:
+            with open(input_file, "rb") as f:
+                yield f
+        finally:
+            if self.log_dir is None:  # Temporary file
+                os.remove(input_file)
+
+    def _create_batch(
+        self, batch_info: BatchInfo, input_file: str, endpoint: str
+    ) -> BatchInfo:
+        with self._open_batch_input(input_file) as f:
+            file_object = self.client.files.create(file=f, purpose="batch")
+        batch_object = self.client.batches.create(
+            input_file_id=file_object.id, endpoint=endpoint, completion_window="24h"
         )
-        self._write_metadata(batch_info, batch_call_id, index)
+        batch_info.file_id = file_object.id
+        batch_info.batch_id = batch_object.id
+        self._write_metadata(batch_info, batch_info.batch_call_id, batch_info.index)
         return batch_info
 
-    def upload_batches(
-        self,
-        requests: list[dict],
-        endpoint: str = "/v1/chat/completions",
-        batch_call_id: str = "batch",
-        max_tokens_per_batch: Optional[int] = 4096,
-        max_requests_per_batch: Optional[int] = 50_000,
-    ):
-        batch_lines = []
-        for index, request_args in enumerate(requests):
-            batch_call_id_ = batch_call_id + "::" + str(index)
+    def _upload_and_return_batch_info(self, endpoint: str, **kwargs) -> BatchInfo:
+        batch_info, input_file = self._prepare_batch_upload(endpoint=endpoint, **kwargs)
+        if input_file is None:
+            return batch_info
+        return self._create_batch(batch_info, input_file, endpoint)
 
-            batch_lines.append(
-                {
-                    "custom_id": batch_call_id_,
-                    "method": "POST",
-                    "url": "/v1/chat/completions",
-                    "body": request_args,
-                }
+    def _count_tokens_of_contents(self, contents):
+        # Each distinct content is encoded once (the system prompt and in-prompt examples
+        # are shared by every request of a stage), and in parallel
+        new_contents = [
+            content
+            for content in dict.fromkeys(contents)
+            if content not in self._token_counts
+        ]
+        if not new_contents:
+            return
+        encoded_contents = self.tokenizer.encode_ordinary_batch(
+            new_contents, num_threads=os.cpu_count() or 1
+        )
+        for content, encoded in zip(new_contents, encoded_contents):
+            self._token_counts[content] = len(encoded)
+
+    def _count_request_tokens(self, requests: list[dict], index: int) -> int:
+        body = requests[index]
+        if any(message["content"] not in self._token_counts for message in body["messages"]):
+            # Counts the next requests too, which are planned right after this one
+            self._count_tokens_of_contents(
+                message["content"]
+                for request in requests[index : index + TOKEN_COUNT_WINDOW]
+                for message in request["messages"]
             )
+        return sum(
+            self._token_counts[message["content"]] for message in body["messages"]
+        ) + body.get("max_tokens", body.get("max_completion_tokens", 0))
 
-        request_index = 0
-        tokens_in_batch = 0
-        requests_in_batch = 0
+    def _plan_batches(
+        self,
+        requests: list[dict],
+        batch_call_id: str,
+        max_tokens_per_batch: Optional[int],
+        max_requests_per_batch: Optional[int],
+        reuse_checkpoints: bool,
+    ) -> list[PlannedBatch]:
+        """
+        Splits the requests into batches within the limits. Batches of a previous run whose
+        processed results were checkpointed are kept as they were, without tokenizing them.
+        """
 
-        batch_infos = []
+        planned_batches = []
+        first_request = 0
+        tokens_in_batch = 0
+        tokens_in_request = None
 
-        batch_index = 0
-        jsonl_strings = []
-        for request_index in range(len(batch_lines)):
-            assert endpoint == "/v1/chat/completions"
+        request_index = 0
+        while request_index < len(requests):
+            if request_index == first_request and reuse_checkpoints:
+                checkpoint = self._load_completed_batch(
+                    batch_call_id, len(planned_batches), request_index, requests
+                )
+                if checkpoint is not None:
+                    print(f"Reusing checkpoint of batch {len(planned_batches)}")
+                    request_index += checkpoint.num_requests
+                    planned_batches.append(
+                        PlannedBatch(
+                            index=len(planned_batches),
+                            first_request=first_request,
+                            end=request_index,
+                            num_tokens=checkpoint.num_tokens or 0,
+                            requests_hash=checkpoint.requests_hash,
+                            checkpoint=checkpoint,
+                            batch_info=checkpoint,
+                        )
+                    )
+                    first_request = request_index
+                    tokens_in_request = None
+                    continue
 
-            body = batch_lines[request_index]["body"]
-            tokens_in_request = sum(
-                len(self.tokenizer.encode(message["content"]))
-                for message in body["messages"]
-            ) + body.get("max_tokens", body.get("max_completion_tokens", 0))
+            if tokens_in_request is None:
+                tokens_in_request = self._count_request_tokens(requests, request_index)
+            requests_in_batch = request_index - first_request
 
             reached_token_limit = (
                 max_tokens_per_batch is not None
@@ -217,56 +742,844 @@ class OpenAIBatchHandler:
                 and requests_in_batch >= max_requests_per_batch
             )
 
-            if reached_token_limit or reached_request_limit:
-                batch_infos.append(
-                    self._upload_and_return_batch_info(
-                        batch_call_id=batch_call_id,
-                        index=batch_index,
-                        jsonl_string="\n".join(jsonl_strings),
-                        endpoint=endpoint,
-                        requests_in_batch=requests_in_batch,
-                        tokens_in_batch=tokens_in_batch,
+            if (reached_token_limit or reached_request_limit) and requests_in_batch > 0:
+                planned_batches.append(
+                    PlannedBatch(
+                        index=len(planned_batches),
+                        first_request=first_request,
+                        end=request_index,
+                        num_tokens=tokens_in_batch,
                     )
                 )
-
-                if reached_token_limit:  # We can't do several batches concurrently
-                    self.wait_for_batches(
-                        [batch_info.batch_id for batch_info in batch_infos]
-                    )
-
-                requests_in_batch = 0
+                first_request = request_index
                 tokens_in_batch = 0
-                batch_index += 1
-                jsonl_strings = []
+                continue
 
-            requests_in_batch += 1
             tokens_in_batch += tokens_in_request
+            tokens_in_request = None
+            request_index += 1
 
-            jsonl_strings.append(json.dumps(batch_lines[request_index]))
-
-        if requests_in_batch > 0:
-            batch_infos.append(
-                self._upload_and_return_batch_info(
-                    batch_call_id=batch_call_id,
-                    index=batch_index,
-                    jsonl_string="\n".join(jsonl_strings),
-                    endpoint=endpoint,
-                    requests_in_batch=requests_in_batch,
-                    tokens_in_batch=tokens_in_batch,
+        if request_index > first_request:
+            planned_batches.append(
+                PlannedBatch(
+                    index=len(planned_batches),
+                    first_request=first_request,
+                    end=request_index,
+                    num_tokens=tokens_in_batch,
                 )
             )
 
-        self.wait_for_batches([batch_info.batch_id for batch_info in batch_infos])
-        outputs_raw = sum(
-            (self.download_batch(batch_info) for batch_info in batch_infos), []
+        for planned_batch in planned_batches:
+            if planned_batch.requests_hash is None:
+                planned_batch.requests_hash = requests_fingerprint(
+                    requests[planned_batch.first_request : planned_batch.end]
+                )
+        return planned_batches
+
+    def _load_manifest_plan(
+        self,
+        requests: list[dict],
+        batch_call_id: str,
+        limits: dict,
+        reuse_checkpoints: bool,
+    ) -> Optional[list[PlannedBatch]]:
+        """
+        The batches of the manifest of an interrupted run of the call, if it sent the same
+        requests with the same limits, so that they are reused as they were (without
+        tokenizing or serializing their requests) and the submitted ones are reattached.
+        """
+
+        manifest = self._read_manifest(batch_call_id)
+        if (
+            "batches" not in manifest
+            or manifest.get("limits") != limits
+            or manifest.get("num_requests") != len(requests)
+        ):
+            return None
+
+        planned_batches = []
+        for index, entry in enumerate(manifest["batches"]):
+            if entry["requests_hash"] != requests_fingerprint(
+                requests[entry["first_request"] : entry["end"]]
+            ):
+                return None
+            planned_batch = PlannedBatch(
+                index=index,
+                first_request=entry["first_request"],
+                end=entry["end"],
+                num_tokens=entry["num_tokens"],
+                requests_hash=entry["requests_hash"],
+                batch_info=BatchInfo(**entry["batch"]) if entry["batch"] else None,
+            )
+            if (
+                reuse_checkpoints
+                and planned_batch.batch_info is not None
+                and self._has_checkpoint(planned_batch.batch_info)
+            ):
+                planned_batch.checkpoint = planned_batch.batch_info
+            planned_batches.append(planned_batch)
+
+        print(f"Reattaching to the batches of {batch_call_id} from its manifest")
+        return planned_batches
+
+    def _write_manifest_plan(
+        self, batch_call_id: str, planned_batches: list[PlannedBatch], **fields
+    ):
+        self._write_manifest(
+            batch_call_id,
+            **fields,
+            batches=[
+                {
+                    "first_request": planned_batch.first_request,
+                    "end": planned_batch.end,
+                    "num_tokens": planned_batch.num_tokens,
+                    "requests_hash": planned_batch.requests_hash,
+                    "batch": (
+                        planned_batch.batch_info.to_dict()
+                        if planned_batch.batch_info is not None
+                        else None
+                    ),
+                }
+                for planned_batch in planned_batches
+            ],
         )
 
-        outputs_clean: list[dict | str | None] = [None for _ in range(len(batch_lines))]
-        for output_raw in outputs_raw:
-            original_index = int(output_raw["custom_id"].split("::")[-1])
-            if output_raw["error"]:
-                outputs_clean[original_index] = output_raw["error"]
-            else:
-                outputs_clean[original_index] = output_raw["response"]["body"]
+    def _prepare_planned_batch(
+        self,
+        requests: list[dict],
+        planned_batch: PlannedBatch,
+        batch_call_id: str,
+        endpoint: str,
+    ) -> tuple[BatchInfo, Optional[str]]:
+        jsonl_lines = (
+            json.dumps(
+                {
+                    "custom_id": batch_call_id + "::" + str(request_index),
+                    "method": "POST",
+                    "url": endpoint,
+                    "body": requests[request_index],
+                }
+            )
+            for request_index in range(planned_batch.first_request, planned_batch.end)
+        )
+        return self._prepare_batch_upload(
+            batch_call_id=batch_call_id,
+            index=planned_batch.index,
+            jsonl_lines=jsonl_lines,
+            endpoint=endpoint,
+            requests_in_batch=planned_batch.end - planned_batch.first_request,
+            tokens_in_batch=planned_batch.num_tokens,
+            first_request=planned_batch.first_request,
+            requests_hash=planned_batch.requests_hash,
+        )
+
+    def _upload_many(
+        self,
+        requests: list[dict],
+        planned_batches: list[PlannedBatch],
+        batch_call_id: str,
+        endpoint: str,
+    ) -> list[BatchInfo]:
+        batch_infos = []
+        for planned_batch in planned_batches:
+            batch_info, input_file = self._prepare_planned_batch(
+                requests, planned_batch, batch_call_id, endpoint
+            )
+            if input_file is not None:
+                batch_info = self._create_batch(batch_info, input_file, endpoint)
+            batch_infos.append(batch_info)
+        return batch_infos
+
+    def upload_batches(
+        self,
+        requests: list[dict],
+        endpoint: str = "/v1/chat/completions",
+        batch_call_id: str = "batch",
+        max_tokens_per_batch: Optional[int] = 4096,
+        max_requests_per_batch: Optional[int] = 50_000,
+        process_output: Optional[
+            Callable[[dict], Any] | list[Callable[[dict], Any]]
+        ] = None,
+        max_enqueued_tokens: Optional[int] = None,
+        on_batch_finished: Optional[Callable[[Any], None]] = None,
+        max_retries: int = 2,
+        priority: int = 0,
+    ):
+        """
+        Sends the requests as batches and returns their outputs, in the same order.
+        Batches are kept in flight as long as the enqueued-token limit of their model
+        allows, counting the batches of every stage of the process (see
+        utils.batch_quota), and, if given, as long as the batches of this call do not
+        exceed max_enqueued_tokens. The next batch is submitted as soon as an earlier one
+        finishes, and batches of calls with a higher priority are admitted first.
+        on_batch_finished is called with each batch object as soon as it finishes.
+        If process_output is given, it is applied to the body of each output as soon as
+        its batch is downloaded, and each output is returned as a dict with its "model",
+        "usage" and "parsed" result. The processed results of each batch are checkpointed
+        in log_dir, so that batches that completed in a previous run are reused without
+        tokenizing, serializing, downloading or processing their requests again. The
+        split into batches and the IDs of the submitted batches are kept in a manifest in
+        log_dir, so that a restarted run reattaches to the batches of an interrupted one.
+        Within SharedBatchSubmission.participant(), the requests are sent together with
+        those of the other participants instead.
+        With a response_cache, only the requests that are not in it are sent, and the
+        responses of the others are processed from the cache (and marked as "cached").
+        The requests that failed or got no response (e.g. their batch expired) are sent
+        again in new batches, up to max_retries times. Requests that still fail have
+        no output, or their error as output if process_output is None.
+        """
+
+        assert endpoint == "/v1/chat/completions"
+
+        upload_kwargs = dict(
+            endpoint=endpoint,
+            batch_call_id=batch_call_id,
+            max_tokens_per_batch=max_tokens_per_batch,
+            max_requests_per_batch=max_requests_per_batch,
+            max_enqueued_tokens=max_enqueued_tokens,
+            on_batch_finished=on_batch_finished,
+            max_retries=max_retries,
+            priority=priority,
+        )
+        if self.response_cache is None or not requests:
+            return self._upload_batches(requests, process_output, **upload_kwargs)
+
+        keys = [request_key(request) for request in requests]
+        cached_responses = self.response_cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached_responses]
+        if cached_responses:
+            print(
+                f"{len(requests) - len(missing)}/{len(requests)} responses found in the"
+                f" cache {self.response_cache.path}"
+            )
+        # An interrupted run sends its requests again in the same order, even those whose
+        # responses were cached since, so that its batches can be reattached
+        manifest = self._read_manifest(batch_call_id)
+        if (
+            manifest.get("batches")
+            and manifest.get("requests") is not None
+            and set(missing) <= set(manifest["requests"])
+            and all(i < len(requests) for i in manifest["requests"])
+        ):
+            missing = manifest["requests"]
+        self._write_manifest(batch_call_id, requests=missing)
+
+        self._response_cache_keys = {
+            f"{batch_call_id}::{j}": keys[i] for j, i in enumerate(missing)
+        }
+        outputs_missing = self._upload_batches(
+            [requests[i] for i in missing],
+            (
+                [process_output[i] for i in missing]
+                if isinstance(process_output, list)
+                else process_output
+            ),
+            **upload_kwargs,
+        )
+
+        self._write_manifest(batch_call_id, requests=None)
+
+        outputs = [None for _ in range(len(requests))]
+        for i, output in zip(missing, outputs_missing):
+            outputs[i] = output
+        for i, key in enumerate(keys):
+            if key not in cached_responses:
+                continue
+            body = cached_responses[key]
+            if process_output is None:
+                outputs[i] = body
+                continue
+            process = (
+                process_output[i] if isinstance(process_output, list) else process_output
+            )
+            outputs[i] = {
+                "custom_id": f"{batch_call_id}::{i}",
+                "model": body.get("model"),
+                "usage": body.get("usage"),
+                "parsed": process(body),
+                "cached": True,
+            }
+        return outputs
+
+    def _upload_batches(
+        self,
+        requests: list[dict],
+        process_output: Optional[Callable[[dict], Any] | list[Callable[[dict], Any]]],
+        endpoint: str,
+        batch_call_id: str,
+        max_tokens_per_batch: Optional[int],
+        max_requests_per_batch: Optional[int],
+        max_enqueued_tokens: Optional[int],
+        on_batch_finished: Optional[Callable[[Any], None]],
+        max_retries: int,
+        priority: int,
+    ):
+        participant = _current_participant.get()
+        if participant is not None and not self.shares_batches:
+            submission, participant_index = participant
+            submission.leave(participant_index)
+        elif participant is not None:
+            submission, participant_index = participant
+            outputs = submission.submit(
+                participant_index,
+                self,
+                requests,
+                process_output,
+                endpoint=endpoint,
+                max_tokens_per_batch=max_tokens_per_batch,
+                max_requests_per_batch=max_requests_per_batch,
+                max_enqueued_tokens=max_enqueued_tokens,
+                on_batch_finished=on_batch_finished,
+                max_retries=max_retries,
+                priority=priority,
+            )
+            if outputs is not None:
+                return outputs
+
+        run_kwargs = dict(
+            endpoint=endpoint,
+            max_tokens_per_batch=max_tokens_per_batch,
+            max_requests_per_batch=max_requests_per_batch,
+            max_enqueued_tokens=max_enqueued_tokens,
+            on_batch_finished=on_batch_finished,
+            priority=priority,
+        )
+
+        outputs, failed = self._run_batches(
+            requests, process_output, batch_call_id=batch_call_id, **run_kwargs
+        )
+        for retry in range(1, max_retries + 1):
+            to_retry = [
+                i for i, output in enumerate(outputs) if output is None or i in failed
+            ]
+            if not to_retry:
+                break
+            print(
+                f"Resubmitting {len(to_retry)} failed or missing requests"
+                f" (retry {retry}/{max_retries})"
+            )
+            retry_call_id = f"{batch_call_id}-retry{retry}"
+            for j, i in enumerate(to_retry):
+                key = self._response_cache_keys.get(f"{batch_call_id}::{i}")
+                if key is not None:
+                    self._response_cache_keys[f"{retry_call_id}::{j}"] = key
+            retried_outputs, retried_failed = self._run_batches(
+                [requests[i] for i in to_retry],
+                (
+                    [process_output[i] for i in to_retry]
+                    if isinstance(process_output, list)
+                    else process_output
+                ),
+                batch_call_id=retry_call_id,
+                **run_kwargs,
+            )
+            failed = set()
+            for j, (i, output) in enumerate(zip(to_retry, retried_outputs)):
+                if output is not None:
+                    outputs[i] = output
+                if j in retried_failed:
+                    failed.add(i)
+
+        return outputs
+
+    def _run_batches(
+        self,
+        requests: list[dict],
+        process_output: Optional[Callable[[dict], Any] | list[Callable[[dict], Any]]],
+        endpoint: str,
+        batch_call_id: str,
+        max_tokens_per_batch: Optional[int],
+        max_requests_per_batch: Optional[int],
+        max_enqueued_tokens: Optional[int],
+        on_batch_finished: Optional[Callable[[Any], None]],
+        priority: int,
+    ) -> tuple[list, set[int]]:
+        """
+        Sends the requests as batches, and returns their outputs (None for the requests
+        without a response) and the indices of the requests that failed.
+        """
+
+        limits = dict(
+            endpoint=endpoint,
+            max_tokens_per_batch=max_tokens_per_batch,
+            max_requests_per_batch=max_requests_per_batch,
+        )
+        planned_batches = self._load_manifest_plan(
+            requests, batch_call_id, limits, reuse_checkpoints=process_output is not None
+        )
+        if planned_batches is None:
+            planned_batches = self._plan_batches(
+                requests,
+                batch_call_id,
+                max_tokens_per_batch=max_tokens_per_batch,
+                max_requests_per_batch=max_requests_per_batch,
+                reuse_checkpoints=process_output is not None,
+            )
+            self._write_manifest_plan(
+                batch_call_id, planned_batches, limits=limits, num_requests=len(requests)
+            )
+
+        outputs_clean: list[dict | str | None] = [None for _ in range(len(requests))]
+        failed = set()
+
+        def collect_outputs(batch_infos: list[BatchInfo]):
+            # The batches whose results are not checkpointed are downloaded together, and
+            # their outputs are then read one by one into their slots
+            self._download_many(
+                [
+                    batch_info
+                    for batch_info in batch_infos
+                    if process_output is None or not self._has_checkpoint(batch_info)
+                ]
+            )
+
+            for batch_info in batch_infos:
+                if process_output is not None:
+                    outputs = self._download_and_process_batch(batch_info, process_output)
+                else:
+                    outputs = self.download_batch(batch_info)
+
+                for output in outputs:
+                    original_index = int(output["custom_id"].split("::")[-1])
+                    if process_output is not None:
+                        outputs_clean[original_index] = output
+                    elif error := output_error(output):
+                        outputs_clean[original_index] = error
+                        failed.add(original_index)
+                    else:
+                        outputs_clean[original_index] = output["response"]["body"]
+
+        collect_outputs(
+            [
+                planned_batch.checkpoint
+                for planned_batch in planned_batches
+                if planned_batch.checkpoint is not None
+            ]
+        )
+        pending = deque(
+            planned_batch
+            for planned_batch in planned_batches
+            if planned_batch.checkpoint is None and planned_batch.batch_info is None
+        )
+
+        def model_of(planned_batch: PlannedBatch) -> str:
+            return requests[planned_batch.first_request].get("model", "")
+
+        # Keeps as many batches in flight as the enqueued-token limit of the model allows
+        # (shared with the other stages through the ledger), submitting the next one as
+        # soon as any of them finishes (and processing the finished one)
+        in_flight: dict[str, tuple[BatchInfo, PlannedBatch]] = {}
+        reserved: list[PlannedBatch] = []
+        enqueued_tokens = 0
+        try:
+            # Batches submitted by an interrupted run are waited for again
+            for planned_batch in planned_batches:
+                if planned_batch.checkpoint is None and planned_batch.batch_info is not None:
+                    self.ledger.reserve(model_of(planned_batch), planned_batch.num_tokens)
+                    reserved.append(planned_batch)
+                    in_flight[planned_batch.batch_info.batch_id] = (
+                        planned_batch.batch_info,
+                        planned_batch,
+                    )
+                    enqueued_tokens += planned_batch.num_tokens
+
+            while pending or in_flight:
+                to_upload = []
+                while pending:
+                    planned_batch = pending[0]
+                    if (
+                        (in_flight or to_upload)
+                        and max_enqueued_tokens is not None
+                        and enqueued_tokens + planned_batch.num_tokens
+                        > max_enqueued_tokens
+                    ):
+                        break
+                    model = model_of(planned_batch)
+                    if not self.ledger.try_acquire(
+                        model, planned_batch.num_tokens, priority
+                    ):
+                        if in_flight or to_upload:
+                            break
+                        print(f"Waiting for other batches of {model} to finish")
+                        self.ledger.acquire(model, planned_batch.num_tokens, priority)
+                    reserved.append(planned_batch)
+                    to_upload.append(pending.popleft())
+                    enqueued_tokens += planned_batch.num_tokens
+                for batch_info, planned_batch in zip(
+                    self._upload_many(requests, to_upload, batch_call_id, endpoint),
+                    to_upload,
+                ):
+                    planned_batch.batch_info = batch_info
+                    in_flight[batch_info.batch_id] = (batch_info, planned_batch)
+                if to_upload:
+                    self._write_manifest_plan(batch_call_id, planned_batches)
+
+                finished = []
+                for batch_object in self.wait_for_any_batch(
+                    list(in_flight), on_batch_finished=on_batch_finished
+                ):
+                    batch_info, planned_batch = in_flight.pop(batch_object.id)
+                    reserved.remove(planned_batch)
+                    self.ledger.release(model_of(planned_batch), planned_batch.num_tokens)
+                    enqueued_tokens -= planned_batch.num_tokens
+                    finished.append(batch_info)
+                collect_outputs(finished)
+        finally:
+            for planned_batch in reserved:
+                self.ledger.release(model_of(planned_batch), planned_batch.num_tokens)
+
+        return outputs_clean, failed
+
+
+class AsyncOpenAIBatchHandler(OpenAIBatchHandler):
+    """
+    OpenAIBatchHandler that uploads, polls and downloads its batches concurrently with the
+    async client, with at most max_concurrency requests at a time. The requests run in an
+    event loop of its own, so it can replace OpenAIBatchHandler in sync code. Async code
+    can await upload_batches_in_thread, which runs the (blocking) upload_batches in a
+    worker thread.
+    """
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        log_dir: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+        ledger: Optional[EnqueuedTokenLedger] = None,
+        base_url: Optional[str] = None,
+        backend: Optional[Any] = None,
+        max_concurrency: int = 16,
+    ):
+        super().__init__(
+            api_key=api_key,
+            log_dir=log_dir,
+            response_cache=response_cache,
+            ledger=ledger,
+            base_url=base_url,
+            backend=backend,
+        )
+        if backend is not None:
+            self.async_client = backend.async_client()
+        else:
+            self.async_client = openai.AsyncClient(
+                api_key=api_key or os.getenv("OPENAI_API_KEY"), base_url=base_url
+            )
+        self.max_concurrency = max_concurrency
+        self._semaphore = None
+        self._loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._loop_thread.start()
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    async def _gather(self, coroutines) -> list:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def bounded(coroutine):
+            async with self._semaphore:
+                return await coroutine
+
+        return await asyncio.gather(*[bounded(coroutine) for coroutine in coroutines])
+
+    def close(self):
+        if self._loop.is_closed():
+            return
+        self._run(self.async_client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop_thread.join()
+        self._loop.close()
+        super().close()
+
+    async def _retrieve_many_async(self, batch_ids: list[str]) -> list:
+        found = {}
+        if len(batch_ids) > 1:
+            wanted = set(batch_ids)
+            oldest = self._list_window(batch_ids)
+            page = await self.async_client.batches.list(limit=100)
+            while True:
+                for batch_object in page.data:
+                    if batch_object.id in wanted:
+                        found[batch_object.id] = batch_object
+                    if len(found) == len(wanted) or batch_object.created_at < oldest:
+                        break
+                else:
+                    if page.has_next_page():
+                        page = await page.get_next_page()
+                        continue
+                break
+        missing = [batch_id for batch_id in batch_ids if batch_id not in found]
+        retrieved = await self._gather(
+            self.async_client.batches.retrieve(batch_id) for batch_id in missing
+        )
+        found |= dict(zip(missing, retrieved))
+        for batch_id in batch_ids:
+            self._batch_created_at[batch_id] = found[batch_id].created_at
+        return [found[batch_id] for batch_id in batch_ids]
+
+    def _retrieve_many(self, batch_ids: list[str]) -> list:
+        return self._run(self._retrieve_many_async(batch_ids))
+
+    async def _create_batch_async(
+        self, batch_info: BatchInfo, input_file: str, endpoint: str
+    ) -> BatchInfo:
+        with self._open_batch_input(input_file) as f:
+            file_object = await self.async_client.files.create(file=f, purpose="batch")
+        batch_object = await self.async_client.batches.create(
+            input_file_id=file_object.id, endpoint=endpoint, completion_window="24h"
+        )
+        batch_info.file_id = file_object.id
+        batch_info.batch_id = batch_object.id
+        self._write_metadata(batch_info, batch_info.batch_call_id, batch_info.index)
+        return batch_info
+
+    def _upload_many(
+        self,
+        requests: list[dict],
+        planned_batches: list[PlannedBatch],
+        batch_call_id: str,
+        endpoint: str,
+    ) -> list[BatchInfo]:
+        prepared = [
+            self._prepare_planned_batch(requests, planned_batch, batch_call_id, endpoint)
+            for planned_batch in planned_batches
+        ]
+        self._run(
+            self._gather(
+                self._create_batch_async(batch_info, input_file, endpoint)
+                for batch_info, input_file in prepared
+                if input_file is not None
+            )
+        )
+        return [batch_info for batch_info, _ in prepared]
+
+    async def _stream_file_async(self, file_id: Optional[str], path: str):
+        with atomic_open(path, "wb") as f:
+            if file_id is None:
+                return
+            async with self.async_client.files.with_streaming_response.content(
+                file_id
+            ) as response:
+                async for chunk in response.iter_bytes(DOWNLOAD_CHUNK_SIZE):
+                    f.write(chunk)
+
+    async def _stream_output_async(self, metadata: BatchInfo):
+        batch_object = await self.async_client.batches.retrieve(metadata.batch_id)
+        await self._stream_file_async(
+            batch_object.error_file_id, self._output_file(metadata, "errors")
+        )
+        await self._stream_file_async(
+            batch_object.output_file_id, self._output_file(metadata)
+        )
+
+    def _download_many(self, batch_infos: list[BatchInfo]):
+        self._run(
+            self._gather(
+                self._stream_output_async(batch_info)
+                for batch_info in batch_infos
+                if not os.path.exists(self._output_file(batch_info))
+            )
+        )
+
+    async def upload_batches_in_thread(self, requests: list[dict], **kwargs):
+        """
+        Awaits upload_batches run in a worker thread, so that the event loop of the caller
+        is not blocked while the batches are polled. This is not an await-based version of
+        upload_batches: the planning and waiting for the enqueued-token ledger still block
+        that thread, and only the HTTP requests run on the async client.
+        """
+
+        return await asyncio.to_thread(self.upload_batches, requests, **kwargs)
+
+
+_current_participant: ContextVar[Optional[tuple["SharedBatchSubmission", int]]] = (
+    ContextVar("current_batch_participant", default=None)
+)
+
+
+class SharedBatchSubmission:
+    """
+    Lets stages running in parallel (see pipeline.parallelize) send their requests in a
+    single submission instead of uploading and polling their own batches. Each participant
+    registers its requests from OpenAIBatchHandler.upload_batches; once every participant
+    has registered or left, the requests are uploaded and polled together, with one group
+    of batches per model, and each participant gets its own outputs back.
+    The batches of a model respect the batch limits of all its participants (see
+    _merged_upload_kwargs). Calls without process_output are not shared.
+    """
+
+    def __init__(
+        self,
+        num_participants: int,
+        log_dir: Optional[str] = None,
+        batch_call_id: str = "shared",
+    ):
+        self.log_dir = log_dir
+        self.batch_call_id = batch_call_id
+        self._pending = set(range(num_participants))
+        self._submissions = {}
+        self._outputs = None
+        self._batch_timings = {}
+        self._handler_type = OpenAIBatchHandler
+        self._handler_options = {}
+        self._error = None
+        self._done = False
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def participant(self, index: int):
+        """Context in which the upload_batches calls of participant index are shared."""
+
+        token = _current_participant.set((self, index))
+        try:
+            yield
+        finally:
+            _current_participant.reset(token)
+            self.leave(index)
+
+    def leave(self, index: int):
+        """Called when a participant will not submit (anymore), e.g. its output was cached."""
+
+        with self._condition:
+            if index not in self._pending:
+                return
+            self._pending.discard(index)
+            is_last = not self._pending
+        if is_last:
+            self._run()
+
+    def submit(
+        self,
+        index: int,
+        handler: "OpenAIBatchHandler",
+        requests: list[dict],
+        process_output: Optional[Callable[[dict], Any]],
+        **upload_kwargs,
+    ) -> Optional[list]:
+        """
+        Blocks until the shared submission is done and returns the outputs of the
+        participant, or returns None if the requests cannot be shared (they are then
+        sent on their own), e.g. for the second call of the same participant.
+        """
+
+        if process_output is None:
+            # Its outputs are not processed like the others', so it does not wait for them
+            self.leave(index)
+            return None
+
+        with self._condition:
+            if index not in self._pending:
+                return None
+            self._submissions[index] = (requests, process_output, upload_kwargs)
+            self._handler_type = type(handler)
+            self._handler_options = dict(
+                response_cache=handler.response_cache, **handler._client_options
+            )
+            self._pending.discard(index)
+            is_last = not self._pending
+        if is_last:
+            self._run()
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._done)
+            if self._error is not None:
+                raise self._error
+            handler.batch_timings.update(self._batch_timings)
+            return self._outputs[index]
+
+    def _merged_upload_kwargs(self, indices: list[int]) -> dict:
+        """
+        upload_batches arguments that hold for all the participants of indices: the
+        smallest batches any of them allows, the sum of their enqueued-token limits, the
+        highest priority and number of retries, and all their on_batch_finished callbacks.
+        """
+
+        all_kwargs = [self._submissions[index][2] for index in indices]
+
+        def smallest(key):
+            values = [kwargs[key] for kwargs in all_kwargs if kwargs[key] is not None]
+            return min(values, default=None)
+
+        endpoints = {kwargs["endpoint"] for kwargs in all_kwargs}
+        if len(endpoints) > 1:
+            raise ValueError(f"Participants use different endpoints: {sorted(endpoints)}")
+        callbacks = [
+            kwargs["on_batch_finished"]
+            for kwargs in all_kwargs
+            if kwargs["on_batch_finished"] is not None
+        ]
+        enqueued_limits = [kwargs["max_enqueued_tokens"] for kwargs in all_kwargs]
+
+        def on_batch_finished(batch):
+            for callback in callbacks:
+                callback(batch)
+
+        return dict(
+            endpoint=endpoints.pop(),
+            max_tokens_per_batch=smallest("max_tokens_per_batch"),
+            max_requests_per_batch=smallest("max_requests_per_batch"),
+            max_enqueued_tokens=(
+                None if None in enqueued_limits else sum(enqueued_limits)
+            ),
+            on_batch_finished=on_batch_finished if callbacks else None,
+            max_retries=max(kwargs["max_retries"] for kwargs in all_kwargs),
+            priority=max(kwargs["priority"] for kwargs in all_kwargs),
+        )
+
+    def _upload_model(self, model: str, entries: list[tuple[int, int, dict, Callable]]):
+        # This upload must not be shared again
+        token = _current_participant.set(None)
+        try:
+            with self._handler_type(
+                log_dir=self.log_dir, **self._handler_options
+            ) as handler:
+                outputs = handler.upload_batches(
+                    requests=[request for _, _, request, _ in entries],
+                    batch_call_id=f"{self.batch_call_id}-{model}",
+                    process_output=[process for _, _, _, process in entries],
+                    **self._merged_upload_kwargs(
+                        sorted({index for index, _, _, _ in entries})
+                    ),
+                )
+            return outputs, handler.batch_timings
+        finally:
+            _current_participant.reset(token)
+
+    def _run(self):
+        # In participant order, so that a rerun reuses the checkpoints of the same batches
+        entries_by_model = {}
+        for index in sorted(self._submissions):
+            requests, process_output, _ = self._submissions[index]
+            for position, request in enumerate(requests):
+                entries_by_model.setdefault(request["model"], []).append(
+                    (index, position, request, process_output)
+                )
+
+        outputs = {
+            index: [None] * len(requests)
+            for index, (requests, _, _) in self._submissions.items()
+        }
+        batch_timings = {}
+        error = None
+        try:
+            # A batch can only have one model
+            with ThreadPoolExecutor(max_workers=max(len(entries_by_model), 1)) as executor:
+                results = executor.map(
+                    lambda item: self._upload_model(*item), entries_by_model.items()
+                )
+                for entries, (model_outputs, model_timings) in zip(
+                    entries_by_model.values(), results
+                ):
+                    batch_timings |= model_timings
+                    for (index, position, _, _), output in zip(entries, model_outputs):
+                        outputs[index][position] = output
+        except Exception as e:
+            error = e
 
-        return outputs_clean
+        with self._condition:
+            self._outputs = outputs
+            self._batch_timings = batch_timings
+            self._error = error
+            self._done = True
+            self._condition.notify_all()
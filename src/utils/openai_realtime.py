@@ -0,0 +1,197 @@
+import os
+import time
+import threading
+from typing import Any, Callable, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import openai
+from tqdm import tqdm
+
+from utils.openai import (
+    CACHE_WRITE_SIZE,
+    OpenAIBatchHandler,
+    output_error,
+    process_raw_output,
+)
+from utils.response_cache import ResponseCache
+
+# Default rate limits of the real-time API
+DEFAULT_REQUESTS_PER_MINUTE = 500
+DEFAULT_TOKENS_PER_MINUTE = 200_000
+
+
+class TokenBucket:
+    """
+    Rate limiter for requests and tokens per minute. Each bucket holds up to one minute of
+    its limit and refills continuously; acquire() blocks until both have enough for the
+    request.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = float(requests_per_minute)
+        self._tokens = float(tokens_per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._requests = min(
+            self.requests_per_minute,
+            self._requests + elapsed * self.requests_per_minute / 60,
+        )
+        self._tokens = min(
+            self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60
+        )
+
+    def acquire(self, tokens: int):
+        # A request larger than the bucket waits for a full bucket
+        tokens = min(tokens, self.tokens_per_minute)
+        with self._lock:
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    return
+                time.sleep(
+                    max(
+                        (1 - self._requests) * 60 / self.requests_per_minute,
+                        (tokens - self._tokens) * 60 / self.tokens_per_minute,
+                    )
+                )
+
+
+_rate_limiters: dict[tuple, TokenBucket] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def shared_rate_limiter(
+    key: tuple, requests_per_minute: int, tokens_per_minute: int
+) -> TokenBucket:
+    """
+    The bucket of the process for key (API key, base URL and model), shared by every
+    handler so that stages running at the same time stay within the limits together. The
+    limits of the first handler that uses it apply.
+    """
+
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = TokenBucket(requests_per_minute, tokens_per_minute)
+        return _rate_limiters[key]
+
+
+class OpenAIRealtimeHandler(OpenAIBatchHandler):
+    """
+    Drop-in replacement of OpenAIBatchHandler that sends the requests of upload_batches
+    to the chat completions endpoint right away, up to max_concurrency at a time and within
+    the requests and tokens per minute limits, instead of waiting for the batch API.
+    Outputs, the response cache and retries work as with batches (the batch limits are
+    ignored), but requests cost twice as much. The limits are shared by all the handlers
+    of the process that send requests of the same model to the same account.
+    """
+
+    shares_batches = False
+    price_multiplier = 2.0
+    rate_limited = True
+
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        log_dir: Optional[str] = None,
+        response_cache: Optional[ResponseCache] = None,
+        base_url: Optional[str] = None,
+        backend: Optional[Any] = None,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = 32,
+    ):
+        super().__init__(
+            api_key=api_key,
+            log_dir=log_dir,
+            response_cache=response_cache,
+            base_url=base_url,
+            backend=backend,
+        )
+        self.requests_per_minute = requests_per_minute or int(
+            os.getenv("OPENAI_REALTIME_RPM", DEFAULT_REQUESTS_PER_MINUTE)
+        )
+        self.tokens_per_minute = tokens_per_minute or int(
+            os.getenv("OPENAI_REALTIME_TPM", DEFAULT_TOKENS_PER_MINUTE)
+        )
+        self.max_concurrency = max_concurrency
+
+    def rate_limiter(self, model: str) -> TokenBucket:
+        key = (
+            getattr(self.client, "api_key", None),
+            str(getattr(self.client, "base_url", "")),
+            model,
+        )
+        return shared_rate_limiter(key, self.requests_per_minute, self.tokens_per_minute)
+
+    def _send(self, custom_id: str, body: dict, tokens: int) -> dict:
+        """Sends a request and returns its output as a line of a batch output file."""
+
+        if self.rate_limited:
+            self.rate_limiter(body["model"]).acquire(tokens)
+        try:
+            completion = self.client.chat.completions.create(**body)
+        except openai.APIStatusError as e:
+            error = e.body if isinstance(e.body, dict) else {"message": e.message}
+            response = {"status_code": e.status_code, "body": {"error": error}}
+            return {"custom_id": custom_id, "response": response, "error": None}
+        except openai.APIConnectionError as e:
+            return {"custom_id": custom_id, "response": None, "error": {"message": str(e)}}
+        response = {"status_code": 200, "body": completion.model_dump(mode="json")}
+        return {"custom_id": custom_id, "response": response, "error": None}
+
+    def _run_batches(
+        self,
+        requests: list[dict],
+        process_output: Optional[Callable[[dict], Any] | list[Callable[[dict], Any]]],
+        endpoint: str,
+        batch_call_id: str,
+        **batch_limits,
+    ) -> tuple[list, set[int]]:
+        outputs = [None for _ in range(len(requests))]
+        failed = set()
+        if self.rate_limited:
+            tokens = [self._count_request_tokens(requests, i) for i in range(len(requests))]
+        else:
+            tokens = [0 for _ in range(len(requests))]
+
+        to_cache = []
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            futures = {
+                executor.submit(
+                    self._send, f"{batch_call_id}::{i}", requests[i], tokens[i]
+                ): i
+                for i in range(len(requests))
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                i = futures[future]
+                output_raw = future.result()
+                error = output_error(output_raw)
+
+                key = self._response_cache_keys.get(output_raw["custom_id"])
+                if key is not None and error is None:
+                    to_cache.append((key, output_raw["response"]["body"]))
+                    if len(to_cache) >= CACHE_WRITE_SIZE:
+                        self.response_cache.put_many(to_cache)
+                        to_cache = []
+
+                if process_output is not None:
+                    outputs[i] = process_raw_output(output_raw, process_output)
+                elif error:
+                    outputs[i] = error
+                    failed.add(i)
+                else:
+                    outputs[i] = output_raw["response"]["body"]
+        if to_cache:
+            self.response_cache.put_many(to_cache)
+
+        return outputs, failed
+
@@ -0,0 +1,84 @@
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from typing import Iterable, Optional
+
+DEFAULT_RESPONSE_CACHE = "data/cache/openai_responses.sqlite"
+
+# Number of keys per SELECT (SQLite limits the number of parameters of a query)
+_QUERY_SIZE = 500
+
+
+def request_key(body: dict) -> str:
+    """Hash of the canonical JSON of a request body (model, messages and parameters)."""
+
+    canonical = json.dumps(
+        body, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """
+    Persistent store of the response bodies of successful requests, keyed by request_key,
+    shared by every stage and run, so that a request that was already answered is never
+    sent again (e.g. after changing a prompt or a threshold, only the requests that
+    changed are sent).
+    """
+
+    def __init__(self, path: str = DEFAULT_RESPONSE_CACHE):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses"
+                " (key TEXT PRIMARY KEY, response TEXT NOT NULL)"
+            )
+
+    def get_many(self, keys: list[str]) -> dict[str, dict]:
+        responses = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for i in range(0, len(unique_keys), _QUERY_SIZE):
+                chunk = unique_keys[i : i + _QUERY_SIZE]
+                rows = self._connection.execute(
+                    "SELECT key, response FROM responses WHERE key IN"
+                    f" ({','.join('?' * len(chunk))})",
+                    chunk,
+                )
+                for key, response in rows:
+                    responses[key] = json.loads(response)
+        return responses
+
+    def put_many(self, items: Iterable[tuple[str, dict]]):
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO responses (key, response) VALUES (?, ?)",
+                (
+                    (key, json.dumps(response, ensure_ascii=False))
+                    for key, response in items
+                ),
+            )
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+_default_caches: dict[str, ResponseCache] = {}
+_default_caches_lock = threading.Lock()
+
+
+def default_response_cache(path: Optional[str] = None) -> ResponseCache:
+    """The cache of the process at path (by default, $OPENAI_RESPONSE_CACHE)."""
+
+    path = path or os.getenv("OPENAI_RESPONSE_CACHE", DEFAULT_RESPONSE_CACHE)
+    with _default_caches_lock:
+        if path not in _default_caches:
+            _default_caches[path] = ResponseCache(path)
+        return _default_caches[path]
@@ -0,0 +1,164 @@
+import os
+import glob
+import json
+import time
+import threading
+
+from utils.input_output import atomic_open, read_records, sibling_file
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+def current_rss_mb() -> float | None:
+    """Resident memory of the process now (None where /proc is not available)."""
+
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") / 1024**2
+
+
+def process_cpu_time() -> float:
+    """
+    CPU time of all the threads of the process and of its child processes that have ended
+    (e.g. the process pools of the stages).
+    """
+
+    if resource is None:
+        return time.process_time()
+    return sum(
+        usage.ru_utime + usage.ru_stime
+        for usage in (
+            resource.getrusage(resource.RUSAGE_SELF),
+            resource.getrusage(resource.RUSAGE_CHILDREN),
+        )
+    )
+
+
+class StageMonitor:
+    """
+    Measures the wall time, the CPU time and the resident memory of the process while a
+    stage runs, sampling the memory every interval seconds. The CPU time and the memory
+    are those of the whole process, so they include the stages running concurrently.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.wall_time = None
+        self.cpu_time = None
+        self.start_rss_mb = None
+        self.peak_rss_mb = None
+        self.end_rss_mb = None
+
+    def __enter__(self):
+        self.start_rss_mb = self.peak_rss_mb = current_rss_mb()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+        self._sampler.start()
+        self._start = time.perf_counter()
+        self._start_cpu = process_cpu_time()
+        return self
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._record_rss(current_rss_mb())
+
+    def _record_rss(self, rss_mb):
+        if rss_mb is not None:
+            self.peak_rss_mb = max(self.peak_rss_mb or 0.0, rss_mb)
+
+    def __exit__(self, *exc_info):
+        self.wall_time = time.perf_counter() - self._start
+        self.cpu_time = process_cpu_time() - self._start_cpu
+        self._stop.set()
+        self._sampler.join()
+        self.end_rss_mb = current_rss_mb()
+        self._record_rss(self.end_rss_mb)
+        return False
+
+
+def count_records(path: str) -> int:
+    if path.endswith(".jsonl"):
+        with open(path, "rb") as f:
+            return sum(1 for line in f if line.strip())
+    return sum(1 for _ in read_records(path))
+
+
+def artifact_size(path: str) -> int:
+    """Size of a stage artifact together with its side files (.metadata, .unfiltered...)."""
+
+    root, _ = os.path.splitext(path)
+    paths = {path} | set(glob.glob(glob.escape(root) + ".*"))
+    return sum(os.path.getsize(p) for p in paths if os.path.isfile(p))
+
+
+def stage_telemetry(
+    input_files: list[str], output_file: str, monitor: StageMonitor
+) -> dict:
+    """
+    peak_rss_mb is the highest resident memory of the process while the stage ran, and
+    rss_delta_mb how much it grew over the stage (see StageMonitor).
+    """
+
+    wall_time = monitor.wall_time
+    records = sum(count_records(input_file) for input_file in input_files)
+    return {
+        "wall_time": wall_time,
+        "cpu_time": monitor.cpu_time,
+        "peak_rss_mb": monitor.peak_rss_mb,
+        "rss_delta_mb": (
+            monitor.end_rss_mb - monitor.start_rss_mb
+            if monitor.start_rss_mb is not None and monitor.end_rss_mb is not None
+            else None
+        ),
+        "bytes_read": sum(os.path.getsize(input_file) for input_file in input_files),
+        "bytes_written": artifact_size(output_file),
+        "records": records,
+        "records_per_second": records / wall_time if wall_time > 0 else None,
+    }
+
+
+def read_metadata(output_file: str) -> dict:
+    metadata_file = sibling_file(output_file, "metadata", ".json")
+    if not os.path.exists(metadata_file):
+        return {}
+    with open(metadata_file, "r", encoding="utf-8") as f:
+        metadata = json.load(f)
+    return metadata if isinstance(metadata, dict) else {}
+
+
+def add_telemetry_to_metadata(output_file: str, telemetry: dict) -> dict:
+    metadata = read_metadata(output_file) | {"telemetry": telemetry}
+    with atomic_open(
+        sibling_file(output_file, "metadata", ".json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=4)
+    return metadata
+
+
+def critical_path(stage_inputs: dict[str, list[str]], wall_times: dict[str, float]):
+    """Longest chain of dependent stages, by wall time. stage_inputs must be in DAG order."""
+
+    finish_times = {}
+    previous_stage = {}
+    for name, inputs in stage_inputs.items():
+        slowest_input = max(inputs, key=lambda i: finish_times[i], default=None)
+        previous_stage[name] = slowest_input
+        finish_times[name] = wall_times.get(name, 0.0) + (
+            finish_times[slowest_input] if slowest_input is not None else 0.0
+        )
+
+    if not finish_times:
+        return [], 0.0
+    name = max(finish_times, key=finish_times.get)
+    total = finish_times[name]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous_stage[name]
+    return path[::-1], total
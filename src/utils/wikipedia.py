@@ -1,9 +1,13 @@
+import os
 import requests
 import json
 
+# Can point to a local stand-in of the API, e.g. for benchmarks
+WIKIPEDIA_API_URL = os.getenv("WIKIPEDIA_API_URL", "https://en.wikipedia.org/w/api.php")
+
 def do_wiki_request(query):
     query_string = "&".join([f"{key}={requests.utils.quote(str(value))}" for key, value in query.items()])
-    url = f"https://en.wikipedia.org/w/api.php?{query_string}"
+    url = f"{WIKIPEDIA_API_URL}?{query_string}"
     
     try:
         response = requests.get(url)